@@ -0,0 +1,157 @@
+# app/balance_cache.py
+# Caché en proceso de saldos por user_id para GET /bank/balance.
+#
+# Los handlers que mueven dinero escriben en la caché los saldos que ya
+# devuelven (write-through). Las funciones SQL avisan por el canal
+# 'balance_changed' (ver bank.notify_balance_changed) y los demás workers
+# invalidan esas entradas; esos usuarios además leen del primario durante un
+# rato (ver ReplicaRouter en db.py).
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from .db import env_float, env_int, local_backend_pids, note_write
+from .notify import subscribe
+
+BALANCE_CACHE_TTL = env_float('BALANCE_CACHE_TTL', 30.0)
+BALANCE_CACHE_SIZE = env_int('BALANCE_CACHE_SIZE', 10000)
+BALANCE_CHANNEL = 'balance_changed'
+BALANCE_FIELDS = ("account_balance", "credit_card_debt")
+
+
+class BalanceCache:
+    """
+    LRU con TTL. Cada usuario tiene una generación que cambia con cada escritura:
+    un handler la lee antes de ir a la base y solo escribe si nadie más escribió
+    entretanto; si no, invalida (dos escrituras concurrentes nunca dejan un saldo viejo).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (saldos, etag, expira_en)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def get(self, user_id: int) -> tuple | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[2] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def update(self, user_id: int, version: int, **fields) -> tuple | None:
+        """
+        Escribe los saldos conocidos y devuelve (saldos, etag); con campos
+        parciales solo completa una entrada existente.
+        """
+        with self._lock:
+            current_gen = self._generations.get(user_id, 0)
+            self._generations[user_id] = current_gen + 1
+            entry = self._entries.get(user_id)
+            if version != current_gen:
+                self._drop(user_id)
+                return None
+            if entry is not None:
+                balances = {**entry[0], **fields}
+            elif all(field in fields for field in BALANCE_FIELDS):
+                balances = dict(fields)
+            else:
+                return None
+            etag = _etag(user_id, balances)
+            self._entries[user_id] = (balances, etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return balances, etag
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._drop(user_id)
+
+    def _drop(self, user_id: int):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for user_id in list(self._entries):
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "invalidations": self.invalidations}
+
+
+def _etag(user_id: int, balances: dict) -> str:
+    raw = f"{user_id}:" + ":".join(repr(balances.get(field)) for field in BALANCE_FIELDS)
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+_cache = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+_synced_pid = None
+_sync_lock = threading.Lock()
+
+def _on_balance_changed(message: str):
+    backend_pid, _, rest = message.partition('|')
+    written, _, others = rest.partition('|')
+    # Los saldos `written` de un aviso propio ya se escribieron en caché
+    own = backend_pid.isdigit() and int(backend_pid) in local_backend_pids()
+    for user_id in written.split(',') + others.split(','):
+        if user_id.isdigit():
+            # Sus próximas lecturas no van a la réplica hasta que esta se ponga al día
+            note_write(int(user_id))
+    user_ids = others.split(',') if own else written.split(',') + others.split(',')
+    for user_id in user_ids:
+        if user_id.isdigit():
+            _cache.invalidate(int(user_id))
+
+def _ensure_synced():
+    global _synced_pid
+    pid = os.getpid()
+    if _synced_pid == pid:
+        return
+    with _sync_lock:
+        if _synced_pid == pid:
+            return
+        _cache.clear()
+        # Tras una reconexión pudimos perder avisos: se vacía la caché
+        subscribe(BALANCE_CHANNEL, _on_balance_changed, on_reconnect=_cache.clear)
+        _synced_pid = pid
+
+def init_balance_cache():
+    """Se suscribe a 'balance_changed' (warm-up del worker)."""
+    _ensure_synced()
+
+def cached_balances(user_id: int) -> tuple | None:
+    """(saldos, etag) vigentes en caché, o None."""
+    _ensure_synced()
+    return _cache.get(user_id)
+
+def balance_version(user_id: int) -> int:
+    """Generación a leer antes de modificar o consultar saldos en la base."""
+    return _cache.version(user_id)
+
+def update_balances(user_id: int, version: int, **fields) -> tuple | None:
+    _ensure_synced()
+    return _cache.update(user_id, version, **fields)
+
+def invalidate_balances(user_id: int):
+    _cache.invalidate(user_id)
+
+def balance_cache_stats() -> dict:
+    return _cache.stats()
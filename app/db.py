@@ -1,7 +1,13 @@
 # app/db.py
 import os
+import threading
+import time
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
 from datetime import datetime
+from flask import g, has_app_context, has_request_context, request
+from .metrics import CONNECTION_ACQUIRE_SECONDS, observe_query
 
 # Variables de entorno (definidas en docker-compose o con valores por defecto)
 DB_HOST = os.environ.get('POSTGRES_HOST', 'db')
@@ -10,170 +16,825 @@ DB_NAME = os.environ.get('POSTGRES_DB', 'corebank')
 DB_USER = os.environ.get('POSTGRES_USER', 'postgres')
 DB_PASSWORD = os.environ.get('POSTGRES_PASSWORD', 'postgres')
 
-def get_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    return conn
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
 
-def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    # Crear la tabla de usuarios
-    cur.execute("""
-    CREATE SCHEMA IF NOT EXISTS bank AUTHORIZATION postgres;
-    
-    CREATE TABLE IF NOT EXISTS bank.users (
-        id SERIAL PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        role TEXT NOT NULL,
-        full_name TEXT,
-        email TEXT
-    ); 
-    """) # -> Se quitó el 'commit;' de aquí
-    conn.commit()
-    
-    # Crear la tabla de cuentas
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank.accounts (
-        id SERIAL PRIMARY KEY,
-        balance NUMERIC NOT NULL DEFAULT 0,
-        user_id INTEGER REFERENCES bank.users(id)
-    );
-    """) # -> Se quitó el 'commit;' de aquí
-    conn.commit()
-    
-    # Crear la tabla de tarjetas de crédito
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank.credit_cards (
-        id SERIAL PRIMARY KEY,
-        limit_credit NUMERIC NOT NULL DEFAULT 1,
-        balance NUMERIC NOT NULL DEFAULT 0,
-        user_id INTEGER REFERENCES bank.users(id)
-    ); 
-    """) # -> Se quitó el 'commit;' de aquí
-    
-    # Create tokens table to persist authentication tokens
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank.tokens (
-        token TEXT PRIMARY KEY,
-        user_id INTEGER REFERENCES bank.users(id),
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    ); 
-    """) # -> Se quitó el 'commit;' de aquí
-    
-    conn.commit()
-    # --- INICIO DE CAMBIOS (Parte de TCE-04) - Ivan Simbana ---
-    
-    # Crear la tabla de establecimientos
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank.establecimientos (
-        id SERIAL PRIMARY KEY,
-        nombre TEXT NOT NULL,
-        direccion TEXT
-    );
-    """)
-    conn.commit()
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
 
-    # Crear la tabla de códigos OTP
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank.otp_codes (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER REFERENCES bank.users(id),
-        code TEXT NOT NULL,
-        expires_at TIMESTAMP NOT NULL,
-        used BOOLEAN NOT NULL DEFAULT FALSE
-    );
-    """)
-    conn.commit()
+# Configuración del pool (por proceso: cada worker de gunicorn tiene el suyo)
+DB_POOL_MIN = env_int('DB_POOL_MIN', 1)
+DB_POOL_MAX = env_int('DB_POOL_MAX', 10)
+DB_POOL_TIMEOUT = env_float('DB_POOL_TIMEOUT', 10.0)
+DB_POOL_PING_INTERVAL = env_float('DB_POOL_PING_INTERVAL', 30.0)
 
+# Réplica de lectura (opcional): sin POSTGRES_READ_HOST todo va al primario.
+# Usuario, clave, puerto y base por defecto son los del primario.
+DB_READ_HOST = os.environ.get('POSTGRES_READ_HOST', '')
+DB_READ_PORT = os.environ.get('POSTGRES_READ_PORT', DB_PORT)
+DB_READ_NAME = os.environ.get('POSTGRES_READ_DB', DB_NAME)
+DB_READ_USER = os.environ.get('POSTGRES_READ_USER', DB_USER)
+DB_READ_PASSWORD = os.environ.get('POSTGRES_READ_PASSWORD', DB_PASSWORD)
+DB_READ_POOL_MAX = env_int('DB_READ_POOL_MAX', DB_POOL_MAX)
+# Las lecturas van a la réplica solo si su retraso medido no supera
+# REPLICA_MAX_LAG; tras escribir, un usuario lee del primario durante
+# REPLICA_STICKY_SECONDS (debe ser mayor que REPLICA_MAX_LAG)
+REPLICA_MAX_LAG = env_float('REPLICA_MAX_LAG', 1.0)
+REPLICA_STICKY_SECONDS = env_float('REPLICA_STICKY_SECONDS', 5.0)
+REPLICA_LAG_CHECK_INTERVAL = env_float('REPLICA_LAG_CHECK_INTERVAL', 1.0)
 
-    # --- INICIO DE CAMBIOS (Parte de TCE-04) - Mateo Pilco ---
-    
-    # Se crea un nuevo esquema para datos sensibles de tarjetas
-    cur.execute("CREATE SCHEMA IF NOT EXISTS bank_secure AUTHORIZATION postgres;")
-    conn.commit()
 
-    # Tabla para guardar de forma segura los datos de tarjetas encriptados
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bank_secure.encrypted_cards (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER REFERENCES bank.users(id),
-        encrypted_card_number TEXT NOT NULL,
-        encrypted_expiry_date TEXT NOT NULL,
-        encrypted_cvv TEXT NOT NULL,
-        card_last_4_digits TEXT NOT NULL -- Para mostrar al usuario de forma segura
-    );
-    """)
-    conn.commit()
-    # --- FIN DE CAMBIOS ---
-    
-    # Insertar datos de ejemplo si no existen usuarios
-    cur.execute("SELECT COUNT(*) FROM bank.users;")
-    count = cur.fetchone()[0]
-    if count == 0:
-        sample_users = [
-            ('user1', 'pass1', 'cliente', 'Usuario Uno', 'user1@example.com'),
-            ('user2', 'pass2', 'cliente', 'Usuario Dos', 'user2@example.com'),
-            ('user3', 'pass3', 'cajero',  'Usuario Tres', 'user3@example.com')
-        ]
-        for username, password, role, full_name, email in sample_users:
-            cur.execute("""
-                INSERT INTO bank.users (username, password, role, full_name, email)
-                VALUES (%s, %s, %s, %s, %s) RETURNING id;
-            """, (username, password, role, full_name, email))
-            user_id = cur.fetchone()[0]
-            # Crear una cuenta con saldo inicial 1000
-            cur.execute("""
-                INSERT INTO bank.accounts (balance, user_id)
-                VALUES (%s, %s); commit;
-            """, (1000, user_id))
-            # Crear una tarjeta de crédito con límite 5000 y deuda 0
-            cur.execute("""
-                INSERT INTO bank.credit_cards (limit_credit, balance, user_id)
-                VALUES (%s, %s, %s); commit;
-            """, (5000, 0, user_id))
+class RoundTripCounter:
+    """Cuenta los viajes de ida y vuelta a Postgres hechos por este proceso."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def add(self, n: int = 1):
+        with self._lock:
+            self.value += n
+
+
+_round_trips = RoundTripCounter()
+
+def db_round_trips() -> int:
+    return _round_trips.value
+
+
+class CountingCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        # psycopg2 envía un BEGIN aparte al iniciar la transacción
+        conn = self.connection
+        opens_tx = not conn.autocommit and conn.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+        _round_trips.add(2 if opens_tx else 1)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe_query(time.perf_counter() - start)
+
+
+class InstrumentedConnection(extensions.connection):
+    """Conexión del pool: sus cursores y commits/rollbacks cuentan round trips."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+        # Se guarda al conectar: tras cerrar la conexión info.backend_pid vale 0
+        self.backend_pid = self.info.backend_pid
+        # Con defer_commit, commit() solo anota el pedido y quien lo activó hace
+        # el commit real (idempotency escribe su respuesta en la misma transacción)
+        self.defer_commit = False
+        self.commit_deferred = False
+        # True si viene del pool de la réplica de lectura
+        self.replica = False
+
+    def commit(self):
+        if self.defer_commit:
+            self.commit_deferred = True
+            return None
+        self.commit_deferred = False
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            _round_trips.add()
+        return super().commit()
+
+    def rollback(self):
+        self.commit_deferred = False
+        if self.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            _round_trips.add()
+        return super().rollback()
+
+
+class ConnectionPool:
+    """Pool de conexiones thread-safe con espera acotada y chequeo de vida al prestar."""
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, ping_interval: float,
+                 readonly: bool = False, **conn_kwargs):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.readonly = readonly
+        self._conn_kwargs = conn_kwargs
+        self._cond = threading.Condition()
+        self._idle = []  # pares (conexión, instante en que se devolvió)
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        # Contadores expuestos en stats()
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._created = 0
+        self._discarded = 0
+        # PIDs de backend de las conexiones abiertas, para reconocer NOTIFY propios
+        self._backend_pids = set()
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=InstrumentedConnection, **self._conn_kwargs)
+        if self.readonly:
+            # También protege una base de reemplazo que no sea réplica de verdad
+            conn.set_session(readonly=True)
+        conn.replica = self.readonly
+        with self._cond:
+            self._created += 1
+            self._backend_pids.add(conn.backend_pid)
+        return conn
+
+    def open(self):
+        """Abre las conexiones mínimas por adelantado."""
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _is_alive(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Presta una conexión; espera hasta `timeout` segundos si el pool está lleno."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolError("timed out waiting for a database connection")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            if conn is not None and not self._is_alive(conn, idle_since):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        CONNECTION_ACQUIRE_SECONDS.observe(elapsed)
+        with self._cond:
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_time_total += elapsed
+            self._wait_time_max = max(self._wait_time_max, elapsed)
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._discarded += 1
+            self._backend_pids.discard(conn.backend_pid)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def putconn(self, conn, close: bool = False):
+        """Devuelve una conexión al pool, descartando la transacción pendiente."""
+        if not close and not conn.closed:
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or conn.closed:
+            self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def backend_pids(self) -> frozenset:
+        with self._cond:
+            return frozenset(self._backend_pids)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_time_total": round(self._wait_time_total, 6),
+                "wait_time_max": round(self._wait_time_max, 6),
+                "created": self._created,
+                "discarded": self._discarded,
+            }
+
+
+def connection_kwargs(readonly: bool = False) -> dict:
+    if readonly:
+        return {
+            "host": DB_READ_HOST,
+            "port": DB_READ_PORT,
+            "dbname": DB_READ_NAME,
+            "user": DB_READ_USER,
+            "password": DB_READ_PASSWORD
+        }
+    return {
+        "host": DB_HOST,
+        "port": DB_PORT,
+        "dbname": DB_NAME,
+        "user": DB_USER,
+        "password": DB_PASSWORD
+    }
+
+def replica_configured() -> bool:
+    return bool(DB_READ_HOST)
+
+def new_connection(readonly: bool = False):
+    """
+    Conexión dedicada fuera del pool (LISTEN, cursores de larga duración).
+    Con `readonly` se abre contra la réplica si hay una configurada y responde
+    (sin mirar el retraso: la usan lecturas largas que toleran datos de hace segundos).
+    """
+    if readonly and replica_configured():
+        try:
+            conn = psycopg2.connect(**connection_kwargs(readonly=True))
+            conn.set_session(readonly=True)
+            return conn
+        except psycopg2.OperationalError:
+            _router.failed()
+    return psycopg2.connect(**connection_kwargs())
+
+
+class ReplicaRouter:
+    """
+    Decide si una lectura puede ir a la réplica: solo con un retraso medido
+    reciente y dentro de REPLICA_MAX_LAG, y nunca para un usuario que escribió
+    hace menos de REPLICA_STICKY_SECONDS (lee lo que acaba de escribir).
+    """
+
+    def __init__(self, max_lag: float, sticky_seconds: float, check_interval: float):
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        # Una medición más vieja que esto no vale (el job dejó de correr)
+        self.max_age = max(3 * check_interval, 1.0)
+        self._lock = threading.Lock()
+        self._writers = {}  # user_id -> hasta cuándo lee del primario
+        self._lag = None
+        self._measured_at = None
+        self.checks = 0
+        self.errors = 0
+        self.replica_reads = 0
+        self.primary_reads = {"unavailable": 0, "lagging": 0, "sticky": 0}
+
+    def note_write(self, user_id: int):
+        with self._lock:
+            self._writers[user_id] = time.monotonic() + self.sticky_seconds
+
+    def record_lag(self, lag: float | None):
+        with self._lock:
+            self.checks += 1
+            self._lag = lag
+            self._measured_at = time.monotonic() if lag is not None else None
+            now = time.monotonic()
+            self._writers = {user_id: until for user_id, until in self._writers.items() if until > now}
+
+    def failed(self):
+        """La réplica no respondió: se lee del primario hasta la próxima medición buena."""
+        with self._lock:
+            self.errors += 1
+            self._lag = None
+            self._measured_at = None
+
+    def use_replica(self, user_id: int | None) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._measured_at is None or now - self._measured_at > self.max_age:
+                reason = "unavailable"
+            elif self._lag > self.max_lag:
+                reason = "lagging"
+            elif user_id is not None and self._writers.get(user_id, 0) > now:
+                reason = "sticky"
+            else:
+                self.replica_reads += 1
+                return True
+            self.primary_reads[reason] += 1
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "configured": replica_configured(),
+                "lag_seconds": self._lag,
+                "max_lag": self.max_lag,
+                "checks": self.checks,
+                "errors": self.errors,
+                "replica_reads": self.replica_reads,
+                "primary_reads": dict(self.primary_reads),
+                "sticky_users": sum(1 for until in self._writers.values() if until > now),
+            }
+
+
+_router = ReplicaRouter(REPLICA_MAX_LAG, REPLICA_STICKY_SECONDS, REPLICA_LAG_CHECK_INTERVAL)
+
+_pool = None
+_pool_pid = None
+_read_pool = None
+_read_pool_pid = None
+_pool_lock = threading.Lock()
+# Conexiones heredadas de un proceso padre: no se cierran (compartirían el socket)
+_inherited_pools = []
+
+def get_pool() -> ConnectionPool:
+    """Pool del proceso actual, creado de forma perezosa (también tras un fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                DB_POOL_TIMEOUT,
+                DB_POOL_PING_INTERVAL,
+                **connection_kwargs()
+            )
+            _pool_pid = pid
+    return _pool
+
+def get_read_pool() -> ConnectionPool:
+    """Pool de la réplica de lectura del proceso actual (requiere POSTGRES_READ_HOST)."""
+    global _read_pool, _read_pool_pid
+    pid = os.getpid()
+    if _read_pool is not None and _read_pool_pid == pid:
+        return _read_pool
+    with _pool_lock:
+        if _read_pool is None or _read_pool_pid != pid:
+            if _read_pool is not None:
+                _inherited_pools.append(_read_pool)
+            _read_pool = ConnectionPool(
+                0,
+                DB_READ_POOL_MAX,
+                DB_POOL_TIMEOUT,
+                DB_POOL_PING_INTERVAL,
+                readonly=True,
+                **connection_kwargs(readonly=True)
+            )
+            _read_pool_pid = pid
+    return _read_pool
+
+def pool_stats() -> dict:
+    return get_pool().stats()
+
+def read_pool_stats() -> dict:
+    return get_read_pool().stats() if replica_configured() else {}
+
+def replica_stats() -> dict:
+    return _router.stats()
+
+def local_backend_pids() -> frozenset:
+    """PIDs de backend de las conexiones del pool de este proceso."""
+    return get_pool().backend_pids()
+
+def note_write(user_id: int):
+    """Durante REPLICA_STICKY_SECONDS las lecturas de `user_id` van al primario."""
+    _router.note_write(user_id)
+
+def check_replica_lag():
+    """
+    Mide el retraso de la réplica (job de mantenimiento). Si ya reprodujo todo
+    el WAL que el primario tenía al empezar la medición, el retraso es 0 aunque
+    no haya escrituras recientes; si no, es la antigüedad de la última
+    transacción reproducida. Una base que no está en recuperación (una copia
+    usada como reemplazo) cuenta como al día.
+    """
+    if not replica_configured():
+        return
+    conn = get_pool().getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_current_wal_lsn()::text")
+        primary_lsn = cur.fetchone()[0]
+        cur.close()
         conn.commit()
-    
-    # Insertar establecimientos de ejemplo si no existen
-    cur.execute("SELECT COUNT(*) FROM bank.establecimientos;")
-    if cur.fetchone()[0] == 0:
+    finally:
+        get_pool().putconn(conn)
+    # Con la réplica caída solo se cuenta el error (ver replica_stats): el
+    # job corre cada segundo y las lecturas ya van al primario
+    conn = _read_connection()
+    if conn is None:
+        return
+    try:
+        cur = conn.cursor()
         cur.execute("""
-            INSERT INTO bank.establecimientos (nombre, direccion) VALUES
-            ('Tienda ABC', 'Av. Siempre Viva 123'),
-            ('Restaurante XYZ', 'Calle Falsa 456');
-        """)
+            SELECT pg_is_in_recovery(),
+                   COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, FALSE),
+                   EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8
+        """, (primary_lsn,))
+        in_recovery, caught_up, replay_age = cur.fetchone()
+        cur.close()
         conn.commit()
-        
-    # Crear esquema separado para logs
-    cur.execute("""
-    CREATE SCHEMA IF NOT EXISTS logs_repo AUTHORIZATION postgres;
-    """)
-    conn.commit()
+    except psycopg2.Error:
+        get_read_pool().putconn(conn, close=True)
+        _router.failed()
+        return
+    get_read_pool().putconn(conn)
+    if not in_recovery or caught_up:
+        _router.record_lag(0.0)
+    else:
+        _router.record_lag(replay_age if replay_age is not None else float('inf'))
 
+def _read_connection():
+    """Conexión de la réplica, o None si no hay o no responde."""
+    try:
+        return get_read_pool().getconn()
+    except (psycopg2.OperationalError, PoolError):
+        _router.failed()
+        return None
 
-    # Crear tabla de logs
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS logs_repo.app_logs (
-        id SERIAL PRIMARY KEY,
-        timestamp TIMESTAMP NOT NULL,
-        log_type TEXT NOT NULL,
-        ip_address TEXT NOT NULL,
-        username TEXT NOT NULL,
-        action TEXT NOT NULL,
-        http_status INTEGER NOT NULL
+def get_connection(readonly: bool = False):
+    """
+    Dentro de un request devuelve la conexión del request (guardada en `g`),
+    prestándola del pool la primera vez. Fuera de un request presta una
+    conexión que debe devolverse con `release_connection`.
+
+    Con `readonly` la consulta puede ir a la réplica de lectura (ver
+    ReplicaRouter); si el request ya usó el primario sigue en él, para leer
+    lo que escribió.
+    """
+    if has_app_context():
+        conn = g.get('_db_conn')
+        if conn is not None and conn.closed:
+            get_pool().putconn(g.pop('_db_conn'), close=True)
+            conn = None
+        if conn is None and readonly and replica_configured():
+            conn = _request_read_connection()
+            if conn is not None:
+                return conn
+        if conn is None:
+            conn = get_pool().getconn()
+            g._db_conn = conn
+        return conn
+    if readonly and replica_configured() and _router.use_replica(None):
+        conn = _read_connection()
+        if conn is not None:
+            return conn
+    return get_pool().getconn()
+
+def _request_read_connection():
+    conn = g.get('_db_read_conn')
+    if conn is not None and conn.closed:
+        get_read_pool().putconn(g.pop('_db_read_conn'), close=True)
+        conn = None
+    if conn is None:
+        user = g.get('user')
+        if not _router.use_replica(user['id'] if user else None):
+            return None
+        conn = _read_connection()
+        if conn is not None:
+            g._db_read_conn = conn
+    return conn
+
+def release_connection(conn):
+    """Libera una conexión; las del request se devuelven en el teardown."""
+    if has_app_context() and (g.get('_db_conn') is conn or g.get('_db_read_conn') is conn):
+        return
+    (get_read_pool() if conn.replica else get_pool()).putconn(conn)
+
+def close_request_connection(exc=None):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+        # Un request que modifica y usó el primario fija las lecturas de su usuario en él
+        user = g.get('user')
+        if user and has_request_context() and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            note_write(user['id'])
+    conn = g.pop('_db_read_conn', None)
+    if conn is not None:
+        get_read_pool().putconn(conn)
+
+def init_db_app(app):
+    """Registra la devolución de la conexión del request al pool."""
+    app.teardown_appcontext(close_request_connection)
+
+# Cada función devuelve un `status` ('ok' o un código de error) que los
+# handlers traducen a las respuestas 400/404 existentes.
+MONEY_FUNCTIONS_SQL = """
+-- Aviso de saldos modificados para la caché de /bank/balance; se entrega al
+-- hacer commit. `p_written` son los usuarios cuyo saldo nuevo recibe quien
+-- llama (su worker ya lo escribió en caché); `p_others`, el resto. Lleva el PID
+-- de backend para que el worker de origen reconozca sus propios avisos.
+CREATE OR REPLACE FUNCTION bank.notify_balance_changed(p_written INTEGER[], p_others INTEGER[] DEFAULT '{}')
+RETURNS VOID AS $$
+BEGIN
+    PERFORM pg_notify('balance_changed',
+        pg_backend_pid() || '|' || array_to_string(p_written, ',') || '|' || array_to_string(p_others, ','));
+END;
+$$ LANGUAGE plpgsql;
+
+-- Cuentas calientes (bank.accounts.hot): los depósitos se anotan en
+-- bank.account_ledger sin tocar la fila del saldo; un job los suma al saldo
+-- por lotes. El saldo real es el de la fila más los movimientos pendientes.
+CREATE OR REPLACE FUNCTION bank.account_balance(p_account_id INTEGER)
+RETURNS NUMERIC AS $$
+    SELECT a.balance + COALESCE((SELECT SUM(l.amount) FROM bank.account_ledger l WHERE l.account_id = a.id), 0)
+    FROM bank.accounts a WHERE a.id = p_account_id;
+$$ LANGUAGE sql STABLE;
+
+-- Suma al saldo los movimientos pendientes del usuario antes de un débito
+-- (que valida fondos contra la fila); devuelve el saldo resultante.
+CREATE OR REPLACE FUNCTION bank.settle_ledger(p_user_id INTEGER)
+RETURNS NUMERIC AS $$
+DECLARE
+    v_balance NUMERIC;
+BEGIN
+    WITH moved AS (
+        DELETE FROM bank.account_ledger l
+        USING bank.accounts a
+        WHERE a.user_id = p_user_id AND l.account_id = a.id
+        RETURNING l.account_id, l.amount
+    )
+    UPDATE bank.accounts a SET balance = a.balance + m.total
+    FROM (SELECT account_id, SUM(amount) AS total FROM moved GROUP BY account_id) m
+    WHERE a.id = m.account_id;
+    SELECT a.balance INTO v_balance FROM bank.accounts a WHERE a.user_id = p_user_id;
+    RETURN v_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank.deposit(p_account_id INTEGER, p_amount NUMERIC)
+RETURNS TABLE (status TEXT, user_id INTEGER, account_balance NUMERIC) AS $$
+DECLARE
+    v_user_id INTEGER;
+    v_hot BOOLEAN;
+    v_balance NUMERIC;
+BEGIN
+    SELECT a.user_id, a.hot INTO v_user_id, v_hot FROM bank.accounts a WHERE a.id = p_account_id;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'account_not_found'::TEXT, NULL::INTEGER, NULL::NUMERIC;
+        RETURN;
+    END IF;
+
+    IF v_hot THEN
+        -- Sin calcular el saldo: sumar los pendientes en cada depósito costaría
+        -- O(pendientes). Sin NOTIFY: toma un lock global al hacer commit y
+        -- volvería a serializar los depósitos; avisa el roll-up (ver roll_up_ledger)
+        INSERT INTO bank.account_ledger (account_id, amount) VALUES (p_account_id, p_amount);
+        INSERT INTO bank.transactions (account_id, kind, amount) VALUES (p_account_id, 'deposit', p_amount);
+        RETURN QUERY SELECT 'ok'::TEXT, v_user_id, NULL::NUMERIC;
+        RETURN;
+    END IF;
+    UPDATE bank.accounts a SET balance = a.balance + p_amount WHERE a.id = p_account_id
+    RETURNING a.balance INTO v_balance;
+    INSERT INTO bank.transactions (account_id, kind, amount) VALUES (p_account_id, 'deposit', p_amount);
+    PERFORM bank.notify_balance_changed(ARRAY[v_user_id]);
+    RETURN QUERY SELECT 'ok'::TEXT, v_user_id, v_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank.withdraw(p_user_id INTEGER, p_amount NUMERIC)
+RETURNS TABLE (status TEXT, account_balance NUMERIC) AS $$
+DECLARE
+    v_balance NUMERIC;
+    v_account_id INTEGER;
+BEGIN
+    PERFORM bank.settle_ledger(p_user_id);
+    UPDATE bank.accounts SET balance = balance - p_amount
+    WHERE user_id = p_user_id AND balance >= p_amount
+    RETURNING balance, id INTO v_balance, v_account_id;
+    IF FOUND THEN
+        INSERT INTO bank.transactions (account_id, kind, amount) VALUES (v_account_id, 'withdraw', -p_amount);
+        PERFORM bank.notify_balance_changed(ARRAY[p_user_id]);
+        RETURN QUERY SELECT 'ok'::TEXT, v_balance;
+        RETURN;
+    END IF;
+
+    SELECT a.balance INTO v_balance FROM bank.accounts a WHERE a.user_id = p_user_id;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'account_not_found'::TEXT, NULL::NUMERIC;
+    ELSE
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, v_balance;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank.transfer(p_sender_id INTEGER, p_target_username TEXT, p_amount NUMERIC)
+RETURNS TABLE (status TEXT, account_balance NUMERIC) AS $$
+DECLARE
+    v_target_id INTEGER;
+    v_balance NUMERIC;
+    v_sender_account INTEGER;
+    v_target_account INTEGER;
+BEGIN
+    SELECT u.id INTO v_target_id FROM bank.users u WHERE u.username = p_target_username;
+
+    -- Bloqueo en orden de user_id para que transferencias cruzadas no se bloqueen mutuamente
+    PERFORM 1 FROM bank.accounts a
+    WHERE a.user_id IN (p_sender_id, v_target_id)
+    ORDER BY a.user_id
+    FOR UPDATE;
+    PERFORM bank.settle_ledger(p_sender_id);
+
+    SELECT a.balance INTO v_balance FROM bank.accounts a WHERE a.user_id = p_sender_id;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'sender_not_found'::TEXT, NULL::NUMERIC;
+        RETURN;
+    END IF;
+    IF v_balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, v_balance;
+        RETURN;
+    END IF;
+    IF v_target_id IS NULL
+       OR NOT EXISTS (SELECT 1 FROM bank.accounts a WHERE a.user_id = v_target_id) THEN
+        RETURN QUERY SELECT 'target_not_found'::TEXT, v_balance;
+        RETURN;
+    END IF;
+
+    UPDATE bank.accounts SET balance = balance - p_amount WHERE user_id = p_sender_id
+    RETURNING balance, id INTO v_balance, v_sender_account;
+    UPDATE bank.accounts SET balance = balance + p_amount WHERE user_id = v_target_id
+    RETURNING id INTO v_target_account;
+    INSERT INTO bank.transactions (account_id, kind, amount, counterparty_account_id) VALUES
+        (v_sender_account, 'transfer_out', -p_amount, v_target_account),
+        (v_target_account, 'transfer_in', p_amount, v_sender_account);
+    PERFORM bank.notify_balance_changed(ARRAY[p_sender_id], ARRAY[v_target_id]);
+    RETURN QUERY SELECT 'ok'::TEXT, v_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bank.pay_credit_balance(p_user_id INTEGER, p_amount NUMERIC)
+RETURNS TABLE (status TEXT, account_balance NUMERIC, credit_balance NUMERIC, payment NUMERIC) AS $$
+DECLARE
+    v_balance NUMERIC;
+    v_debt NUMERIC;
+    v_payment NUMERIC;
+    v_account_id INTEGER;
+BEGIN
+    PERFORM bank.settle_ledger(p_user_id);
+    SELECT a.balance INTO v_balance FROM bank.accounts a WHERE a.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'account_not_found'::TEXT, NULL::NUMERIC, NULL::NUMERIC, NULL::NUMERIC;
+        RETURN;
+    END IF;
+    IF v_balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, v_balance, NULL::NUMERIC, NULL::NUMERIC;
+        RETURN;
+    END IF;
+
+    SELECT c.balance INTO v_debt FROM bank.credit_cards c WHERE c.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'card_not_found'::TEXT, v_balance, NULL::NUMERIC, NULL::NUMERIC;
+        RETURN;
+    END IF;
+
+    v_payment := LEAST(p_amount, v_debt);
+    UPDATE bank.accounts SET balance = balance - v_payment WHERE user_id = p_user_id
+    RETURNING balance, id INTO v_balance, v_account_id;
+    UPDATE bank.credit_cards SET balance = balance - v_payment WHERE user_id = p_user_id
+    RETURNING balance INTO v_debt;
+    IF v_payment > 0 THEN
+        INSERT INTO bank.transactions (account_id, kind, amount) VALUES (v_account_id, 'credit_payment', -v_payment);
+    END IF;
+    PERFORM bank.notify_balance_changed(ARRAY[p_user_id]);
+    RETURN QUERY SELECT 'ok'::TEXT, v_balance, v_debt, v_payment;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Compra a crédito: consume el OTP, valida el establecimiento y los fondos y
+-- mueve el dinero. `card_stored` indica si la tarjeta ya está guardada, para
+-- insertarla solo cuando es nueva. El OTP queda consumido aunque
+-- la compra se rechace (igual que al validarlo por separado).
+CREATE OR REPLACE FUNCTION bank.credit_purchase(
+    p_user_id INTEGER, p_otp_code TEXT, p_now TIMESTAMP,
+    p_establishment_id INTEGER, p_amount NUMERIC, p_card_last_4 TEXT
+)
+RETURNS TABLE (status TEXT, account_balance NUMERIC, credit_balance NUMERIC, card_stored BOOLEAN) AS $$
+DECLARE
+    v_balance NUMERIC;
+    v_debt NUMERIC;
+    v_card_stored BOOLEAN;
+    v_account_id INTEGER;
+BEGIN
+    UPDATE bank.otp_codes SET used = TRUE
+    WHERE id = (
+        SELECT o.id FROM bank.otp_codes o
+        WHERE o.user_id = p_user_id AND o.code = p_otp_code
+          AND o.used = FALSE AND o.expires_at > p_now
+        ORDER BY o.expires_at DESC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) AND used = FALSE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'invalid_otp'::TEXT, NULL::NUMERIC, NULL::NUMERIC, NULL::BOOLEAN;
+        RETURN;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM bank.establecimientos e WHERE e.id = p_establishment_id) THEN
+        RETURN QUERY SELECT 'invalid_establishment'::TEXT, NULL::NUMERIC, NULL::NUMERIC, NULL::BOOLEAN;
+        RETURN;
+    END IF;
+
+    v_card_stored := EXISTS (
+        SELECT 1 FROM bank_secure.encrypted_cards ec
+        WHERE ec.user_id = p_user_id AND ec.card_last_4_digits = p_card_last_4
     );
-    """)
-    conn.commit()
 
-    cur.close()
-    conn.close()
+    PERFORM bank.settle_ledger(p_user_id);
+    SELECT a.balance INTO v_balance FROM bank.accounts a WHERE a.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'account_not_found'::TEXT, NULL::NUMERIC, NULL::NUMERIC, v_card_stored;
+        RETURN;
+    END IF;
+    IF v_balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, v_balance, NULL::NUMERIC, v_card_stored;
+        RETURN;
+    END IF;
+
+    UPDATE bank.credit_cards SET balance = balance + p_amount WHERE user_id = p_user_id
+    RETURNING balance INTO v_debt;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'card_not_found'::TEXT, v_balance, NULL::NUMERIC, v_card_stored;
+        RETURN;
+    END IF;
+    UPDATE bank.accounts SET balance = balance - p_amount WHERE user_id = p_user_id
+    RETURNING balance, id INTO v_balance, v_account_id;
+    INSERT INTO bank.transactions (account_id, kind, amount, description)
+    VALUES (v_account_id, 'credit_purchase', -p_amount, 'establecimiento ' || p_establishment_id);
+    PERFORM bank.notify_balance_changed(ARRAY[p_user_id]);
+    RETURN QUERY SELECT 'ok'::TEXT, v_balance, v_debt, v_card_stored;
+END;
+$$ LANGUAGE plpgsql;
+"""
 
 def establecimiento_valido(id_establecimiento: int) -> bool:
     conn = get_connection()
@@ -181,54 +842,372 @@ def establecimiento_valido(id_establecimiento: int) -> bool:
     cur.execute("SELECT COUNT(*) FROM bank.establecimientos WHERE id = %s", (id_establecimiento,))
     count = cur.fetchone()[0]
     cur.close()
-    conn.close()
+    release_connection(conn)
     return count > 0
 
+# --- OTP ---
+OTP_MAX_ACTIVE_PER_USER = env_int('OTP_MAX_ACTIVE_PER_USER', 5)
+OTP_PURGE_BATCH_SIZE = env_int('OTP_PURGE_BATCH_SIZE', 1000)
+OTP_PURGE_MAX_BATCHES = env_int('OTP_PURGE_MAX_BATCHES', 50)
+
+# Consume el código en una sola sentencia: dos requests concurrentes con el
+# mismo código no pueden validarlo ambos (el segundo salta la fila bloqueada).
+CONSUME_OTP_SQL = """
+    UPDATE bank.otp_codes SET used = TRUE
+    WHERE id = (
+        SELECT id FROM bank.otp_codes
+        WHERE user_id = %s AND code = %s AND used = FALSE AND expires_at > %s
+        ORDER BY expires_at DESC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) AND used = FALSE
+    RETURNING id
+"""
+
+
+class OTPMetrics:
+    """Contadores de validación de OTP y tamaño de bank.otp_codes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.validations = 0
+        self.valid = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.purged = 0
+        self.table_rows = None
+        self.table_bytes = None
+
+    def record_validation(self, valid: bool, elapsed: float):
+        with self._lock:
+            self.validations += 1
+            if valid:
+                self.valid += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "validations": self.validations,
+                "valid": self.valid,
+                "invalid": self.validations - self.valid,
+                "latency_total": round(self.latency_total, 6),
+                "latency_max": round(self.latency_max, 6),
+                "purged": self.purged,
+                "table_rows": self.table_rows,
+                "table_bytes": self.table_bytes,
+            }
+
+
+_otp_metrics = OTPMetrics()
+
+def otp_stats() -> dict:
+    return _otp_metrics.snapshot()
+
 def save_otp(user_id: int, code: str, expires_at: datetime):
     conn = get_connection()
     cur = conn.cursor()
+    # Solo quedan vigentes los OTP_MAX_ACTIVE_PER_USER más recientes del usuario
     cur.execute("""
+        WITH stale AS (
+            UPDATE bank.otp_codes SET used = TRUE
+            WHERE id IN (
+                SELECT id FROM bank.otp_codes
+                WHERE user_id = %s AND used = FALSE
+                ORDER BY expires_at DESC
+                OFFSET %s
+            )
+        )
         INSERT INTO bank.otp_codes (user_id, code, expires_at, used)
         VALUES (%s, %s, %s, FALSE)
-    """, (user_id, code, expires_at))
+    """, (user_id, max(OTP_MAX_ACTIVE_PER_USER - 1, 0), user_id, code, expires_at))
     conn.commit()
     cur.close()
-    conn.close()
+    release_connection(conn)
 
 def validate_otp(user_id: int, code: str) -> bool:
+    start = time.perf_counter()
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT id, expires_at, used FROM bank.otp_codes
-        WHERE user_id = %s AND code = %s
-        ORDER BY expires_at DESC LIMIT 1
-    """, (user_id, code))
-    row = cur.fetchone()
-    if not row:
+    try:
+        cur.execute(CONSUME_OTP_SQL, (user_id, code, datetime.utcnow()))
+        valid = cur.fetchone() is not None
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        valid = False
+    finally:
         cur.close()
-        conn.close()
-        return False
+        release_connection(conn)
+    _otp_metrics.record_validation(valid, time.perf_counter() - start)
+    return valid
 
-    otp_id, expires_at, used = row
-    if used:
+def purge_otp_codes() -> int:
+    """Borra OTP usados o vencidos en lotes acotados; devuelve cuántos borró."""
+    total = 0
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        for _ in range(OTP_PURGE_MAX_BATCHES):
+            cur.execute("""
+                DELETE FROM bank.otp_codes
+                WHERE id IN (
+                    SELECT id FROM bank.otp_codes
+                    WHERE used = TRUE OR expires_at < %s
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (datetime.utcnow(), OTP_PURGE_BATCH_SIZE))
+            deleted = cur.rowcount
+            conn.commit()
+            total += deleted
+            if deleted < OTP_PURGE_BATCH_SIZE:
+                break
+        cur.execute("""
+            SELECT reltuples::BIGINT, pg_total_relation_size(oid)
+            FROM pg_class WHERE oid = 'bank.otp_codes'::regclass
+        """)
+        rows, size = cur.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cur.close()
-        conn.close()
-        return False
-    if expires_at < datetime.utcnow():
+        release_connection(conn)
+    with _otp_metrics._lock:
+        _otp_metrics.purged += total
+        _otp_metrics.table_rows = max(rows, 0)
+        _otp_metrics.table_bytes = size
+    return total
+
+# --- Cuentas calientes: roll-up de bank.account_ledger ---
+LEDGER_ROLLUP_BATCH_SIZE = env_int('LEDGER_ROLLUP_BATCH_SIZE', 5000)
+LEDGER_ROLLUP_MAX_BATCHES = env_int('LEDGER_ROLLUP_MAX_BATCHES', 20)
+
+def roll_up_ledger() -> int:
+    """
+    Suma al saldo de cada cuenta sus movimientos pendientes, en lotes (una
+    actualización por cuenta y lote); devuelve cuántos movimientos aplicó.
+    Los depósitos a cuentas calientes no avisan a las cachés: lo hace este job,
+    con un aviso por cuenta, así que un saldo cacheado en otro worker puede
+    atrasarse hasta LEDGER_ROLLUP_INTERVAL.
+    """
+    total = 0
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        for _ in range(LEDGER_ROLLUP_MAX_BATCHES):
+            cur.execute("""
+                WITH moved AS (
+                    DELETE FROM bank.account_ledger
+                    WHERE id IN (
+                        SELECT id FROM bank.account_ledger
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING account_id, amount
+                ), totals AS (
+                    SELECT account_id, SUM(amount) AS total, COUNT(*) AS entries
+                    FROM moved GROUP BY account_id
+                ), applied AS (
+                    UPDATE bank.accounts a SET balance = a.balance + t.total
+                    FROM totals t WHERE a.id = t.account_id
+                    RETURNING t.entries, a.user_id
+                )
+                SELECT COALESCE(SUM(entries), 0)::INTEGER, COALESCE(array_agg(DISTINCT user_id), '{}')
+                FROM applied
+            """, (LEDGER_ROLLUP_BATCH_SIZE,))
+            applied, user_ids = cur.fetchone()
+            if user_ids:
+                # Nadie escribió estos saldos en caché: todos los workers invalidan
+                cur.execute(
+                    "SELECT bank.notify_balance_changed('{}', ARRAY[user_id]) FROM unnest(%s::INTEGER[]) AS user_id",
+                    (user_ids,)
+                )
+            conn.commit()
+            total += applied
+            if applied < LEDGER_ROLLUP_BATCH_SIZE:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cur.close()
-        conn.close()
-        return False
-    
-    # Si llegamos aquí, es válido y no usado, entonces marcamos como usado
+        release_connection(conn)
+    return total
+
+# --- Logs de auditoría: particiones mensuales de logs_repo.app_logs ---
+LOG_PARTITIONS_AHEAD = env_int('LOG_PARTITIONS_AHEAD', 3)
+LOG_RETENTION_MONTHS = env_int('LOG_RETENTION_MONTHS', 12)  # 0 = sin retención
+LOG_RETENTION_MODE = os.environ.get('LOG_RETENTION_MODE', 'drop')  # 'drop' o 'detach'
+
+# Serializa la creación/borrado de particiones entre workers
+_LOG_PARTITIONS_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('logs_repo.app_logs'))"
+
+# Recibe lo que no cae en ningún mes creado (p. ej. si el job de particiones
+# dejó de correr); maintain_log_partitions mueve esas filas a su mes
+APP_LOGS_DEFAULT_SQL = """
+CREATE TABLE IF NOT EXISTS logs_repo.app_logs_default PARTITION OF logs_repo.app_logs DEFAULT;
+"""
+
+APP_LOGS_SQL = """
+CREATE SEQUENCE IF NOT EXISTS logs_repo.app_logs_id_seq AS BIGINT;
+CREATE TABLE logs_repo.app_logs (
+    id BIGINT NOT NULL DEFAULT nextval('logs_repo.app_logs_id_seq'),
+    timestamp TIMESTAMP NOT NULL,
+    log_type TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    username TEXT NOT NULL,
+    action TEXT NOT NULL,
+    http_status INTEGER NOT NULL,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+ALTER SEQUENCE logs_repo.app_logs_id_seq OWNED BY logs_repo.app_logs.id;
+""" + APP_LOGS_DEFAULT_SQL
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+def _add_months(value: datetime, months: int) -> datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def _partition_name(month: datetime) -> str:
+    return f"app_logs_p{month:%Y%m}"
+
+def _create_log_partitions(cur, first: datetime, last: datetime) -> tuple:
+    """
+    Crea las particiones mensuales de `first` a `last` (inclusive) que falten.
+    Devuelve (creadas, filas movidas desde la partición por defecto).
+    """
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'logs_repo.app_logs'::regclass
+    """)
+    existing = {row[0] for row in cur.fetchall()}
+    has_default = 'app_logs_default' in existing
+    created = moved = 0
+    month = _month_start(first)
+    while month <= last:
+        name = _partition_name(month)
+        if name not in existing:
+            moved += _create_log_partition(cur, name, month, _add_months(month, 1), has_default)
+            created += 1
+        month = _add_months(month, 1)
+    return created, moved
+
+def _create_log_partition(cur, name: str, start: datetime, end: datetime, has_default: bool) -> int:
+    pending = False
+    if has_default:
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM logs_repo.app_logs_default WHERE timestamp >= %s AND timestamp < %s)",
+            (start, end)
+        )
+        pending = cur.fetchone()[0]
+    if not pending:
+        cur.execute(
+            f"CREATE TABLE logs_repo.{name} PARTITION OF logs_repo.app_logs FOR VALUES FROM (%s) TO (%s)",
+            (start, end)
+        )
+        return 0
+    # Con filas de ese mes en la partición por defecto no se puede crear la
+    # partición directamente: se llena aparte y se adjunta ya sin conflicto
+    cur.execute(f"CREATE TABLE logs_repo.{name} (LIKE logs_repo.app_logs)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM logs_repo.app_logs_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+        )
+        INSERT INTO logs_repo.{name} SELECT * FROM moved
+    """, (start, end))
+    moved = cur.rowcount
+    cur.execute(
+        f"ALTER TABLE logs_repo.app_logs ATTACH PARTITION logs_repo.{name} FOR VALUES FROM (%s) TO (%s)",
+        (start, end)
+    )
+    return moved
+
+def init_app_logs(cur):
+    """
+    Crea logs_repo.app_logs particionada por rango de `timestamp`. Si existe la
+    tabla sin particionar de versiones anteriores, copia sus filas a la nueva
+    (mismos ids) y la elimina, todo en la transacción del llamador.
+    """
+    cur.execute(_LOG_PARTITIONS_LOCK_SQL)
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('logs_repo.app_logs')")
+    row = cur.fetchone()
+    now = datetime.now()
+    if row is not None and row[0] == 'p':
+        _create_log_partitions(cur, now, _add_months(now, LOG_PARTITIONS_AHEAD))
+        return
+    if row is None:
+        cur.execute(APP_LOGS_SQL)
+        _create_log_partitions(cur, now, _add_months(now, LOG_PARTITIONS_AHEAD))
+        return
+
+    cur.execute("""
+        LOCK TABLE logs_repo.app_logs IN ACCESS EXCLUSIVE MODE;
+        ALTER TABLE logs_repo.app_logs RENAME TO app_logs_legacy;
+        ALTER INDEX IF EXISTS logs_repo.app_logs_pkey RENAME TO app_logs_legacy_pkey;
+        ALTER TABLE logs_repo.app_logs_legacy ALTER COLUMN id DROP DEFAULT;
+        ALTER SEQUENCE IF EXISTS logs_repo.app_logs_id_seq OWNED BY NONE;
+        ALTER SEQUENCE IF EXISTS logs_repo.app_logs_id_seq AS BIGINT;
+    """)
+    cur.execute(APP_LOGS_SQL)
+    cur.execute("SELECT min(timestamp) FROM logs_repo.app_logs_legacy")
+    oldest = cur.fetchone()[0] or now
+    _create_log_partitions(cur, min(oldest, now), _add_months(max(oldest, now), LOG_PARTITIONS_AHEAD))
+    cur.execute("""
+        INSERT INTO logs_repo.app_logs (id, timestamp, log_type, ip_address, username, action, http_status)
+        SELECT id, timestamp, log_type, ip_address, username, action, http_status
+        FROM logs_repo.app_logs_legacy;
+        DROP TABLE logs_repo.app_logs_legacy;
+        SELECT setval('logs_repo.app_logs_id_seq', GREATEST(COALESCE(MAX(id), 0), 1))
+        FROM logs_repo.app_logs;
+    """)
+
+def maintain_log_partitions() -> dict:
+    """
+    Crea las particiones de los próximos meses y retira las que quedan fuera de
+    LOG_RETENTION_MONTHS (DETACH + DROP, o solo DETACH con LOG_RETENTION_MODE=detach).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    removed = []
     try:
-        cur.execute("UPDATE bank.otp_codes SET used = TRUE WHERE id = %s", (otp_id,))
+        cur.execute(_LOG_PARTITIONS_LOCK_SQL)
+        now = datetime.now()
+        # Meses que no se crearon a tiempo quedaron en la partición por defecto
+        cur.execute("SELECT min(timestamp) FROM logs_repo.app_logs_default")
+        oldest = cur.fetchone()[0]
+        first = min(oldest, now) if oldest is not None else now
+        created, moved = _create_log_partitions(cur, first, _add_months(now, LOG_PARTITIONS_AHEAD))
+        if moved:
+            print(f"Se movieron {moved} logs de auditoría de la partición por defecto: "
+                  f"el job de particiones no corrió a tiempo")
+        if LOG_RETENTION_MONTHS > 0:
+            cutoff = _partition_name(_add_months(_month_start(now), -LOG_RETENTION_MONTHS))
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'logs_repo.app_logs'::regclass
+                ORDER BY c.relname
+            """)
+            # Los nombres app_logs_pYYYYMM ordenan igual que sus meses
+            for (name,) in cur.fetchall():
+                if name.startswith('app_logs_p') and name < cutoff:
+                    cur.execute(f"ALTER TABLE logs_repo.app_logs DETACH PARTITION logs_repo.{name}")
+                    if LOG_RETENTION_MODE != 'detach':
+                        cur.execute(f"DROP TABLE logs_repo.{name}")
+                    removed.append(name)
         conn.commit()
-    except Exception as e:
+    except Exception:
         conn.rollback()
+        raise
+    finally:
         cur.close()
-        conn.close()
-        return False
-
-    cur.close()
-    conn.close()
-    return True
+        release_connection(conn)
+    return {"created": created, "removed": len(removed), "moved_from_default": moved}
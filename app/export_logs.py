@@ -0,0 +1,109 @@
+# app/export_logs.py
+# Exportación de logs_repo.app_logs por rango de fechas en NDJSON o CSV.
+#
+# Lee con un cursor con nombre (del lado del servidor) en bloques de tamaño
+# fijo y genera la salida por partes, opcionalmente comprimida con gzip al
+# vuelo: la memoria usada no depende del tamaño del rango. Lo usan el
+# endpoint GET /logs/export y la línea de comandos:
+#
+#   python -m app.export_logs --start 2025-01-01 --end 2025-02-01 --format csv --gzip -o enero.csv.gz
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import datetime
+from psycopg2 import extensions
+from .db import new_connection, env_int
+
+EXPORT_CHUNK_SIZE = env_int('EXPORT_CHUNK_SIZE', 5000)
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+EXPORT_COLUMNS = ("id", "timestamp", "log_type", "ip_address", "username", "action", "http_status")
+EXPORT_LOGS_SQL = """
+    SELECT id, timestamp, log_type, ip_address, username, action, http_status
+    FROM logs_repo.app_logs
+    WHERE timestamp >= %s AND timestamp < %s
+    ORDER BY timestamp, id
+"""
+
+def iter_log_chunks(start: datetime, end: datetime, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Bloques de filas con start <= timestamp < end, en orden de (timestamp, id)."""
+    # Conexión dedicada: una exportación larga no debe ocupar una del pool
+    # (ni cargar al primario, si hay réplica)
+    conn = new_connection(readonly=True)
+    try:
+        conn.set_session(isolation_level=extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        cur = conn.cursor(name='app_logs_export')
+        cur.itersize = chunk_size
+        cur.execute(EXPORT_LOGS_SQL, (start, end))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+    finally:
+        conn.close()
+
+def _ndjson(chunks):
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, (row[0], row[1].isoformat(), *row[2:]))), ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+def _csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows((row[0], row[1].isoformat(), *row[2:]) for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def _gzip(parts):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_logs(start: datetime, end: datetime, fmt: str = "ndjson", compress: bool = False,
+                chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Genera la exportación en partes de bytes."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato no soportado: {fmt}")
+    chunks = iter_log_chunks(start, end, chunk_size)
+    parts = _ndjson(chunks) if fmt == "ndjson" else _csv(chunks)
+    return _gzip(parts) if compress else parts
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta logs_repo.app_logs por rango de fechas.")
+    parser.add_argument('--start', required=True, type=datetime.fromisoformat, help='Inicio (ISO 8601, inclusivo)')
+    parser.add_argument('--end', required=True, type=datetime.fromisoformat, help='Fin (ISO 8601, exclusivo)')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+    parser.add_argument('--gzip', action='store_true', help='Comprime la salida con gzip')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Filas por lectura')
+    parser.add_argument('-o', '--output', help='Archivo de salida (por defecto, stdout)')
+    args = parser.parse_args()
+    if args.start >= args.end:
+        parser.error("--start debe ser anterior a --end")
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for part in export_logs(args.start, args.end, args.format, args.gzip, args.chunk_size):
+            out.write(part)
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == "__main__":
+    main()
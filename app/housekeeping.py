@@ -0,0 +1,61 @@
+# app/housekeeping.py
+# Tareas periódicas de mantenimiento ejecutadas en un hilo de fondo por proceso.
+import os
+import threading
+import time
+
+_jobs = {}   # nombre -> dict(interval, fn, next_run, runs, errors, last_result, last_duration)
+_lock = threading.Lock()
+_thread = None
+_thread_pid = None
+
+def register_job(name: str, interval: float, fn):
+    """Registra (o reemplaza) una tarea que se ejecuta cada `interval` segundos."""
+    with _lock:
+        _jobs[name] = {
+            "interval": interval,
+            "fn": fn,
+            "next_run": time.monotonic() + interval,
+            "runs": 0,
+            "errors": 0,
+            "last_result": None,
+            "last_duration": None,
+        }
+
+def start_housekeeping():
+    """Arranca el hilo de mantenimiento del proceso actual (idempotente)."""
+    global _thread, _thread_pid
+    pid = os.getpid()
+    with _lock:
+        if _thread is not None and _thread_pid == pid and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_run, name="housekeeping", daemon=True)
+        _thread_pid = pid
+        _thread.start()
+
+def _run():
+    while True:
+        now = time.monotonic()
+        with _lock:
+            due = [(name, job) for name, job in _jobs.items() if job["next_run"] <= now]
+            wait = min((job["next_run"] for job in _jobs.values()), default=now + 1.0) - now
+        for name, job in due:
+            start = time.monotonic()
+            try:
+                result = job["fn"]()
+                job["last_result"] = result
+            except Exception as e:
+                job["errors"] += 1
+                print(f"Error en la tarea de mantenimiento {name}: {e}")
+            job["runs"] += 1
+            job["last_duration"] = round(time.monotonic() - start, 6)
+            job["next_run"] = time.monotonic() + job["interval"]
+        if not due:
+            time.sleep(max(0.05, min(wait, 1.0)))
+
+def housekeeping_stats() -> dict:
+    with _lock:
+        return {
+            name: {k: job[k] for k in ("interval", "runs", "errors", "last_result", "last_duration")}
+            for name, job in _jobs.items()
+        }
@@ -0,0 +1,260 @@
+# app/idempotency.py
+# Cabecera Idempotency-Key para los POST de /bank.
+#
+# La primera ejecución guarda la respuesta en bank.idempotency_keys dentro de
+# la misma transacción que mueve el dinero; los reintentos la reciben desde
+# una LRU en memoria (o desde la tabla) sin volver a ejecutar el handler.
+# Los duplicados concurrentes esperan al primero: en el mismo proceso con un
+# Event y entre workers con un advisory lock de Postgres.
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request
+from psycopg2.extras import Json
+from werkzeug.exceptions import HTTPException
+from .db import get_connection, release_connection, env_int, env_float
+from .balance_cache import invalidate_balances
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_CACHE_SIZE = env_int('IDEMPOTENCY_CACHE_SIZE', 10000)
+IDEMPOTENCY_TTL = env_float('IDEMPOTENCY_TTL', 86400.0)
+IDEMPOTENCY_WAIT_TIMEOUT = env_float('IDEMPOTENCY_WAIT_TIMEOUT', 30.0)
+IDEMPOTENCY_PURGE_BATCH_SIZE = env_int('IDEMPOTENCY_PURGE_BATCH_SIZE', 1000)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Documentación de la cabecera para Swagger (params de bank_ns.doc)
+IDEMPOTENCY_PARAMS = {
+    IDEMPOTENCY_HEADER: {
+        'in': 'header',
+        'type': 'string',
+        'description': 'Clave única por operación; los reintentos con la misma clave devuelven la respuesta original'
+    }
+}
+
+
+class ResponseCache:
+    """LRU acotada (user_id, clave) -> (hash del request, status, cuerpo, guardada_en)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key: tuple) -> tuple | None:
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            if time.time() - entry[3] > self.ttl:
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry
+
+    def put(self, cache_key: tuple, request_hash: str, status: int, body, stored_at: float):
+        with self._lock:
+            self._entries[cache_key] = (request_hash, status, body, stored_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class IdempotencyMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.replayed_memory = 0
+        self.replayed_db = 0
+        self.waits = 0
+        self.conflicts = 0
+
+    def inc(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+_responses = ResponseCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL)
+_metrics = IdempotencyMetrics()
+_in_flight = {}  # (user_id, clave) -> Event que se activa al terminar el primero
+_in_flight_lock = threading.Lock()
+
+def _request_hash() -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}\n".encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+def _lock_id(user_id: int, key: str) -> int:
+    digest = hashlib.sha256(f"idempotency:{user_id}:{key}".encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def _replay(entry: tuple, request_hash: str):
+    stored_hash, status, body, _ = entry
+    if stored_hash != request_hash:
+        _metrics.inc("conflicts")
+        return {"message": f"{IDEMPOTENCY_HEADER} ya usada con otra petición"}, 422
+    return body, status, {"Idempotent-Replayed": "true"}
+
+def _execute(f, args, kwargs, cache_key: tuple, request_hash: str):
+    """Ejecuta el handler con el lock de la clave tomado y guarda su respuesta."""
+    user_id, key = cache_key
+    lock_id = _lock_id(user_id, key)
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # Lock de sesión: sobrevive a los rollbacks que hacen los handlers al fallar
+        cur.execute("SELECT pg_advisory_lock(%s)", (lock_id,))
+        try:
+            cur.execute("""
+                SELECT request_hash, status_code, response,
+                       EXTRACT(EPOCH FROM created_at - NOW())::FLOAT8
+                FROM bank.idempotency_keys WHERE user_id = %s AND key = %s
+            """, (user_id, key))
+            row = cur.fetchone()
+            if row is not None:
+                conn.rollback()
+                entry = (row[0], row[1], row[2], time.time() + row[3])
+                _responses.put(cache_key, *entry)
+                _metrics.inc("replayed_db")
+                return _replay(entry, request_hash)
+
+            conn.defer_commit = True
+            try:
+                result = f(*args, **kwargs)
+                body, status = result[:2] if isinstance(result, tuple) else (result, 200)
+            except HTTPException as e:
+                if e.code >= 500:
+                    raise
+                # Las respuestas 4xx también se guardan (p. ej. fondos insuficientes)
+                result = None
+                body, status = getattr(e, 'data', None) or {"message": e.description}, e.code
+            finally:
+                conn.defer_commit = False
+            if status >= 500:
+                return result
+
+            # Lo que el handler no llegó a confirmar no se guarda junto a la respuesta
+            committed = conn.commit_deferred
+            if not committed:
+                conn.rollback()
+            cur.execute("""
+                INSERT INTO bank.idempotency_keys (user_id, key, request_hash, status_code, response)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (user_id, key) DO NOTHING
+            """, (user_id, key, request_hash, status, Json(body)))
+            try:
+                conn.commit()
+            except Exception:
+                # El handler ya pudo escribir en caché saldos que no llegaron a confirmarse
+                if committed:
+                    invalidate_balances(user_id)
+                raise
+            _responses.put(cache_key, request_hash, status, body, time.time())
+            _metrics.inc("executed")
+            return result if result is not None else (body, status)
+        finally:
+            _unlock(conn, cur, lock_id)
+    finally:
+        cur.close()
+        release_connection(conn)
+
+def _unlock(conn, cur, lock_id: int):
+    """
+    Suelta el advisory lock sin tapar la excepción del handler. Si la conexión
+    está rota se cierra: al terminar la sesión Postgres suelta el lock, y el
+    pool la descarta en vez de reutilizarla con el lock tomado.
+    """
+    if conn.closed:
+        return
+    try:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+        conn.rollback()
+    except Exception as e:
+        print(f"No se pudo soltar el lock de idempotencia {lock_id}; se descarta la conexión: {e}")
+        conn.close()
+
+def idempotent(f):
+    """
+    Decorador para los POST de /bank; va debajo de token_required (usa g.user).
+    Sin cabecera Idempotency-Key el handler se ejecuta como siempre.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return {"message": f"{IDEMPOTENCY_HEADER} inválida"}, 400
+        cache_key = (g.user['id'], key)
+        request_hash = _request_hash()
+
+        while True:
+            entry = _responses.get(cache_key)
+            if entry is not None:
+                _metrics.inc("replayed_memory")
+                return _replay(entry, request_hash)
+            with _in_flight_lock:
+                event = _in_flight.get(cache_key)
+                leader = event is None
+                if leader:
+                    event = _in_flight[cache_key] = threading.Event()
+            if leader:
+                break
+            # Otro request de este proceso la está ejecutando: se espera su resultado
+            _metrics.inc("waits")
+            event.wait(IDEMPOTENCY_WAIT_TIMEOUT)
+
+        try:
+            return _execute(f, args, kwargs, cache_key, request_hash)
+        finally:
+            with _in_flight_lock:
+                _in_flight.pop(cache_key, None)
+            event.set()
+    return decorated
+
+def purge_idempotency_keys() -> int:
+    """Borra en lotes las claves más antiguas que IDEMPOTENCY_TTL."""
+    total = 0
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute("""
+                DELETE FROM bank.idempotency_keys
+                WHERE (user_id, key) IN (
+                    SELECT user_id, key FROM bank.idempotency_keys
+                    WHERE created_at < NOW() - make_interval(secs => %s)
+                    LIMIT %s
+                )
+            """, (IDEMPOTENCY_TTL, IDEMPOTENCY_PURGE_BATCH_SIZE))
+            deleted = cur.rowcount
+            conn.commit()
+            total += deleted
+            if deleted < IDEMPOTENCY_PURGE_BATCH_SIZE:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+    return total
+
+def idempotency_stats() -> dict:
+    with _metrics._lock:
+        stats = {
+            "executed": _metrics.executed,
+            "replayed_memory": _metrics.replayed_memory,
+            "replayed_db": _metrics.replayed_db,
+            "waits": _metrics.waits,
+            "conflicts": _metrics.conflicts,
+        }
+    stats["cached"] = len(_responses)
+    return stats
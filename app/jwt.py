@@ -3,7 +3,10 @@ import base64
 import hmac
 import hashlib
 import json
-from datetime import datetime, timedelta
+import secrets
+import threading
+import time
+from collections import OrderedDict
 
 SECRET_KEY = os.environ.get('JWT_SECRET')
 
@@ -12,6 +15,11 @@ try:
 except ValueError:
     JWT_EXP_MINUTES = 30
 
+try:
+    JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', 10000))
+except ValueError:
+    JWT_CACHE_SIZE = 10000
+
 def base64url_encode(data: bytes) -> str:
     return base64.urlsafe_b64encode(data).decode().rstrip('=')
 
@@ -19,39 +27,104 @@ def base64url_decode(data: str) -> bytes:
     padding = '=' * (-len(data) % 4)
     return base64.urlsafe_b64decode(data + padding)
 
+# El header es siempre el mismo: se codifica una sola vez
+JWT_HEADER = {"alg": "HS256", "typ": "JWT"}
+JWT_HEADER_ENC = base64url_encode(json.dumps(JWT_HEADER).encode())
+
+_hmac_template = None
+
+def load_signing_key():
+    """HMAC inicializado con la clave (se crea en create_app o al primer uso)."""
+    global _hmac_template
+    if _hmac_template is None:
+        _hmac_template = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+    return _hmac_template
+
+def _sign(signing_input: str) -> str:
+    """Firma con una copia del HMAC ya inicializado con la clave."""
+    mac = load_signing_key().copy()
+    mac.update(signing_input.encode())
+    return base64url_encode(mac.digest())
+
+
+class VerifiedTokenCache:
+    """LRU acotado de tokens ya verificados, indexado por el segmento de firma."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # firma -> (token, payload, expira_en)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, signature: str, token: str, now: float) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None or entry[0] != token:
+                self.misses += 1
+                return None
+            if now > entry[2]:
+                del self._entries[signature]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(signature)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, signature: str, token: str, payload: dict, expires_at: float):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[signature] = (token, payload, expires_at)
+            self._entries.move_to_end(signature)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+_token_cache = VerifiedTokenCache(JWT_CACHE_SIZE)
+
+def token_cache_stats() -> dict:
+    return _token_cache.stats()
+
 def create_jwt(payload: dict) -> str:
     """Crea un JWT con expiración configurada por variable de entorno."""
-    header = {"alg": "HS256", "typ": "JWT"}
-    payload["exp"] = int((datetime.utcnow() + timedelta(minutes=JWT_EXP_MINUTES)).timestamp())
+    payload["exp"] = int(time.time() + JWT_EXP_MINUTES * 60)
+    # Identificador único para poder revocar el token en el logout
+    payload.setdefault("jti", secrets.token_hex(16))
 
-    header_enc = base64url_encode(json.dumps(header).encode())
     payload_enc = base64url_encode(json.dumps(payload).encode())
-
-    signature = hmac.new(
-        SECRET_KEY.encode(),
-        msg=f"{header_enc}.{payload_enc}".encode(),
-        digestmod=hashlib.sha256
-    ).digest()
-
-    signature_enc = base64url_encode(signature)
-    return f"{header_enc}.{payload_enc}.{signature_enc}"
+    signature_enc = _sign(f"{JWT_HEADER_ENC}.{payload_enc}")
+    return f"{JWT_HEADER_ENC}.{payload_enc}.{signature_enc}"
 
 def verify_jwt(token: str) -> dict | None:
     """Verifica un JWT y retorna el payload si es válido."""
     try:
         header_enc, payload_enc, signature_enc = token.split('.')
-        expected_sig = hmac.new(
-            SECRET_KEY.encode(),
-            msg=f"{header_enc}.{payload_enc}".encode(),
-            digestmod=hashlib.sha256
-        ).digest()
-        if not hmac.compare_digest(base64url_encode(expected_sig), signature_enc):
+        now = time.time()
+        cached = _token_cache.get(signature_enc, token, now)
+        if cached is not None:
+            return dict(cached)
+
+        if header_enc != JWT_HEADER_ENC:
+            header = json.loads(base64url_decode(header_enc))
+            if header.get("alg") != "HS256":
+                return None
+
+        expected_sig = _sign(f"{header_enc}.{payload_enc}")
+        if not hmac.compare_digest(expected_sig, signature_enc):
             return None
 
         payload = json.loads(base64url_decode(payload_enc))
-        if "exp" in payload and datetime.utcnow().timestamp() > payload["exp"]:
+        if "exp" in payload and now > payload["exp"]:
             return None
 
-        return payload
+        # La entrada nunca vive más allá del `exp` del token
+        expires_at = payload.get("exp", now + JWT_EXP_MINUTES * 60)
+        _token_cache.put(signature_enc, token, payload, expires_at)
+        return dict(payload)
     except Exception:
         return None
@@ -1,5 +1,27 @@
-from .db import get_connection
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from .db import get_pool, env_int, env_float
+from .metrics import AUDIT_LOG_SECONDS
 from datetime import datetime
+from psycopg2.extras import execute_values
+
+# Configuración del escritor de logs en segundo plano
+LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000)
+LOG_BATCH_SIZE = env_int('LOG_BATCH_SIZE', 200)
+LOG_FLUSH_INTERVAL = env_float('LOG_FLUSH_INTERVAL', 1.0)
+LOG_ENQUEUE_TIMEOUT = env_float('LOG_ENQUEUE_TIMEOUT', 0.05)
+LOG_SPILL_PATH = os.environ.get('LOG_SPILL_PATH', 'app_logs.spill.jsonl')
+
+INSERT_LOGS_SQL = """
+    INSERT INTO logs_repo.app_logs (
+        timestamp, log_type, ip_address, username, action, http_status
+    ) VALUES %s
+"""
 
 def sanitize(value: str, max_len: int = 255) -> str:
     if not isinstance(value, str):
@@ -7,28 +29,193 @@ def sanitize(value: str, max_len: int = 255) -> str:
     value = value.replace('\n', ' ').replace('\r', ' ').strip()
     return value[:max_len]
 
+
+class AuditLogWriter:
+    """
+    Escribe los registros de auditoría en lotes desde un hilo de fondo.
+    Si la cola está llena o Postgres no responde, los registros se vuelcan
+    a un archivo local y se reenvían en el siguiente lote exitoso. El archivo
+    es compartido por los workers: agregar y tomarlo para reenviar se hace
+    con un flock sobre `<archivo>.lock`.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float,
+                 enqueue_timeout: float, spill_path: str):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._written = 0
+        self._batches = 0
+        self._spilled = 0
+        self._replayed = 0
+        self._failures = 0
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+        with self._start_lock:
+            if self._pid == pid and self._thread is not None:
+                return
+            # Tras un fork el hilo del padre no existe en el hijo
+            if self._pid != pid:
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+            self._pid = pid
+            self._thread.start()
+
+    def submit(self, record: tuple):
+        """Encola un registro; con la cola llena espera un poco y luego lo vuelca a disco."""
+        self._ensure_started()
+        try:
+            self._queue.put(record, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._spill([record])
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect(self.flush_interval)
+            if batch:
+                self._flush(batch)
+        self._drain()
+
+    def _collect(self, wait: float) -> list:
+        """Junta registros hasta completar un lote o agotar el intervalo."""
+        batch = []
+        deadline = time.monotonic() + wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._flush(batch)
+
+    def _insert(self, rows: list):
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            cur = conn.cursor()
+            execute_values(cur, INSERT_LOGS_SQL, rows, page_size=self.batch_size)
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+    def _flush(self, batch: list):
+        try:
+            self._insert(batch)
+        except Exception as e:
+            print(f"No se pudo guardar el lote de logs ({len(batch)} registros): {e}")
+            self._failures += 1
+            self._spill(batch)
+            return
+        self._written += len(batch)
+        self._batches += 1
+        self._replay_spill()
+
+    def _spill_locked(self):
+        """flock exclusivo entre procesos (y entre hilos: cada llamada abre su propio descriptor)."""
+        lock = open(f"{self.spill_path}.lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _spill(self, records: list):
+        with self._spill_locked():
+            with open(self.spill_path, 'a', encoding='utf-8') as fh:
+                for record in records:
+                    fh.write(json.dumps(record) + '\n')
+        self._spilled += len(records)
+
+    def _replay_spill(self):
+        """Reenvía a Postgres lo que quedó en el archivo de respaldo."""
+        if not os.path.exists(self.spill_path):
+            return
+        replay_path = f"{self.spill_path}.{os.getpid()}.replay"
+        # Bajo el lock nadie tiene el archivo abierto: lo que se agregue
+        # después va a un archivo nuevo, no al que se está reenviando
+        with self._spill_locked():
+            try:
+                os.replace(self.spill_path, replay_path)
+            except FileNotFoundError:
+                return
+        with open(replay_path, encoding='utf-8') as fh:
+            rows = [tuple(json.loads(line)) for line in fh if line.strip()]
+        done = 0
+        try:
+            while done < len(rows):
+                chunk = rows[done:done + self.batch_size]
+                self._insert(chunk)
+                done += len(chunk)
+                self._replayed += len(chunk)
+        except Exception as e:
+            print(f"No se pudo reenviar el respaldo de logs: {e}")
+            self._spill(rows[done:])
+        finally:
+            os.remove(replay_path)
+
+    def close(self, timeout: float = 5.0):
+        """Vacía la cola antes de terminar el proceso."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "queue_max": self._queue.maxsize,
+            "written": self._written,
+            "batches": self._batches,
+            "spilled": self._spilled,
+            "replayed": self._replayed,
+            "failures": self._failures,
+        }
+
+
+_writer = AuditLogWriter(LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_ENQUEUE_TIMEOUT, LOG_SPILL_PATH)
+atexit.register(_writer.close)
+
+def start_log_writer():
+    """Arranca el hilo escritor del proceso (warm-up del worker)."""
+    _writer._ensure_started()
+
+def log_writer_stats() -> dict:
+    return _writer.stats()
+
 def write_log(log_type: str, ip_address: str, username: str, action: str, http_status: int):
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-
-        cur.execute("""
-            INSERT INTO logs_repo.app_logs (
-                timestamp, log_type, ip_address, username, action, http_status
-            ) VALUES (%s, %s, %s, %s, %s, %s)
-        """, (
-            sanitize(timestamp),
-            sanitize(log_type.upper(), 10),
-            sanitize(ip_address, 50),
-            sanitize(username, 50),
-            sanitize(action, 255),
-            int(http_status)
-        ))
-        conn.commit()
-    except Exception as e:
-        print(f"No se pudo guardar el log: {e}")
-        conn.rollback()
-    finally:
-        cur.close()
-        conn.close()
+    start = time.perf_counter()
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    _writer.submit((
+        sanitize(timestamp),
+        sanitize(log_type.upper(), 10),
+        sanitize(ip_address, 50),
+        sanitize(username, 50),
+        sanitize(action, 255),
+        int(http_status)
+    ))
+    AUDIT_LOG_SECONDS.observe(time.perf_counter() - start)
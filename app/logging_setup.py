@@ -0,0 +1,212 @@
+# app/logging_setup.py
+# Logging de la aplicación (módulo `logging`, archivo app.log) fuera del hilo del request.
+#
+# Los handlers solo encolan el registro (sin esperar: con la cola llena se
+# descarta y se cuenta) y un hilo por proceso lo escribe en un archivo con
+# rotación por tamaño. Los DEBUG se pueden muestrear por ruta; la decisión es
+# por request, así que se conservan o descartan todos los de un mismo request.
+import atexit
+import fcntl
+import logging
+import os
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import g, has_request_context, request
+from .db import env_int, env_float
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
+LOG_FILE_MAX_BYTES = env_int('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024)  # 0 = sin rotación
+LOG_FILE_BACKUPS = env_int('LOG_FILE_BACKUPS', 5)
+LOG_APP_QUEUE_SIZE = env_int('LOG_APP_QUEUE_SIZE', 10000)
+LOG_APP_STOP_TIMEOUT = env_float('LOG_APP_STOP_TIMEOUT', 5.0)
+# Fracción de requests cuyos DEBUG se escriben; LOG_DEBUG_SAMPLE_ROUTES la
+# ajusta por ruta, p. ej. "/bank/deposit=0.01,/auth/login=0"
+LOG_DEBUG_SAMPLE_RATE = env_float('LOG_DEBUG_SAMPLE_RATE', 1.0)
+LOG_DEBUG_SAMPLE_ROUTES = os.environ.get('LOG_DEBUG_SAMPLE_ROUTES', '')
+LOG_FORMAT = "{asctime} - {levelname} - {message}"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def parse_sample_routes(spec: str) -> dict:
+    routes = {}
+    for item in spec.split(','):
+        route, sep, rate = item.strip().rpartition('=')
+        if sep and route:
+            routes[route] = float(rate)
+    return routes
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler para varios workers que escriben el mismo archivo: si
+    otro proceso ya lo rotó, se reabre el nuevo en lugar de rotar otra vez.
+    """
+
+    def shouldRollover(self, record) -> bool:
+        if self.stream is not None and self._rotated_elsewhere():
+            self.stream.close()
+            self.stream = self._open()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        # Un solo proceso rota a la vez; los demás ven el archivo nuevo y lo reabren
+        with open(f"{self.baseFilename}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.stream is not None and self._rotated_elsewhere():
+                self.stream.close()
+                self.stream = self._open()
+                return
+            super().doRollover()
+
+    def _rotated_elsewhere(self) -> bool:
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.stream.fileno())
+        return (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+
+
+class DebugSampler(logging.Filter):
+    """Deja pasar los DEBUG de una fracción de los requests, según su ruta."""
+
+    def __init__(self, default_rate: float, route_rates: dict):
+        super().__init__()
+        self.default_rate = default_rate
+        self.route_rates = route_rates
+        self.sampled_out = 0
+
+    def filter(self, record) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        if has_request_context():
+            keep = g.get('_log_debug_sampled')
+            if keep is None:
+                route = request.url_rule.rule if request.url_rule is not None else request.path
+                keep = g._log_debug_sampled = random.random() < self.route_rates.get(route, self.default_rate)
+        else:
+            keep = random.random() < self.default_rate
+        if not keep:
+            self.sampled_out += 1
+        return keep
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Con la cola llena espera a que el hilo libere lugar (put_nowait fallaría)
+        self.queue.put(self._sentinel, timeout=LOG_APP_STOP_TIMEOUT)
+
+
+class BackgroundLogHandler(QueueHandler):
+    """
+    Encola sin bloquear y escribe con un QueueListener en un hilo del proceso
+    (se vuelve a crear tras un fork, como el escritor de logs de auditoría).
+    """
+
+    def __init__(self, target: logging.Handler, queue_size: int):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.target = target
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            # Tras un fork el hilo del padre no existe en el hijo
+            if self._pid is not None:
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._listener = _Listener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = pid
+
+    def prepare(self, record):
+        # Solo se resuelve lo que no puede esperar (args mutables, traceback);
+        # el formato lo aplica el hilo escritor. El logger raíz es el último
+        # destino del registro, así que no hace falta copiarlo.
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+            dropped = False
+        except queue.Full:
+            dropped = True
+        with self._stats_lock:
+            if dropped:
+                self.dropped += 1
+            else:
+                self.enqueued += 1
+
+    def stop(self):
+        """Escribe lo pendiente y detiene el hilo (solo en el proceso que lo arrancó)."""
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+        self.target.close()
+
+
+_handler = None
+_sampler = None
+
+def configure_logging(filename: str, level: str = LOG_LEVEL):
+    """Reemplaza los handlers del logger raíz por la cola hacia `filename`."""
+    global _handler, _sampler
+    target = SharedRotatingFileHandler(
+        filename, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+    )
+    target.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT, style="{"))
+    sampler = DebugSampler(LOG_DEBUG_SAMPLE_RATE, parse_sample_routes(LOG_DEBUG_SAMPLE_ROUTES))
+    handler = BackgroundLogHandler(target, LOG_APP_QUEUE_SIZE)
+    handler.addFilter(sampler)
+
+    root = logging.getLogger()
+    for previous in root.handlers[:]:
+        root.removeHandler(previous)
+        if previous is _handler:
+            previous.stop()
+        else:
+            previous.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+    _handler, _sampler = handler, sampler
+
+def start_app_log_listener():
+    """Arranca el hilo escritor del proceso (warm-up del worker)."""
+    if _handler is not None:
+        _handler.start()
+
+def _shutdown():
+    if _handler is not None:
+        _handler.stop()
+
+atexit.register(_shutdown)
+
+def app_log_stats() -> dict:
+    if _handler is None:
+        return {}
+    with _handler._stats_lock:
+        return {
+            "level": logging.getLevelName(logging.getLogger().level),
+            "queued": _handler.queue.qsize(),
+            "queue_max": _handler.queue.maxsize,
+            "enqueued": _handler.enqueued,
+            "dropped": _handler.dropped,
+            "debug_sampled_out": _sampler.sampled_out,
+        }
@@ -1,29 +1,44 @@
-from http.client import HTTPException
-import secrets
-from app.logger import write_log
-from flask import Flask, request, g
+import base64
+import os
+import threading
+import time
+from app.logger import write_log, start_log_writer, log_writer_stats
+from app.logging_setup import configure_logging, start_app_log_listener, app_log_stats, LOG_LEVEL
+from flask import Flask, Response, request, g
 from flask_restx import Api, Resource, fields # type: ignore
 from functools import wraps
-from .db import get_connection, init_db, save_otp, validate_otp
-from .utils import encrypt_data, is_luhn_valid, generate_otp, otp_expiration
+from psycopg2.extras import execute_values
+from .db import (
+    get_connection, release_connection, get_pool, init_db_app, save_otp, validate_otp,
+    pool_stats, read_pool_stats, replica_stats, replica_configured, check_replica_lag, REPLICA_LAG_CHECK_INTERVAL,
+    otp_stats, purge_otp_codes, maintain_log_partitions, roll_up_ledger, env_int, env_float
+)
+from .migrations import migrate, migration_stats
+from .metrics import init_metrics_app, render as render_metrics, write_snapshot, METRICS_DIR
+from .housekeeping import register_job, start_housekeeping, housekeeping_stats
+from .utils import load_cipher, encrypt_data, is_luhn_valid, generate_otp, otp_expiration
 import logging
 from datetime import datetime
-from .jwt import create_jwt, verify_jwt
+from decimal import Decimal
+from .jwt import load_signing_key, create_jwt, verify_jwt, token_cache_stats, JWT_EXP_MINUTES
+from .revocation import init_revocation, is_revoked, revoke, token_id, revocation_stats, purge_revoked
+from .export_logs import export_logs, EXPORT_FORMATS
+from .ratelimit import init_ratelimit_app, limit_user, limit_login, ratelimit_stats
+from .idempotency import idempotent, purge_idempotency_keys, idempotency_stats, IDEMPOTENCY_PARAMS
+from .balance_cache import (
+    init_balance_cache, cached_balances, balance_version, update_balances, invalidate_balances, balance_cache_stats
+)
 
 
 # Define a simple in-memory token store
 tokens = {}
 
-#log = logging.getLogger(__name__)
-logging.basicConfig(
-     filename="app.log",
-     level=logging.DEBUG,
-     encoding="utf-8",
-     filemode="a",
-     format="{asctime} - {levelname} - {message}",
-     style="{",
-     datefmt="%Y-%m-%d %H:%M",
-)
+LOGIN_USER_SQL = "SELECT id, username, password, role, full_name, email FROM bank.users WHERE username = %s"
+
+# Máximo de transferencias aceptadas en /bank/batch-transfers
+BATCH_TRANSFER_MAX = env_int('BATCH_TRANSFER_MAX', 1000)
+# Roles que pueden exportar los logs de auditoría
+EXPORT_ROLES = {role.strip() for role in os.environ.get('EXPORT_ROLES', 'cajero').split(',') if role.strip()}
 
 # Configure Swagger security scheme for Bearer tokens
 authorizations = {
@@ -35,9 +50,8 @@ authorizations = {
     }
 }
 
-app = Flask(__name__)
+# La app se construye en create_app(); los recursos se registran en `api`
 api = Api(
-    app,
     version='1.0',
     title='Core Bancario API',
     description='API para operaciones bancarias, incluyendo autenticación y operaciones de cuenta.',
@@ -49,6 +63,7 @@ api = Api(
 # Create namespaces for authentication and bank operations
 auth_ns = api.namespace('auth', description='Operaciones de autenticación')
 bank_ns = api.namespace('bank', description='Operaciones bancarias')
+logs_ns = api.namespace('logs', description='Exportación de logs de auditoría')
 
 # Define the expected payload models for Swagger
 login_model = auth_ns.model('Login', {
@@ -70,6 +85,11 @@ transfer_model = bank_ns.model('Transfer', {
     'amount': fields.Float(required=True, description='Monto a transferir', example=100)
 })
 
+batch_transfer_model = bank_ns.model('BatchTransfer', {
+    'transfers': fields.List(fields.Nested(transfer_model), required=True, description='Transferencias a realizar'),
+    'mode': fields.String(description="'atomic' (todo o nada) o 'best_effort'", enum=['atomic', 'best_effort'], default='atomic', example='atomic')
+})
+
 # Se modifica este modelo para actualizar la documetanción en el Swagger
 credit_payment_model = bank_ns.model('CreditPayment', {
     'amount': fields.Float(required=True, description='Monto de la compra', example=100),
@@ -107,6 +127,8 @@ def token_required(f):
         payload = verify_jwt(token)
         if not payload:
             api.abort(401, "Invalid or expired token")
+        if is_revoked(token_id(token, payload)):
+            api.abort(401, "Token has been revoked")
         
         # Guardar datos del usuario en `g.user` para uso en endpoints
         g.user = {
@@ -115,6 +137,9 @@ def token_required(f):
             "role": payload["role"],
             "email": payload.get("email", "")
         }
+        limited = limit_user(g.user["id"])
+        if limited:
+            return limited
         return f(*args, **kwargs)
     return decorated
 
@@ -130,13 +155,17 @@ class Login(Resource):
         data = api.payload
         username = data.get("username")
         password = data.get("password")
+        limited = limit_login(ip)
+        if limited:
+            write_log("WARNING", ip, username or "unknown", "Login bloqueado por exceso de intentos", 429)
+            return limited
 
-        conn = get_connection()
+        conn = get_connection(readonly=True)
         cur = conn.cursor()
-        cur.execute("SELECT id, username, password, role, full_name, email FROM bank.users WHERE username = %s", (username,))
+        cur.execute(LOGIN_USER_SQL, (username,))
         user = cur.fetchone()
         cur.close()
-        conn.close()
+        release_connection(conn)
         if user and user[2] == password:
             payload = {
                 "user_id": user[0],
@@ -161,19 +190,11 @@ class Logout(Resource):
         if not auth_header.startswith("Bearer "):
             api.abort(401, "Authorization header missing or invalid")
         token = auth_header.split(" ")[1]
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM bank.tokens WHERE token = %s", (token,))
-        if cur.rowcount == 0:
-            conn.commit()
-            cur.close()
-            conn.close()
-            api.abort(401, "Invalid token")
-        conn.commit()
-        cur.close()
-        conn.close()
         payload = verify_jwt(token)
-        username = payload["username"] if payload else "unknown"
+        if not payload or is_revoked(token_id(token, payload)):
+            api.abort(401, "Invalid token")
+        revoke(token_id(token, payload), payload.get("exp", time.time() + JWT_EXP_MINUTES * 60))
+        username = payload["username"]
         write_log("INFO", ip, username, "Logout exitoso", 200)
         return {"message": "Logout successful"}, 200
 
@@ -228,14 +249,16 @@ class ValidateOTP(Resource):
 
 @bank_ns.route('/deposit')
 class Deposit(Resource):
-    logging.debug("Entering....")
     @bank_ns.expect(deposit_model, validate=True)
-    @bank_ns.doc('deposit')
+    @bank_ns.doc('deposit', params=IDEMPOTENCY_PARAMS)
     @token_required
+    @idempotent
     def post(self):
         """
         Realiza un depósito en la cuenta especificada.
         Se requiere el número de cuenta y el monto a depositar.
+        En cuentas calientes `new_balance` es null: el depósito queda pendiente
+        y el saldo se consulta con GET /bank/balance.
         """
         data = api.payload
         account_number = data.get("account_number")
@@ -244,23 +267,29 @@ class Deposit(Resource):
         if amount <= 0:
             api.abort(400, "Amount must be greater than zero")
         
+        version = balance_version(g.user['id'])
         conn = get_connection()
         cur = conn.cursor()
         # Update the specified account using its account number (primary key)
         cur.execute(
-            "UPDATE bank.accounts SET balance = balance + %s WHERE id = %s RETURNING balance",
-            (amount, account_number)
+            "SELECT status, user_id, account_balance FROM bank.deposit(%s, %s)",
+            (account_number, amount)
         )
-        result = cur.fetchone()
-        if not result:
+        status, account_user_id, balance = cur.fetchone()
+        if status != "ok":
             conn.rollback()
             cur.close()
-            conn.close()
+            release_connection(conn)
             api.abort(404, "Account not found")
-        new_balance = float(result[0])
+        # Las cuentas calientes no calculan el saldo al depositar (ver bank.deposit)
+        new_balance = float(balance) if balance is not None else None
         conn.commit()
         cur.close()
-        conn.close()
+        release_connection(conn)
+        if account_user_id == g.user['id'] and new_balance is not None:
+            update_balances(account_user_id, version, account_balance=new_balance)
+        else:
+            invalidate_balances(account_user_id)
         ip = request.remote_addr or "unknown"
         write_log("INFO", ip, g.user["username"], f"Depósito de ${amount} en cuenta {account_number}", 200)
         return {"message": "Deposit successful", "new_balance": new_balance}, 200
@@ -268,8 +297,9 @@ class Deposit(Resource):
 @bank_ns.route('/withdraw')
 class Withdraw(Resource):
     @bank_ns.expect(withdraw_model, validate=True)
-    @bank_ns.doc('withdraw')
+    @bank_ns.doc('withdraw', params=IDEMPOTENCY_PARAMS)
     @token_required
+    @idempotent
     def post(self):
         ip = request.remote_addr or "unknown"
         """Realiza un retiro de la cuenta del usuario autenticado."""
@@ -278,33 +308,33 @@ class Withdraw(Resource):
         if amount <= 0:
             api.abort(400, "Amount must be greater than zero")
         user_id = g.user['id']
+        version = balance_version(user_id)
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.close()
-            conn.close()
-            api.abort(404, "Account not found")
-        current_balance = float(row[0])
-        if current_balance < amount:
+        cur.execute("SELECT status, account_balance FROM bank.withdraw(%s, %s)", (user_id, amount))
+        status, balance = cur.fetchone()
+        if status != "ok":
+            conn.rollback()
             cur.close()
-            conn.close()
+            release_connection(conn)
+            if status == "account_not_found":
+                api.abort(404, "Account not found")
             write_log("WARNING", ip, g.user["username"], f"Retiro fallido por fondos insuficientes: ${amount}", 400)
             api.abort(400, "Insufficient funds")
-        cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s RETURNING balance", (amount, user_id))
-        new_balance = float(cur.fetchone()[0])
+        new_balance = float(balance)
         conn.commit()
         cur.close()
-        conn.close()
+        release_connection(conn)
+        update_balances(user_id, version, account_balance=new_balance)
         write_log("INFO", ip, g.user["username"], f"Retiro de ${amount}", 200)
         return {"message": "Withdrawal successful", "new_balance": new_balance}, 200
 
 @bank_ns.route('/transfer')
 class Transfer(Resource):
     @bank_ns.expect(transfer_model, validate=True)
-    @bank_ns.doc('transfer')
+    @bank_ns.doc('transfer', params=IDEMPOTENCY_PARAMS)
     @token_required
+    @idempotent
     def post(self):
         ip = request.remote_addr or "unknown"
         """Transfiere fondos desde la cuenta del usuario autenticado a otra cuenta."""
@@ -315,51 +345,182 @@ class Transfer(Resource):
             api.abort(400, "Invalid data")
         if target_username == g.user['username']:
             api.abort(400, "Cannot transfer to the same account")
+        version = balance_version(g.user['id'])
         conn = get_connection()
         cur = conn.cursor()
-        # Check sender's balance
-        cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (g.user['id'],))
-        row = cur.fetchone()
-        if not row:
+        try:
+            cur.execute(
+                "SELECT status, account_balance FROM bank.transfer(%s, %s, %s)",
+                (g.user['id'], target_username, amount)
+            )
+            status, balance = cur.fetchone()
+            if status == "ok":
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception as e:
+            conn.rollback()
             cur.close()
-            conn.close()
+            release_connection(conn)
+            write_log("ERROR", ip, g.user["username"], f"Error durante transferencia: {str(e)}", 500)
+            api.abort(500, f"Error during transfer: {str(e)}")
+        cur.close()
+        release_connection(conn)
+        if status == "sender_not_found":
             api.abort(404, "Sender account not found")
-        sender_balance = float(row[0])
-        if sender_balance < amount:
-            cur.close()
-            conn.close()
+        if status == "insufficient_funds":
             api.abort(400, "Insufficient funds")
-        # Find target user
-        cur.execute("SELECT id FROM bank.users WHERE username = %s", (target_username,))
-        target_user = cur.fetchone()
-        if not target_user:
-            cur.close()
-            conn.close()
+        if status == "target_not_found":
             write_log("WARNING", ip, g.user["username"], f"Transferencia fallida: destinatario {target_username} no encontrado", 404)
             api.abort(404, "Target user not found")
-        target_user_id = target_user[0]
+        new_balance = float(balance)
+        update_balances(g.user['id'], version, account_balance=new_balance)
+        write_log("INFO", ip, g.user["username"], f"Transferencia de ${amount} a {target_username}", 200)
+        return {"message": "Transfer successful", "new_balance": new_balance}, 200
+
+@bank_ns.route('/batch-transfers')
+class BatchTransfers(Resource):
+    @bank_ns.expect(batch_transfer_model, validate=True)
+    @bank_ns.doc('batch_transfers', params=IDEMPOTENCY_PARAMS)
+    @token_required
+    @idempotent
+    def post(self):
+        ip = request.remote_addr or "unknown"
+        """
+        Realiza varias transferencias desde la cuenta del usuario autenticado en una sola transacción.
+        - atomic: si alguna falla no se aplica ninguna.
+        - best_effort: se aplican las válidas y se informa el resultado de cada una.
+        """
+        data = api.payload
+        transfers = data.get("transfers") or []
+        mode = data.get("mode") or "atomic"
+        if mode not in ("atomic", "best_effort"):
+            api.abort(400, "Invalid mode")
+        if not transfers:
+            api.abort(400, "Invalid data")
+        if len(transfers) > BATCH_TRANSFER_MAX:
+            api.abort(400, f"At most {BATCH_TRANSFER_MAX} transfers per batch")
+        sender_id = g.user['id']
+        targets = list({t.get("target_username") for t in transfers if t.get("target_username")})
+        version = balance_version(sender_id)
+
+        conn = get_connection()
+        cur = conn.cursor()
         try:
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (amount, g.user['id']))
-            cur.execute("UPDATE bank.accounts SET balance = balance + %s WHERE user_id = %s", (amount, target_user_id))
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (g.user['id'],))
+            # Resuelve destinatarios y bloquea todas las cuentas en orden de user_id (evita deadlocks)
+            cur.execute("""
+                SELECT a.user_id, u.username, a.balance,
+                       EXISTS (SELECT 1 FROM bank.account_ledger l WHERE l.account_id = a.id), a.id
+                FROM bank.accounts a
+                JOIN bank.users u ON u.id = a.user_id
+                WHERE a.user_id = %s OR u.username = ANY(%s)
+                ORDER BY a.user_id
+                FOR UPDATE OF a
+            """, (sender_id, targets))
+            rows = cur.fetchall()
+            accounts = {username: user_id for user_id, username, _, _, _ in rows}
+            balances = {user_id: balance for user_id, _, balance, _, _ in rows}
+            account_ids = {user_id: account_id for user_id, _, _, _, account_id in rows}
+            if sender_id not in balances:
+                conn.rollback()
+                cur.close()
+                release_connection(conn)
+                api.abort(404, "Sender account not found")
+            # Cuenta caliente con depósitos pendientes: se suman antes de validar fondos
+            if any(pending for user_id, _, _, pending, _ in rows if user_id == sender_id):
+                cur.execute("SELECT bank.settle_ledger(%s)", (sender_id,))
+                balances[sender_id] = cur.fetchone()[0]
+
+            results = []
+            deltas = {}
+            movements = []
+            sender_account = account_ids[sender_id]
+            available = balances[sender_id]
+            for index, item in enumerate(transfers):
+                target_username = item.get("target_username")
+                amount = item.get("amount", 0)
+                if not target_username or amount <= 0:
+                    status, code = "invalid_data", 400
+                elif target_username == g.user['username']:
+                    status, code = "same_account", 400
+                elif target_username not in accounts:
+                    status, code = "target_not_found", 404
+                elif available < Decimal(str(amount)):
+                    status, code = "insufficient_funds", 400
+                else:
+                    status, code = "ok", 200
+                    # Decimal para que la suma de muchos montos no acumule error de float
+                    value = Decimal(str(amount))
+                    available -= value
+                    target_id = accounts[target_username]
+                    deltas[sender_id] = deltas.get(sender_id, Decimal(0)) - value
+                    deltas[target_id] = deltas.get(target_id, Decimal(0)) + value
+                    target_account = account_ids[target_id]
+                    movements.append((sender_account, "transfer_out", -value, target_account))
+                    movements.append((target_account, "transfer_in", value, sender_account))
+                results.append({
+                    "index": index,
+                    "target_username": target_username,
+                    "amount": amount,
+                    "status": status,
+                    "code": code
+                })
+
+            failed = sum(1 for r in results if r["status"] != "ok")
+            if (mode == "atomic" and failed) or not deltas:
+                conn.rollback()
+                cur.close()
+                release_connection(conn)
+                write_log("WARNING", ip, g.user["username"], f"Lote de transferencias rechazado: {failed} de {len(results)} inválidas", 400)
+                return {
+                    "message": "Batch rejected",
+                    "mode": mode,
+                    "applied": 0,
+                    "failed": failed,
+                    "results": results
+                }, 400
+
+            # Una sola actualización para todas las cuentas afectadas
+            execute_values(cur, """
+                UPDATE bank.accounts AS a SET balance = a.balance + d.delta
+                FROM (VALUES %s) AS d(user_id, delta)
+                WHERE a.user_id = d.user_id
+            """, list(deltas.items()), template="(%s, %s::NUMERIC)")
+            execute_values(cur, """
+                INSERT INTO bank.transactions (account_id, kind, amount, counterparty_account_id) VALUES %s
+            """, movements, page_size=len(movements))
+            cur.execute("""
+                SELECT bank.account_balance(a.id) FROM bank.accounts a, bank.notify_balance_changed(ARRAY[%s], %s)
+                WHERE a.user_id = %s
+            """, (sender_id, [user_id for user_id in deltas if user_id != sender_id], sender_id))
             new_balance = float(cur.fetchone()[0])
             conn.commit()
         except Exception as e:
             conn.rollback()
             cur.close()
-            conn.close()
-            write_log("ERROR", ip, g.user["username"], f"Error durante transferencia: {str(e)}", 500)
-            api.abort(500, f"Error during transfer: {str(e)}")
+            release_connection(conn)
+            write_log("ERROR", ip, g.user["username"], f"Error durante lote de transferencias: {str(e)}", 500)
+            api.abort(500, f"Error during batch transfer: {str(e)}")
         cur.close()
-        conn.close()
-        write_log("INFO", ip, g.user["username"], f"Transferencia de ${amount} a {target_username}", 200)
-        return {"message": "Transfer successful", "new_balance": new_balance}, 200
+        release_connection(conn)
+        update_balances(sender_id, version, account_balance=new_balance)
+        applied = len(results) - failed
+        write_log("INFO", ip, g.user["username"], f"Lote de transferencias: {applied} aplicadas, {failed} fallidas", 200)
+        return {
+            "message": "Batch processed",
+            "mode": mode,
+            "applied": applied,
+            "failed": failed,
+            "new_balance": new_balance,
+            "results": results
+        }, 200
 
 @bank_ns.route('/credit-payment')
 class CreditPayment(Resource):
     @bank_ns.expect(credit_payment_model, validate=True)
-    @bank_ns.doc('credit_payment')
+    @bank_ns.doc('credit_payment', params=IDEMPOTENCY_PARAMS)
     @token_required
+    @idempotent
     def post(self):
         ip = request.remote_addr or "unknown"
         """
@@ -387,56 +548,57 @@ class CreditPayment(Resource):
             api.abort(400, "OTP code y establishment_id son requeridos")
 
         user_id = g.user['id']
+        last_4 = card_number[-4:]
+        # Se cifra antes de abrir la transacción: bank.credit_purchase deja
+        # bloqueadas la cuenta y la tarjeta hasta el commit
+        encrypted_card = (encrypt_data(card_number), encrypt_data(data['expiry_date']), encrypt_data(data['cvv']))
+        version = balance_version(user_id)
         conn = get_connection()
         cur = conn.cursor()
         try:
-            # Verificar OTP
-            if not validate_otp(user_id, otp_code):
-                write_log("WARNING", ip, g.user["username"], "Compra rechazada: OTP inválido", 400)
-                api.abort(400, "OTP inválido o expirado")
-            
-            # Verificar establecimiento
-            cur.execute("SELECT id FROM bank.establecimientos WHERE id = %s", (establishment_id,))
-            if not cur.fetchone():
-                write_log("WARNING", ip, g.user["username"], f"Compra rechazada: Establecimiento {establishment_id} inválido", 400)
-                api.abort(400, "Establecimiento no válido o no registrado")
-
-            # 2. Guardar la tarjeta de forma segura si es nueva
-            cur.execute("SELECT id FROM bank_secure.encrypted_cards WHERE user_id = %s AND card_last_4_digits = %s", (user_id, card_number[-4:]))
-            if not cur.fetchone():
+            # OTP, establecimiento, fondos y saldos en una sola llamada
+            cur.execute(
+                """
+                SELECT status, account_balance, credit_balance, card_stored
+                FROM bank.credit_purchase(%s, %s, %s, %s, %s, %s)
+                """,
+                (user_id, otp_code, datetime.utcnow(), establishment_id, amount, last_4)
+            )
+            status, account_balance, credit_balance, card_stored = cur.fetchone()
+
+            # Guardar la tarjeta de forma segura solo si es nueva
+            if status == "ok" and not card_stored:
                 cur.execute("""
                     INSERT INTO bank_secure.encrypted_cards (user_id, encrypted_card_number, encrypted_expiry_date, encrypted_cvv, card_last_4_digits)
                     VALUES (%s, %s, %s, %s, %s)
-                """, (user_id, encrypt_data(card_number), encrypt_data(data['expiry_date']), encrypt_data(data['cvv']), card_number[-4:]))
-            
-            # 3. Lógica original del pago
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            account_balance = float(cur.fetchone()[0])
-            if account_balance < amount:
-                api.abort(400, "Fondos insuficientes en la cuenta")
-
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (amount, user_id))
-            cur.execute("UPDATE bank.credit_cards SET balance = balance + %s WHERE user_id = %s", (amount, user_id))
-            
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            new_account_balance = float(cur.fetchone()[0])
-            cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-            new_credit_balance = float(cur.fetchone()[0])
-            
+                """, (user_id, *encrypted_card, last_4))
             conn.commit()
-            write_log("INFO", ip, g.user["username"], f"Compra a crédito por ${amount} en establecimiento {establishment_id}", 200)
-
-        except HTTPException as http_err:
-            conn.rollback()
-            raise http_err
         except Exception as e:
+            conn.rollback()
+            cur.close()
+            release_connection(conn)
             write_log("ERROR", ip, g.user["username"], f"Error procesando compra: {str(e)}", 500)
             logging.exception("Error procesando compra")
-            conn.rollback()
             api.abort(500, "Error interno inesperado. Contacta al administrador.")
-        finally:
-            cur.close()
-            conn.close()
+        cur.close()
+        release_connection(conn)
+
+        if status == "invalid_otp":
+            write_log("WARNING", ip, g.user["username"], "Compra rechazada: OTP inválido", 400)
+            api.abort(400, "OTP inválido o expirado")
+        if status == "invalid_establishment":
+            write_log("WARNING", ip, g.user["username"], f"Compra rechazada: Establecimiento {establishment_id} inválido", 400)
+            api.abort(400, "Establecimiento no válido o no registrado")
+        if status == "account_not_found":
+            api.abort(404, "Account not found")
+        if status == "insufficient_funds":
+            api.abort(400, "Fondos insuficientes en la cuenta")
+        if status == "card_not_found":
+            api.abort(404, "Credit card not found")
+        new_account_balance = float(account_balance)
+        new_credit_balance = float(credit_balance)
+        update_balances(user_id, version, account_balance=new_account_balance, credit_card_debt=new_credit_balance)
+        write_log("INFO", ip, g.user["username"], f"Compra a crédito por ${amount} en establecimiento {establishment_id}", 200)
 
         return {           
             "message": "Compra con tarjeta de crédito exitosa. Tarjeta validada y guardada de forma segura.",
@@ -447,8 +609,9 @@ class CreditPayment(Resource):
 @bank_ns.route('/pay-credit-balance')
 class PayCreditBalance(Resource):
     @bank_ns.expect(pay_credit_balance_model, validate=True)
-    @bank_ns.doc('pay_credit_balance')
+    @bank_ns.doc('pay_credit_balance', params=IDEMPOTENCY_PARAMS)
     @token_required
+    @idempotent
     def post(self):
         ip = request.remote_addr or "unknown"
         """
@@ -461,56 +624,317 @@ class PayCreditBalance(Resource):
         if amount <= 0:
             api.abort(400, "Amount must be greater than zero")
         user_id = g.user['id']
+        version = balance_version(user_id)
         conn = get_connection()
         cur = conn.cursor()
-        # Check account funds
-        cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.close()
-            conn.close()
-            api.abort(404, "Account not found")
-        account_balance = float(row[0])
-        if account_balance < amount:
-            cur.close()
-            conn.close()
-            write_log("WARNING", ip, g.user["username"], f"Intento de pago fallido: fondos insuficientes (${amount})", 400)
-            api.abort(400, "Insufficient funds in account")
-        # Get current credit card debt
-        cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.close()
-            conn.close()
-            api.abort(404, "Credit card not found")
-        credit_debt = float(row[0])
-        payment = min(amount, credit_debt)
         try:
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (payment, user_id))
-            cur.execute("UPDATE bank.credit_cards SET balance = balance - %s WHERE user_id = %s", (payment, user_id))
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            new_account_balance = float(cur.fetchone()[0])
-            cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-            new_credit_debt = float(cur.fetchone()[0])
-            conn.commit()
-            write_log("INFO", ip, g.user["username"], f"Pago de deuda por ${payment}", 200)
+            cur.execute(
+                "SELECT status, account_balance, credit_balance, payment FROM bank.pay_credit_balance(%s, %s)",
+                (user_id, amount)
+            )
+            status, account_balance, credit_balance, payment = cur.fetchone()
+            if status == "ok":
+                conn.commit()
+            else:
+                conn.rollback()
         except Exception as e:
             conn.rollback()
             cur.close()
-            conn.close()
+            release_connection(conn)
             write_log("ERROR", ip, g.user["username"], f"Error procesando pago de deuda: {str(e)}", 500)
             api.abort(500, f"Error processing credit balance payment: {str(e)}")
         cur.close()
-        conn.close()
+        release_connection(conn)
+        if status == "account_not_found":
+            api.abort(404, "Account not found")
+        if status == "insufficient_funds":
+            write_log("WARNING", ip, g.user["username"], f"Intento de pago fallido: fondos insuficientes (${amount})", 400)
+            api.abort(400, "Insufficient funds in account")
+        if status == "card_not_found":
+            api.abort(404, "Credit card not found")
+        new_account_balance = float(account_balance)
+        new_credit_debt = float(credit_balance)
+        payment = float(payment)
+        update_balances(user_id, version, account_balance=new_account_balance, credit_card_debt=new_credit_debt)
+        write_log("INFO", ip, g.user["username"], f"Pago de deuda por ${payment}", 200)
         return {
             "message": "Credit card debt payment successful",
             "account_balance": new_account_balance,
             "credit_card_debt": new_credit_debt
         }, 200
 
-@app.before_first_request
-def initialize_db():
-    init_db()
+# accounts_user_id_idx y credit_cards_user_id_idx; bench/plans.py revisa su plan
+BALANCE_SQL = """
+    SELECT (SELECT bank.account_balance(id) FROM bank.accounts WHERE user_id = %s),
+           (SELECT balance FROM bank.credit_cards WHERE user_id = %s)
+"""
+
+@bank_ns.route('/balance')
+class Balance(Resource):
+    @bank_ns.doc('balance')
+    @token_required
+    def get(self):
+        """
+        Devuelve el saldo de la cuenta y la deuda de la tarjeta del usuario autenticado.
+        Responde 304 si el ETag enviado en If-None-Match sigue vigente.
+        """
+        user_id = g.user['id']
+        cached = cached_balances(user_id)
+        if cached is None:
+            version = balance_version(user_id)
+            # Réplica salvo que el usuario haya escrito hace poco (ver ReplicaRouter)
+            conn = get_connection(readonly=True)
+            cur = conn.cursor()
+            cur.execute(BALANCE_SQL, (user_id, user_id))
+            account_balance, credit_balance = cur.fetchone()
+            conn.commit()
+            cur.close()
+            release_connection(conn)
+            if account_balance is None:
+                api.abort(404, "Account not found")
+            balances = {
+                "account_balance": float(account_balance),
+                "credit_card_debt": float(credit_balance) if credit_balance is not None else None
+            }
+            # Sin ETag si otra escritura se cruzó con esta lectura
+            cached = update_balances(user_id, version, **balances) or (balances, None)
+        balances, etag = cached
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"} if etag else {}
+        if etag and request.if_none_match.contains(etag):
+            return None, 304, headers
+        return balances, 200, headers
+
+STATEMENT_PAGE_DEFAULT = env_int('STATEMENT_PAGE_DEFAULT', 50)
+STATEMENT_PAGE_MAX = env_int('STATEMENT_PAGE_MAX', 200)
+
+# Página del extracto por keyset (transactions_account_created_idx); bench/plans.py revisa su plan
+STATEMENT_PAGE_SQL = """
+    SELECT t.id, t.kind, t.amount, cu.username, t.description, t.created_at
+    FROM bank.transactions t
+    LEFT JOIN bank.accounts ca ON ca.id = t.counterparty_account_id
+    LEFT JOIN bank.users cu ON cu.id = ca.user_id
+    WHERE t.account_id = (SELECT id FROM bank.accounts WHERE user_id = %s)
+      AND (t.created_at, t.id) < (%s, %s)
+    ORDER BY t.created_at DESC, t.id DESC
+    LIMIT %s
+"""
+
+def _encode_cursor(created_at: datetime, transaction_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{transaction_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, transaction_id = raw.split("|")
+    return datetime.fromisoformat(created_at), int(transaction_id)
+
+@bank_ns.route('/statement')
+class Statement(Resource):
+    @bank_ns.doc('statement', params={
+        'limit': {'in': 'query', 'type': 'integer', 'description': f'Movimientos por página (máx. {STATEMENT_PAGE_MAX})'},
+        'cursor': {'in': 'query', 'type': 'string', 'description': 'next_cursor de la página anterior'}
+    })
+    @token_required
+    def get(self):
+        """
+        Extracto de movimientos de la cuenta del usuario autenticado, del más reciente al más antiguo.
+        Paginación por cursor: cada página cuesta lo mismo sin importar su posición.
+        """
+        limit = request.args.get("limit", STATEMENT_PAGE_DEFAULT, type=int)
+        if limit < 1 or limit > STATEMENT_PAGE_MAX:
+            api.abort(400, f"limit must be between 1 and {STATEMENT_PAGE_MAX}")
+        cursor = request.args.get("cursor")
+        # Sin cursor se parte de un punto posterior a cualquier movimiento
+        after = (datetime.max, 0)
+        if cursor:
+            try:
+                after = _decode_cursor(cursor)
+            except (ValueError, UnicodeDecodeError):
+                api.abort(400, "Invalid cursor")
+
+        conn = get_connection(readonly=True)
+        cur = conn.cursor()
+        cur.execute(STATEMENT_PAGE_SQL, (g.user['id'], after[0], after[1], limit + 1))
+        rows = cur.fetchall()
+        conn.commit()
+        cur.close()
+        release_connection(conn)
+
+        page = rows[:limit]
+        next_cursor = _encode_cursor(page[-1][5], page[-1][0]) if len(rows) > limit else None
+        return {
+            "transactions": [{
+                "id": transaction_id,
+                "kind": kind,
+                "amount": float(amount),
+                "counterparty": counterparty,
+                "description": description,
+                "created_at": created_at.isoformat()
+            } for transaction_id, kind, amount, counterparty, description, created_at in page],
+            "next_cursor": next_cursor
+        }, 200
+
+# ---------------- Logs Endpoints ----------------
+
+@logs_ns.route('/export')
+class ExportLogs(Resource):
+    @logs_ns.doc('export_logs', params={
+        'start': {'in': 'query', 'type': 'string', 'required': True, 'description': 'Inicio (ISO 8601, inclusivo)'},
+        'end': {'in': 'query', 'type': 'string', 'required': True, 'description': 'Fin (ISO 8601, exclusivo)'},
+        'format': {'in': 'query', 'type': 'string', 'enum': sorted(EXPORT_FORMATS), 'default': 'ndjson'},
+        'gzip': {'in': 'query', 'type': 'boolean', 'default': False}
+    })
+    @token_required
+    def get(self):
+        """Descarga en streaming los logs de auditoría de un rango de fechas (NDJSON o CSV, opcionalmente gzip)."""
+        ip = request.remote_addr or "unknown"
+        if g.user["role"] not in EXPORT_ROLES:
+            write_log("WARNING", ip, g.user["username"], "Exportación de logs denegada", 403)
+            api.abort(403, "Not allowed to export logs")
+        fmt = request.args.get("format", "ndjson")
+        if fmt not in EXPORT_FORMATS:
+            api.abort(400, "Invalid format")
+        try:
+            start = datetime.fromisoformat(request.args.get("start", ""))
+            end = datetime.fromisoformat(request.args.get("end", ""))
+        except ValueError:
+            api.abort(400, "start and end must be ISO 8601 dates")
+        if start >= end:
+            api.abort(400, "start must be before end")
+        compress = request.args.get("gzip", "false").lower() in ("1", "true", "yes")
+
+        filename = f"app_logs_{start:%Y%m%d%H%M%S}_{end:%Y%m%d%H%M%S}.{fmt}" + (".gz" if compress else "")
+        write_log("INFO", ip, g.user["username"], f"Exportación de logs {start.isoformat()} a {end.isoformat()}", 200)
+        return Response(
+            export_logs(start, end, fmt, compress),
+            mimetype="application/gzip" if compress else EXPORT_FORMATS[fmt],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+
+OTP_PURGE_INTERVAL = env_float('OTP_PURGE_INTERVAL', 300.0)
+REVOCATION_PURGE_INTERVAL = env_float('REVOCATION_PURGE_INTERVAL', 300.0)
+LOG_PARTITION_INTERVAL = env_float('LOG_PARTITION_INTERVAL', 3600.0)
+LEDGER_ROLLUP_INTERVAL = env_float('LEDGER_ROLLUP_INTERVAL', 1.0)
+IDEMPOTENCY_PURGE_INTERVAL = env_float('IDEMPOTENCY_PURGE_INTERVAL', 3600.0)
+METRICS_FLUSH_INTERVAL = env_float('METRICS_FLUSH_INTERVAL', 5.0)
+
+# ---------------- Estadísticas internas ----------------
+
+def process_stats() -> dict:
+    return {
+        "db_pool": pool_stats(),
+        "db_read_pool": read_pool_stats(),
+        "replica": replica_stats(),
+        "schema": migration_stats(),
+        "audit_log": log_writer_stats(),
+        "app_log": app_log_stats(),
+        "jwt_cache": token_cache_stats(),
+        "revocation": revocation_stats(),
+        "balance_cache": balance_cache_stats(),
+        "idempotency": idempotency_stats(),
+        "ratelimit": ratelimit_stats(),
+        "otp": otp_stats(),
+        "housekeeping": housekeeping_stats(),
+        "startup": {"ready": _ready_pid == os.getpid(), "warm_up_seconds": _warm_up_seconds}
+    }
+
+def stats():
+    """Estadísticas del proceso (pool, logs, JWT, OTP, mantenimiento) para scraping."""
+    return {"pid": os.getpid(), **process_stats()}
+
+def metrics():
+    """Métricas de todos los workers en formato de texto de Prometheus."""
+    return Response(render_metrics(process_stats()), mimetype="text/plain; version=0.0.4")
+
+def ready():
+    """200 cuando el worker terminó su warm-up; 503 mientras tanto (para el balanceador)."""
+    if _ready_pid != os.getpid():
+        return {"status": "starting", "pid": os.getpid()}, 503
+    return {"status": "ready", "pid": os.getpid(), "warm_up_seconds": _warm_up_seconds}
+
+# ---------------- Arranque ----------------
+
+_warm_up_lock = threading.Lock()
+_ready_pid = None
+_warm_up_seconds = None
+
+def warm_up():
+    """
+    Deja el proceso listo para recibir tráfico: abre el pool, comprueba el
+    esquema, carga los tokens revocados, se suscribe a los avisos y arranca los
+    hilos de fondo. Gunicorn la llama en post_worker_init, antes de que el
+    worker acepte conexiones; si no, la dispara el primer request.
+    """
+    global _ready_pid, _warm_up_seconds
+    pid = os.getpid()
+    if _ready_pid == pid:
+        return
+    with _warm_up_lock:
+        if _ready_pid == pid:
+            return
+        start = time.perf_counter()
+        get_pool().open()
+        if replica_configured():
+            # Sin una medición del retraso las lecturas van al primario; si la
+            # réplica no responde el worker igual queda listo
+            check_replica_lag()
+            register_job("replica_lag", REPLICA_LAG_CHECK_INTERVAL, check_replica_lag)
+        # Con el esquema al día (lo migra el master de gunicorn) es una sola consulta
+        migrate()
+        init_revocation()
+        init_balance_cache()
+        start_log_writer()
+        start_app_log_listener()
+        register_job("otp_purge", OTP_PURGE_INTERVAL, purge_otp_codes)
+        register_job("revocation_purge", REVOCATION_PURGE_INTERVAL, purge_revoked)
+        register_job("log_partitions", LOG_PARTITION_INTERVAL, maintain_log_partitions)
+        register_job("ledger_rollup", LEDGER_ROLLUP_INTERVAL, roll_up_ledger)
+        register_job("idempotency_purge", IDEMPOTENCY_PURGE_INTERVAL, purge_idempotency_keys)
+        if METRICS_DIR:
+            register_job("metrics_flush", METRICS_FLUSH_INTERVAL, lambda: write_snapshot(process_stats()))
+        start_housekeeping()
+        _warm_up_seconds = round(time.perf_counter() - start, 6)
+        _ready_pid = pid
+
+def _prepare(app):
+    """
+    Lo que no depende del proceso: cifrador, clave del JWT y spec de Swagger.
+    Con --preload se hace una sola vez en el master y los workers lo heredan.
+    """
+    load_cipher()
+    load_signing_key()
+    with app.test_request_context():
+        api.__schema__  # queda cacheado en `api` para /swagger.json
+    app.jinja_env.get_template('swagger-ui.html')
+
+def create_app(config: dict | None = None) -> Flask:
+    """
+    Construye la app. `config` se aplica sobre app.config; con WARM_UP
+    (por defecto) se prepara lo que no depende del proceso.
+    """
+    app = Flask(__name__)
+    app.config.update(
+        WARM_UP=os.environ.get('WARM_UP', '1') == '1',
+        LOG_FILE=os.environ.get('LOG_FILE', 'app.log'),
+        LOG_LEVEL=LOG_LEVEL,
+    )
+    app.config.update(config or {})
+
+    configure_logging(app.config['LOG_FILE'], app.config['LOG_LEVEL'])
+
+    init_db_app(app)
+    init_metrics_app(app)
+    init_ratelimit_app(app)
+    api.init_app(app)
+    app.add_url_rule('/stats', view_func=stats)
+    app.add_url_rule('/metrics', view_func=metrics)
+    app.add_url_rule('/ready', view_func=ready)
+    app.before_first_request(warm_up)
+    if app.config['WARM_UP']:
+        _prepare(app)
+    return app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
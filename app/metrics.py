@@ -0,0 +1,220 @@
+# app/metrics.py
+# Métricas en formato de texto de Prometheus, sin dependencias externas.
+#
+# Cada worker acumula sus métricas en memoria. Con METRICS_DIR configurado,
+# cada worker vuelca una instantánea a METRICS_DIR/<pid>.json y /metrics suma
+# las de todos los workers (los contadores de workers ya terminados se
+# conservan; sus gauges se descartan).
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from flask import g, has_app_context, request
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(labels), value] for labels, value in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "values": values}
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [conteos por bucket (+Inf al final), suma, total]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(labels), [list(e[0]), e[1], e[2]]] for labels, e in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames),
+                "buckets": list(self.buckets), "values": values}
+
+
+_registry = []
+
+REQUEST_SECONDS = Histogram('corebank_http_request_duration_seconds', 'Latencia por ruta', ('route', 'method'))
+REQUESTS_TOTAL = Counter('corebank_http_requests_total', 'Requests por ruta y código', ('route', 'method', 'status'))
+REQUEST_QUERIES = Histogram('corebank_db_queries_per_request', 'Sentencias SQL por request', ('route',), COUNT_BUCKETS)
+REQUEST_QUERY_SECONDS = Histogram('corebank_db_query_seconds_per_request', 'Tiempo total en SQL por request', ('route',))
+QUERY_SECONDS = Histogram('corebank_db_query_duration_seconds', 'Duración de cada sentencia SQL')
+CONNECTION_ACQUIRE_SECONDS = Histogram('corebank_db_connection_acquire_seconds', 'Espera para obtener una conexión del pool')
+AUDIT_LOG_SECONDS = Histogram('corebank_audit_log_write_seconds', 'Tiempo de write_log dentro del request')
+CRYPTO_SECONDS = Histogram('corebank_crypto_seconds', 'Tiempo de cifrado Fernet', ('operation',))
+
+
+def observe_query(elapsed: float):
+    QUERY_SECONDS.observe(elapsed)
+    if has_app_context() and '_metrics_start' in g:
+        g._metrics_queries += 1
+        g._metrics_query_time += elapsed
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_queries = 0
+    g._metrics_query_time = 0.0
+
+def _after_request(response):
+    start = g.get('_metrics_start')
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method)
+    REQUESTS_TOTAL.inc(route, request.method, str(response.status_code))
+    REQUEST_QUERIES.observe(g._metrics_queries, route)
+    REQUEST_QUERY_SECONDS.observe(g._metrics_query_time, route)
+    return response
+
+def init_metrics_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+# ---------------- Instantáneas y agregación entre workers ----------------
+
+def _gauges(stats: dict, prefix: str = 'corebank') -> list:
+    """Aplana un dict de estadísticas en gauges (nombre, valor)."""
+    gauges = []
+    for key, value in stats.items():
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', f"{prefix}_{key}")
+        if isinstance(value, dict):
+            gauges.extend(_gauges(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges.append([name, value])
+    return gauges
+
+def local_snapshot(stats: dict) -> dict:
+    return {
+        "pid": os.getpid(),
+        "metrics": {metric.name: metric.snapshot() for metric in _registry},
+        "gauges": _gauges(stats),
+    }
+
+def write_snapshot(stats: dict):
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(local_snapshot(stats), fh)
+    os.replace(tmp_path, path)
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _load_snapshots(stats: dict) -> list:
+    if not METRICS_DIR:
+        return [local_snapshot(stats)]
+    write_snapshot(stats)
+    snapshots = []
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename), encoding='utf-8') as fh:
+                snapshots.append(json.load(fh))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def _merge(snapshots: list) -> dict:
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for labels, value in metric["values"]:
+                key = tuple(labels)
+                if metric["type"] == "counter":
+                    target["values"][key] = target["values"].get(key, 0) + value
+                else:
+                    current = target["values"].get(key)
+                    if current is None:
+                        target["values"][key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+    return merged
+
+def _format_labels(names, values, extra: dict | None = None) -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in (extra or {}).items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render(stats: dict) -> str:
+    """Texto de exposición de Prometheus con las métricas de todos los workers."""
+    snapshots = _load_snapshots(stats)
+    lines = []
+    for name, metric in sorted(_merge(snapshots).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for labels, value in metric["values"].items():
+            if metric["type"] == "counter":
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric["buckets"]) + ["+Inf"], counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labelnames, labels, {'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labelnames, labels)} {count}")
+
+    gauges = {}
+    for snapshot in snapshots:
+        if snapshot["pid"] != os.getpid() and not _pid_alive(snapshot["pid"]):
+            continue
+        for name, value in snapshot["gauges"]:
+            gauges.setdefault(name, []).append((snapshot["pid"], value))
+    for name in sorted(gauges):
+        lines.append(f"# TYPE {name} gauge")
+        for pid, value in gauges[name]:
+            lines.append(f'{name}{{pid="{pid}"}} {value}')
+    return "\n".join(lines) + "\n"
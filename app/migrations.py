@@ -0,0 +1,339 @@
+# app/migrations.py
+# Esquema versionado de la base.
+#
+# Cada paso de MIGRATIONS se aplica una sola vez, en su propia transacción, y
+# queda registrado en public.schema_version. Las funciones de MONEY_FUNCTIONS_SQL
+# se reinstalan cuando cambia su checksum (public.schema_routines).
+#
+# Un solo proceso migra a la vez (advisory lock de sesión); con el esquema al
+# día basta una consulta. Los pasos usan IF NOT EXISTS: en una base creada por
+# el init_db anterior se aplican todos sin cambiar nada y quedan registrados.
+import hashlib
+import threading
+import time
+from psycopg2 import errors
+from .db import get_connection, release_connection, init_app_logs, APP_LOGS_DEFAULT_SQL, MONEY_FUNCTIONS_SQL
+
+MIGRATIONS_LOCK_SQL = "SELECT pg_advisory_lock(hashtext('public.schema_version'))"
+MIGRATIONS_UNLOCK_SQL = "SELECT pg_advisory_unlock(hashtext('public.schema_version'))"
+ROUTINES_NAME = 'money_functions'
+ROUTINES_CHECKSUM = hashlib.sha1(MONEY_FUNCTIONS_SQL.encode()).hexdigest()
+
+SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS public.schema_version (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS public.schema_routines (
+    name TEXT PRIMARY KEY,
+    checksum TEXT NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+# Camino rápido: una sola consulta (falla con UndefinedTable en una base nueva)
+CURRENT_SCHEMA_SQL = """
+SELECT COALESCE((SELECT MAX(version) FROM public.schema_version), 0),
+       (SELECT checksum FROM public.schema_routines WHERE name = %s)
+"""
+
+
+def _base_schema(cur):
+    cur.execute("""
+    CREATE SCHEMA IF NOT EXISTS bank AUTHORIZATION postgres;
+
+    CREATE TABLE IF NOT EXISTS bank.users (
+        id SERIAL PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL,
+        full_name TEXT,
+        email TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.accounts (
+        id SERIAL PRIMARY KEY,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        user_id INTEGER REFERENCES bank.users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.credit_cards (
+        id SERIAL PRIMARY KEY,
+        limit_credit NUMERIC NOT NULL DEFAULT 1,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        user_id INTEGER REFERENCES bank.users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.tokens (
+        token TEXT PRIMARY KEY,
+        user_id INTEGER REFERENCES bank.users(id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- TCE-04 (Ivan Simbana): establecimientos y códigos OTP
+    CREATE TABLE IF NOT EXISTS bank.establecimientos (
+        id SERIAL PRIMARY KEY,
+        nombre TEXT NOT NULL,
+        direccion TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.otp_codes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES bank.users(id),
+        code TEXT NOT NULL,
+        expires_at TIMESTAMP NOT NULL,
+        used BOOLEAN NOT NULL DEFAULT FALSE
+    );
+
+    -- TCE-04 (Mateo Pilco): esquema aparte para los datos cifrados de tarjetas
+    CREATE SCHEMA IF NOT EXISTS bank_secure AUTHORIZATION postgres;
+
+    CREATE TABLE IF NOT EXISTS bank_secure.encrypted_cards (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES bank.users(id),
+        encrypted_card_number TEXT NOT NULL,
+        encrypted_expiry_date TEXT NOT NULL,
+        encrypted_cvv TEXT NOT NULL,
+        card_last_4_digits TEXT NOT NULL -- Para mostrar al usuario de forma segura
+    );
+    """)
+
+def _sample_data(cur):
+    # Usuarios de ejemplo, cada uno con una cuenta (saldo 1000) y una tarjeta (límite 5000)
+    cur.execute("SELECT COUNT(*) FROM bank.users")
+    if cur.fetchone()[0] == 0:
+        sample_users = [
+            ('user1', 'pass1', 'cliente', 'Usuario Uno', 'user1@example.com'),
+            ('user2', 'pass2', 'cliente', 'Usuario Dos', 'user2@example.com'),
+            ('user3', 'pass3', 'cajero',  'Usuario Tres', 'user3@example.com')
+        ]
+        for username, password, role, full_name, email in sample_users:
+            cur.execute("""
+                INSERT INTO bank.users (username, password, role, full_name, email)
+                VALUES (%s, %s, %s, %s, %s) RETURNING id
+            """, (username, password, role, full_name, email))
+            user_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (%s, %s)", (1000, user_id))
+            cur.execute("""
+                INSERT INTO bank.credit_cards (limit_credit, balance, user_id)
+                VALUES (%s, %s, %s)
+            """, (5000, 0, user_id))
+
+    cur.execute("SELECT COUNT(*) FROM bank.establecimientos")
+    if cur.fetchone()[0] == 0:
+        cur.execute("""
+            INSERT INTO bank.establecimientos (nombre, direccion) VALUES
+            ('Tienda ABC', 'Av. Siempre Viva 123'),
+            ('Restaurante XYZ', 'Calle Falsa 456')
+        """)
+
+def _revoked_tokens(cur):
+    # Tokens revocados por logout (jti + exp del JWT, en segundos epoch)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS bank.revoked_tokens (
+        jti TEXT PRIMARY KEY,
+        exp BIGINT NOT NULL
+    );
+    """)
+
+def _app_logs(cur):
+    # Particionada por mes; migra la tabla sin particionar si existe
+    cur.execute("CREATE SCHEMA IF NOT EXISTS logs_repo AUTHORIZATION postgres")
+    init_app_logs(cur)
+
+def _hot_path_indexes(cur):
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS accounts_user_id_idx
+        ON bank.accounts (user_id);
+    CREATE INDEX IF NOT EXISTS credit_cards_user_id_idx
+        ON bank.credit_cards (user_id);
+    -- validate_otp: solo interesan los códigos sin usar, el más reciente primero
+    CREATE INDEX IF NOT EXISTS otp_codes_unused_idx
+        ON bank.otp_codes (user_id, code, expires_at DESC) WHERE used = FALSE;
+    -- purge_otp_codes: códigos vencidos o ya usados
+    CREATE INDEX IF NOT EXISTS otp_codes_expires_at_idx
+        ON bank.otp_codes (expires_at);
+    CREATE INDEX IF NOT EXISTS otp_codes_used_idx
+        ON bank.otp_codes (id) WHERE used = TRUE;
+    CREATE INDEX IF NOT EXISTS encrypted_cards_user_last4_idx
+        ON bank_secure.encrypted_cards (user_id, card_last_4_digits);
+    CREATE INDEX IF NOT EXISTS revoked_tokens_exp_idx
+        ON bank.revoked_tokens (exp);
+    """)
+
+def _idempotency_keys(cur):
+    # Respuestas de los POST de /bank por Idempotency-Key
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS bank.idempotency_keys (
+        user_id INTEGER NOT NULL REFERENCES bank.users(id),
+        key TEXT NOT NULL,
+        request_hash TEXT NOT NULL,
+        status_code INTEGER NOT NULL,
+        response JSONB NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (user_id, key)
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+        ON bank.idempotency_keys (created_at);
+    """)
+
+def _hot_accounts(cur):
+    # Modo de cuenta caliente: depósitos en ledger, sumados al saldo por lotes
+    cur.execute("""
+    ALTER TABLE bank.accounts ADD COLUMN IF NOT EXISTS hot BOOLEAN NOT NULL DEFAULT FALSE;
+    CREATE TABLE IF NOT EXISTS bank.account_ledger (
+        id BIGSERIAL PRIMARY KEY,
+        account_id INTEGER NOT NULL REFERENCES bank.accounts(id),
+        amount NUMERIC NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS account_ledger_account_id_idx
+        ON bank.account_ledger (account_id);
+    """)
+
+def _transactions(cur):
+    # Historial de movimientos (monto con signo: positivo entra a la cuenta)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS bank.transactions (
+        id BIGSERIAL PRIMARY KEY,
+        account_id INTEGER NOT NULL REFERENCES bank.accounts(id),
+        kind TEXT NOT NULL,
+        amount NUMERIC NOT NULL,
+        counterparty_account_id INTEGER REFERENCES bank.accounts(id),
+        description TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    -- Extractos: paginación por (created_at, id) dentro de la cuenta
+    CREATE INDEX IF NOT EXISTS transactions_account_created_idx
+        ON bank.transactions (account_id, created_at, id);
+    """)
+
+def _app_logs_timestamp_index(cur):
+    # Exportación por rango de fechas (se crea en cada partición)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS app_logs_timestamp_idx
+        ON logs_repo.app_logs (timestamp);
+    """)
+
+def _app_logs_default_partition(cur):
+    # Sin ella, si el job de particiones se detiene, los inserts fallan al pasar el último mes creado
+    cur.execute(APP_LOGS_DEFAULT_SQL)
+
+# (versión, descripción, paso): solo se agregan al final, nunca se editan
+MIGRATIONS = [
+    (1, "esquema base", _base_schema),
+    (2, "datos de ejemplo", _sample_data),
+    (3, "tokens revocados", _revoked_tokens),
+    (4, "logs particionados por mes", _app_logs),
+    (5, "índices del camino caliente", _hot_path_indexes),
+    (6, "claves de idempotencia", _idempotency_keys),
+    (7, "cuentas calientes", _hot_accounts),
+    (8, "historial de movimientos", _transactions),
+    (9, "índice de logs por fecha", _app_logs_timestamp_index),
+    (10, "partición por defecto de logs", _app_logs_default_partition),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+class MigrationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.checks = 0
+        self.fast_path = 0
+        self.applied = 0
+        self.routines_applied = 0
+        self.last_duration = None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "version": self.version,
+                "target": SCHEMA_VERSION,
+                "checks": self.checks,
+                "fast_path": self.fast_path,
+                "applied": self.applied,
+                "routines_applied": self.routines_applied,
+                "last_duration": self.last_duration,
+            }
+
+
+_stats = MigrationStats()
+
+def _current(cur) -> tuple:
+    cur.execute(CURRENT_SCHEMA_SQL, (ROUTINES_NAME,))
+    return cur.fetchone()
+
+def _apply_pending(conn, cur) -> int:
+    """Aplica los pasos pendientes con el lock de migraciones tomado."""
+    cur.execute(SCHEMA_VERSION_SQL)
+    conn.commit()
+    version, checksum = _current(cur)
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        step(cur)
+        cur.execute(
+            "INSERT INTO public.schema_version (version, description) VALUES (%s, %s)",
+            (step_version, description)
+        )
+        conn.commit()
+        print(f"Migración {step_version} aplicada: {description}")
+        version = step_version
+        with _stats._lock:
+            _stats.applied += 1
+
+    # Funciones de dinero: validan fondos, mueven el dinero y devuelven los
+    # saldos nuevos en una sola sentencia
+    if checksum != ROUTINES_CHECKSUM:
+        cur.execute(MONEY_FUNCTIONS_SQL)
+        cur.execute("""
+            INSERT INTO public.schema_routines (name, checksum) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET checksum = EXCLUDED.checksum, applied_at = NOW()
+        """, (ROUTINES_NAME, ROUTINES_CHECKSUM))
+        conn.commit()
+        with _stats._lock:
+            _stats.routines_applied += 1
+    return version
+
+def migrate(conn=None) -> int:
+    """
+    Deja el esquema en SCHEMA_VERSION y devuelve la versión. Sin `conn` usa
+    una conexión del pool.
+    """
+    start = time.perf_counter()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
+    cur = conn.cursor()
+    try:
+        try:
+            version, checksum = _current(cur)
+            conn.rollback()
+            fast = version >= SCHEMA_VERSION and checksum == ROUTINES_CHECKSUM
+        except errors.UndefinedTable:
+            conn.rollback()
+            fast = False
+        if not fast:
+            cur.execute(MIGRATIONS_LOCK_SQL)
+            try:
+                version = _apply_pending(conn, cur)
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    cur.execute(MIGRATIONS_UNLOCK_SQL)
+                    conn.rollback()
+        with _stats._lock:
+            _stats.version = version
+            _stats.checks += 1
+            _stats.fast_path += fast
+            _stats.last_duration = round(time.perf_counter() - start, 6)
+        return version
+    finally:
+        cur.close()
+        if own_conn:
+            release_connection(conn)
+
+def migration_stats() -> dict:
+    return _stats.snapshot()
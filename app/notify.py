@@ -0,0 +1,89 @@
+# app/notify.py
+# Difusión de eventos entre workers de gunicorn mediante LISTEN/NOTIFY.
+import os
+import select
+import threading
+import time
+from psycopg2 import extensions
+from .db import new_connection
+
+_handlers = {}       # canal -> [callback(payload)]
+_on_reconnect = {}   # canal -> [callback()] para resincronizar tras LISTEN
+_lock = threading.Lock()
+_thread = None
+_thread_pid = None
+
+def subscribe(channel: str, callback, on_reconnect=None):
+    """
+    Registra un callback para el canal y arranca el listener del proceso.
+    `on_reconnect` corre cada vez que el LISTEN del canal queda activo (también
+    el primero): lo que se cargó antes de eso pudo perder eventos.
+    """
+    with _lock:
+        _handlers.setdefault(channel, []).append(callback)
+        if on_reconnect is not None:
+            _on_reconnect.setdefault(channel, []).append(on_reconnect)
+    _ensure_listener()
+
+def publish(cur, channel: str, payload: str):
+    """Emite el evento en la transacción del cursor: se entrega al hacer commit."""
+    cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+def _ensure_listener():
+    global _thread, _thread_pid
+    pid = os.getpid()
+    with _lock:
+        if _thread is not None and _thread_pid == pid and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_listen_forever, name="pg-listener", daemon=True)
+        _thread_pid = pid
+        _thread.start()
+
+def _resync(channels: list):
+    with _lock:
+        callbacks = [cb for channel in channels for cb in _on_reconnect.get(channel, ())]
+    for callback in callbacks:
+        callback()
+
+def _listen_forever():
+    while True:
+        conn = None
+        try:
+            conn = new_connection()
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            with _lock:
+                channels = list(_handlers)
+            for channel in channels:
+                cur.execute(f'LISTEN "{channel}"')
+            # Lo que se leyó antes del LISTEN (carga inicial o antes de
+            # reconectar) pudo perder eventos: se recarga con el canal ya activo
+            _resync(channels)
+            while True:
+                with _lock:
+                    pending = [c for c in _handlers if c not in channels]
+                for channel in pending:
+                    cur.execute(f'LISTEN "{channel}"')
+                    channels.append(channel)
+                _resync(pending)
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    with _lock:
+                        callbacks = list(_handlers.get(notification.channel, ()))
+                    for callback in callbacks:
+                        try:
+                            callback(notification.payload)
+                        except Exception as e:
+                            print(f"Error procesando evento {notification.channel}: {e}")
+        except Exception as e:
+            print(f"Listener de eventos desconectado: {e}")
+            time.sleep(1)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
@@ -0,0 +1,188 @@
+# app/ratelimit.py
+# Control de admisión y límites de tasa.
+#
+# - Token bucket por usuario (en token_required) y por IP (en /auth/login): 429 + Retry-After.
+# - Tope de requests en curso por worker: 503 + Retry-After cuando se supera.
+#
+# Los buckets viven en un archivo mapeado en memoria (por defecto en /dev/shm)
+# compartido por todos los workers de la máquina, con un lock fcntl por slot.
+# Con RATE_LIMIT_STORE=local (o si el archivo no se puede abrir) cada worker
+# usa su propio dict.
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from .db import env_int, env_float
+from .metrics import Counter
+
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'shared')
+RATE_LIMIT_SHM_PATH = os.environ.get('RATE_LIMIT_SHM_PATH', '/dev/shm/corebank-ratelimit')
+RATE_LIMIT_SLOTS = env_int('RATE_LIMIT_SLOTS', 65536)
+# Tokens por segundo y ráfaga máxima; una tasa 0 desactiva el límite
+RATE_LIMIT_USER_RATE = env_float('RATE_LIMIT_USER_RATE', 10.0)
+RATE_LIMIT_USER_BURST = env_float('RATE_LIMIT_USER_BURST', 20.0)
+RATE_LIMIT_LOGIN_RATE = env_float('RATE_LIMIT_LOGIN_RATE', 0.5)
+RATE_LIMIT_LOGIN_BURST = env_float('RATE_LIMIT_LOGIN_BURST', 10.0)
+# Requests simultáneos por worker (0 = sin tope). Con workers gevent
+# (SERVING_MODE=async, ver gunicorn.conf.py) cada worker atiende hasta
+# WORKER_CONNECTIONS a la vez: ese es el tope por defecto
+MAX_IN_FLIGHT = env_int(
+    'MAX_IN_FLIGHT', env_int('WORKER_CONNECTIONS', 1000) if os.environ.get('SERVING_MODE') == 'async' else 64
+)
+IN_FLIGHT_RETRY_AFTER = env_int('IN_FLIGHT_RETRY_AFTER', 1)
+# Rutas de observabilidad: deben responder justo cuando hay sobrecarga
+ADMISSION_EXEMPT_PATHS = ('/metrics', '/stats', '/ready')
+
+SHED_TOTAL = Counter('corebank_requests_shed_total', 'Requests rechazados por límites de tasa o de concurrencia', ('reason',))
+
+
+def _take(tokens: float, updated: float, rate: float, burst: float, now: float) -> tuple:
+    """Recarga el bucket y consume un token; devuelve (tokens, segundos a esperar)."""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1.0:
+        return tokens - 1.0, 0.0
+    return tokens, (1.0 - tokens) / rate
+
+
+class LocalBucketStore:
+    """Buckets en un dict del proceso (LRU acotada a `slots` claves)."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens, wait = _take(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.slots:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SharedBucketStore:
+    """
+    Tabla de slots de tamaño fijo en un archivo mmap compartido entre procesos.
+    Cada slot guarda (hash de la clave, tokens, última recarga); si dos claves
+    caen en el mismo slot la nueva lo reinicia con la ráfaga completa.
+    """
+
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, path: str, slots: int):
+        self.slots = max(1, slots)
+        size = self.SLOT.size * self.slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED)
+        # Los locks fcntl no excluyen a hilos del mismo proceso
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        offset = (key_hash % self.slots) * self.SLOT.size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                stored_hash, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                if stored_hash != key_hash:
+                    tokens, updated = burst, now
+                tokens, wait = _take(tokens, updated, rate, burst, now)
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+        return wait
+
+
+class InFlightLimiter:
+    """Cuenta los requests en curso del worker y rechaza los que superan el tope."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.limit > 0 and self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+_store = None
+_store_lock = threading.Lock()
+_in_flight = InFlightLimiter(MAX_IN_FLIGHT)
+
+def get_store():
+    global _store
+    if _store is not None:
+        return _store
+    with _store_lock:
+        if _store is None:
+            if RATE_LIMIT_STORE == 'shared':
+                try:
+                    _store = SharedBucketStore(RATE_LIMIT_SHM_PATH, RATE_LIMIT_SLOTS)
+                except OSError as e:
+                    print(f"Límites de tasa sin memoria compartida ({RATE_LIMIT_SHM_PATH}): {e}")
+            if _store is None:
+                _store = LocalBucketStore(RATE_LIMIT_SLOTS)
+    return _store
+
+def _limit(key: str, rate: float, burst: float, reason: str):
+    """Devuelve la respuesta 429 si el bucket está vacío, o None."""
+    if rate <= 0:
+        return None
+    wait = get_store().take(key, rate, burst, time.time())
+    if wait <= 0:
+        return None
+    SHED_TOTAL.inc(reason)
+    return {"message": "Too many requests"}, 429, {"Retry-After": str(math.ceil(wait))}
+
+def limit_user(user_id: int):
+    return _limit(f"user:{user_id}", RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST, "user_rate")
+
+def limit_login(ip: str):
+    return _limit(f"login:{ip}", RATE_LIMIT_LOGIN_RATE, RATE_LIMIT_LOGIN_BURST, "login_rate")
+
+def _admit():
+    if request.path in ADMISSION_EXEMPT_PATHS:
+        return None
+    if not _in_flight.try_enter():
+        SHED_TOTAL.inc("in_flight")
+        return {"message": "Server busy"}, 503, {"Retry-After": str(IN_FLIGHT_RETRY_AFTER)}
+    g._admitted = True
+    return None
+
+def _release(exc=None):
+    if g.pop('_admitted', False):
+        _in_flight.leave()
+
+def init_ratelimit_app(app):
+    app.before_request(_admit)
+    app.teardown_request(_release)
+
+def ratelimit_stats() -> dict:
+    shed = {labels[0]: value for labels, value in SHED_TOTAL.snapshot()["values"]}
+    return {
+        "store": type(get_store()).__name__,
+        "in_flight": _in_flight.in_flight,
+        "max_in_flight": _in_flight.max_in_flight,
+        "in_flight_limit": _in_flight.limit,
+        "shed": shed,
+    }
@@ -0,0 +1,188 @@
+# app/revocation.py
+# Tokens revocados (logout): chequeo O(1) en memoria, persistidos en
+# bank.revoked_tokens y sincronizados entre workers con LISTEN/NOTIFY.
+import hashlib
+import os
+import threading
+import time
+from .db import get_connection, release_connection, env_int
+from .notify import publish, subscribe
+
+REVOCATION_CHANNEL = 'token_revoked'
+REVOCATION_BLOOM_BITS = env_int('REVOCATION_BLOOM_BITS', 1 << 20)
+REVOCATION_BLOOM_HASHES = env_int('REVOCATION_BLOOM_HASHES', 4)
+REVOCATION_PURGE_BATCH_SIZE = env_int('REVOCATION_PURGE_BATCH_SIZE', 5000)
+
+# Borra un lote de revocados vencidos (revoked_tokens_exp_idx). El try-lock
+# deja que solo un worker purgue la tabla a la vez; el resto se lo salta.
+PURGE_REVOKED_SQL = """
+    DELETE FROM bank.revoked_tokens
+    WHERE jti IN (
+        SELECT jti FROM bank.revoked_tokens WHERE exp < %s LIMIT %s
+    ) AND pg_try_advisory_xact_lock(hashtext('bank.revoked_tokens'))
+"""
+
+
+class BloomFilter:
+    """Filtro de Bloom sobre un bytearray; descarta rápido los tokens no revocados."""
+
+    def __init__(self, num_bits: int, num_hashes: int):
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = max(1, num_hashes)
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RevocationSet:
+    """Bloom filter respaldado por un dict exacto jti -> exp."""
+
+    def __init__(self, num_bits: int, num_hashes: int):
+        self._num_bits = num_bits
+        self._num_hashes = num_hashes
+        self._bloom = BloomFilter(num_bits, num_hashes)
+        self._exact = {}
+        self._lock = threading.Lock()
+
+    def add(self, jti: str, exp: float):
+        with self._lock:
+            self._exact[jti] = exp
+            self._bloom.add(jti)
+
+    def contains(self, jti: str, now: float) -> bool:
+        if jti not in self._bloom:
+            return False
+        with self._lock:
+            exp = self._exact.get(jti)
+            if exp is None:
+                return False
+            if now > exp:
+                del self._exact[jti]
+                return False
+            return True
+
+    def purge(self, now: float) -> int:
+        """Elimina entradas vencidas y reconstruye el filtro (no admite borrados)."""
+        with self._lock:
+            live = {jti: exp for jti, exp in self._exact.items() if exp >= now}
+            removed = len(self._exact) - len(live)
+            bloom = BloomFilter(self._num_bits, self._num_hashes)
+            for jti in live:
+                bloom.add(jti)
+            self._exact, self._bloom = live, bloom
+            return removed
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+
+_revoked = RevocationSet(REVOCATION_BLOOM_BITS, REVOCATION_BLOOM_HASHES)
+_loaded_pid = None
+_load_lock = threading.Lock()
+_purged_rows = 0
+
+def token_id(token: str, payload: dict) -> str:
+    """`jti` del token; los tokens emitidos antes de tenerlo usan su firma."""
+    return payload.get("jti") or token.rsplit('.', 1)[-1]
+
+def _on_notify(message: str):
+    jti, _, exp = message.rpartition(':')
+    _revoked.add(jti, float(exp))
+
+def load_revoked_tokens():
+    """Carga los revocados vigentes desde la base (al iniciar y cada vez que el LISTEN queda activo)."""
+    now = time.time()
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM bank.revoked_tokens WHERE exp < %s", (int(now),))
+        cur.execute("SELECT jti, exp FROM bank.revoked_tokens")
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        cur.close()
+        release_connection(conn)
+    for jti, exp in rows:
+        _revoked.add(jti, float(exp))
+    _revoked.purge(now)
+
+def _ensure_loaded():
+    global _loaded_pid
+    pid = os.getpid()
+    if _loaded_pid == pid:
+        return
+    with _load_lock:
+        if _loaded_pid == pid:
+            return
+        subscribe(REVOCATION_CHANNEL, _on_notify, on_reconnect=load_revoked_tokens)
+        load_revoked_tokens()
+        _loaded_pid = pid
+
+def init_revocation():
+    """Carga los revocados y se suscribe a los avisos (warm-up del worker)."""
+    _ensure_loaded()
+
+def is_revoked(jti: str) -> bool:
+    _ensure_loaded()
+    return _revoked.contains(jti, time.time())
+
+def revoke(jti: str, exp: float):
+    """Revoca el token hasta su expiración y avisa al resto de workers."""
+    _ensure_loaded()
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO bank.revoked_tokens (jti, exp) VALUES (%s, %s)
+            ON CONFLICT (jti) DO NOTHING
+        """, (jti, int(exp)))
+        publish(cur, REVOCATION_CHANNEL, f"{jti}:{int(exp)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+    _revoked.add(jti, float(exp))
+
+def purge_revoked() -> int:
+    """
+    Quita los vencidos de memoria y de bank.revoked_tokens (job de housekeeping);
+    sin esto la tabla solo se limpiaba al arrancar o reconectar un worker.
+    """
+    global _purged_rows
+    now = time.time()
+    removed = _revoked.purge(now)
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute(PURGE_REVOKED_SQL, (int(now), REVOCATION_PURGE_BATCH_SIZE))
+            deleted = cur.rowcount
+            conn.commit()
+            _purged_rows += deleted
+            if deleted < REVOCATION_PURGE_BATCH_SIZE:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+    return removed
+
+def revocation_stats() -> dict:
+    return {"revoked": len(_revoked), "purged_rows": _purged_rows}
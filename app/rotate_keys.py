@@ -0,0 +1,134 @@
+# app/rotate_keys.py
+# Re-cifrado masivo de bank_secure.encrypted_cards con la clave activa.
+#
+# Procedimiento de rotación:
+#   1. Desplegar con FERNET_KEYS="<nueva>,<anterior>" (la app ya cifra con la nueva).
+#   2. Ejecutar: python -m app.rotate_keys
+#   3. Al terminar, quitar la clave anterior de FERNET_KEYS.
+#
+# El job lee la tabla en orden de id con un cursor del lado del servidor, reparte
+# el trabajo criptográfico en un pool de procesos y escribe con UPDATE por lotes.
+# Tras cada lote guarda el último id procesado para poder reanudar. El checkpoint
+# lleva la huella de FERNET_KEYS: con otro juego de claves se empieza desde el
+# principio, y al terminar la tabla se borra (solo reanuda una corrida cortada).
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from psycopg2.extras import execute_values
+from .db import new_connection
+from .utils import key_fingerprint, rotate_encrypted
+
+UPDATE_CARDS_SQL = """
+    UPDATE bank_secure.encrypted_cards AS c SET
+        encrypted_card_number = v.card_number,
+        encrypted_expiry_date = v.expiry_date,
+        encrypted_cvv = v.cvv
+    FROM (VALUES %s) AS v(id, card_number, expiry_date, cvv)
+    WHERE c.id = v.id
+"""
+
+def _rotate_chunk(rows: list) -> list:
+    """Se ejecuta en los procesos del pool."""
+    return [
+        (card_id, rotate_encrypted(number), rotate_encrypted(expiry), rotate_encrypted(cvv))
+        for card_id, number, expiry, cvv in rows
+    ]
+
+def load_checkpoint(path: str, fingerprint: str) -> dict:
+    try:
+        with open(path, encoding='utf-8') as fh:
+            checkpoint = json.load(fh)
+    except FileNotFoundError:
+        return {"last_id": 0, "rows": 0, "keys": fingerprint}
+    if checkpoint.get("keys") != fingerprint:
+        # Checkpoint de una rotación con otras claves: reanudarlo saltaría tarjetas
+        print(f"El checkpoint {path} es de otro juego de claves; se empieza desde el principio")
+        return {"last_id": 0, "rows": 0, "keys": fingerprint}
+    return checkpoint
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(checkpoint, fh)
+    os.replace(tmp_path, path)
+
+def rotate_cards(chunk_size: int, workers: int, checkpoint_path: str) -> dict:
+    fingerprint = key_fingerprint()
+    checkpoint = load_checkpoint(checkpoint_path, fingerprint)
+    start_id = checkpoint["last_id"]
+    processed = 0
+    start = time.monotonic()
+
+    read_conn = new_connection()
+    write_conn = new_connection()
+    try:
+        cur = read_conn.cursor(name='encrypted_cards_rotation')
+        cur.itersize = chunk_size
+        cur.execute("""
+            SELECT id, encrypted_card_number, encrypted_expiry_date, encrypted_cvv
+            FROM bank_secure.encrypted_cards
+            WHERE id > %s
+            ORDER BY id
+        """, (start_id,))
+        write_cur = write_conn.cursor()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            exhausted = False
+            while in_flight or not exhausted:
+                # Mantiene a todos los procesos ocupados mientras se escriben lotes anteriores
+                while not exhausted and len(in_flight) < workers * 2:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        exhausted = True
+                        break
+                    in_flight.append(executor.submit(_rotate_chunk, rows))
+                if not in_flight:
+                    break
+                # Los lotes se escriben en orden para que el checkpoint sea monótono
+                rotated = in_flight.popleft().result()
+                execute_values(write_cur, UPDATE_CARDS_SQL, rotated, page_size=len(rotated))
+                write_conn.commit()
+
+                processed += len(rotated)
+                checkpoint = {"last_id": rotated[-1][0], "rows": checkpoint["rows"] + len(rotated),
+                              "keys": fingerprint}
+                save_checkpoint(checkpoint_path, checkpoint)
+                elapsed = time.monotonic() - start
+                print(f"{processed} filas re-cifradas (último id {checkpoint['last_id']}), "
+                      f"{processed / elapsed:.0f} filas/s")
+        cur.close()
+        write_cur.close()
+        # Tabla completa: la próxima corrida es una rotación nueva, no una reanudación
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+    elapsed = time.monotonic() - start
+    return {
+        "rows": processed,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(processed / elapsed, 1) if elapsed > 0 else None,
+        "last_id": checkpoint["last_id"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-cifra bank_secure.encrypted_cards con la clave activa de FERNET_KEYS.")
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Filas por lote')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Procesos de cifrado')
+    parser.add_argument('--checkpoint', default='rotate_keys.checkpoint.json', help='Archivo de checkpoint')
+    parser.add_argument('--restart', action='store_true', help='Ignora el checkpoint y empieza desde el principio')
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    summary = rotate_cards(args.chunk_size, max(1, args.workers), args.checkpoint)
+    print(json.dumps(summary))
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,68 @@
+import csv
+import hashlib
+import heapq
 import os
 import random
 import string
+import threading
+import time
+from bisect import bisect_right
 from datetime import datetime, timedelta
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
+from .metrics import CRYPTO_SECONDS
 
 # --- Manejo de Encriptación ---
-key = os.environ.get('FERNET_KEY')
-if not key:
-    key = Fernet.generate_key().decode()
-    print(f"ATENCION: No se encontró FERNET_KEY. Usando una clave generada: {key}")
-    print("Por favor, configura esta variable de entorno en tu docker-compose.yml.")
-cipher_suite = Fernet(key.encode())
+# FERNET_KEYS admite varias claves separadas por comas para rotarlas: la
+# primera cifra y todas descifran. Sin ella se usa la clave única FERNET_KEY.
+# El cifrador se construye una sola vez (en create_app o al primer uso).
+_cipher_suite = None
+_cipher_lock = threading.Lock()
+
+def _configured_keys() -> list:
+    keys = [k.strip() for k in os.environ.get('FERNET_KEYS', '').split(',') if k.strip()]
+    if not keys and os.environ.get('FERNET_KEY'):
+        keys = [os.environ['FERNET_KEY']]
+    return keys
+
+def key_fingerprint() -> str:
+    """Huella (sin revelar las claves) del juego de claves configurado."""
+    return hashlib.sha256(",".join(_configured_keys()).encode()).hexdigest()[:16]
+
+def load_cipher() -> MultiFernet:
+    global _cipher_suite
+    if _cipher_suite is not None:
+        return _cipher_suite
+    with _cipher_lock:
+        if _cipher_suite is None:
+            keys = _configured_keys()
+            if not keys:
+                key = Fernet.generate_key().decode()
+                print(f"ATENCION: No se encontró FERNET_KEY. Usando una clave generada: {key}")
+                print("Por favor, configura esta variable de entorno en tu docker-compose.yml.")
+                keys = [key]
+            _cipher_suite = MultiFernet([Fernet(k.encode()) for k in keys])
+    return _cipher_suite
 
 def encrypt_data(data: str) -> str:
     """Se cifra un texto plano usando Fernet."""
     if not data:
         return ""
-    return cipher_suite.encrypt(data.encode()).decode()
+    start = time.perf_counter()
+    token = load_cipher().encrypt(data.encode()).decode()
+    CRYPTO_SECONDS.observe(time.perf_counter() - start, "encrypt")
+    return token
+
+def decrypt_data(token: str) -> str:
+    """Se descifra un texto cifrado con cualquiera de las claves configuradas."""
+    if not token:
+        return ""
+    return load_cipher().decrypt(token.encode()).decode()
+
+def rotate_encrypted(token: str) -> str:
+    """Se vuelve a cifrar con la clave activa (la primera de FERNET_KEYS)."""
+    if not token:
+        return ""
+    return load_cipher().rotate(token.encode()).decode()
 
 # --- Algoritmo de Luhn para validar tarjetas ---
 def is_luhn_valid(card_number: str) -> bool:
@@ -36,6 +82,156 @@ def is_luhn_valid(card_number: str) -> bool:
         s += d
     return s % 10 == 0
 
+# --- Validación de tarjetas por lotes (onboarding de comercios, liquidaciones) ---
+# NumPy se importa al usarse: los workers web no pagan su import.
+LUHN_BATCH_CHUNK = 100_000
+# Valor de un dígito duplicado en Luhn (2*d, restando 9 si pasa de 9)
+LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+def _digit_matrix(card_numbers: list):
+    """
+    Matriz (n, ancho) de dígitos uint8 alineados a la izquierda (relleno en 0),
+    más la longitud de cada número y si todos sus caracteres son dígitos ASCII.
+    """
+    import numpy as np
+    n = len(card_numbers)
+    codes = np.array(card_numbers, dtype=str)
+    width = max(codes.dtype.itemsize // 4, 1)
+    digits = codes.view(np.uint32).reshape(n, width) - 48  # unsigned: no dígitos y relleno quedan > 9
+    is_digit = digits <= 9
+    lengths = np.fromiter(map(len, card_numbers), dtype=np.int64, count=n)
+    all_digits = (np.count_nonzero(is_digit, axis=1) == lengths) & (lengths > 0)
+    digits = np.where(is_digit, digits, 0).astype(np.uint8)
+    return digits, lengths, all_digits
+
+def luhn_valid_batch(card_numbers, chunk_size: int = LUHN_BATCH_CHUNK):
+    """
+    is_luhn_valid sobre una secuencia de números, vectorizado con NumPy por
+    bloques de `chunk_size`. Devuelve un array de bool en el mismo orden; solo
+    acepta dígitos ASCII.
+    """
+    import numpy as np
+    card_numbers = list(card_numbers)
+    result = np.zeros(len(card_numbers), dtype=bool)
+    doubled_value = np.array(LUHN_DOUBLED, dtype=np.uint8)
+    for start in range(0, len(card_numbers), chunk_size):
+        chunk = card_numbers[start:start + chunk_size]
+        digits, lengths, all_digits = _digit_matrix(chunk)
+        doubled = doubled_value[digits]
+        # Misma paridad que is_luhn_valid: se duplican las posiciones i con
+        # i % 2 == (n - 1) % 2, es decir, las pares o las impares según la longitud
+        even_doubled = doubled[:, 0::2].sum(axis=1, dtype=np.int64) + digits[:, 1::2].sum(axis=1, dtype=np.int64)
+        odd_doubled = doubled[:, 1::2].sum(axis=1, dtype=np.int64) + digits[:, 0::2].sum(axis=1, dtype=np.int64)
+        total = np.where((lengths - 1) % 2 == 0, even_doubled, odd_doubled)
+        result[start:start + len(chunk)] = all_digits & (total % 10 == 0)
+    return result
+
+# --- Índice de rangos BIN (prefijo de la tarjeta -> red / emisor) ---
+# Rangos de las redes; los de emisores se cargan con BinRangeIndex.from_csv
+NETWORK_BIN_RANGES = [
+    ("4", "4", "visa", None),
+    ("51", "55", "mastercard", None),
+    ("2221", "2720", "mastercard", None),
+    ("34", "34", "amex", None),
+    ("37", "37", "amex", None),
+    ("300", "305", "diners", None),
+    ("36", "36", "diners", None),
+    ("6011", "6011", "discover", None),
+    ("644", "649", "discover", None),
+    ("65", "65", "discover", None),
+    ("3528", "3589", "jcb", None),
+    ("62", "62", "unionpay", None),
+]
+
+class BinRangeIndex:
+    """
+    Rangos de prefijos (BIN) -> (red, emisor) en arrays ordenados: búsqueda
+    O(log n) con bisect. Los prefijos se normalizan a BIN_WIDTH dígitos; si
+    los rangos se anidan, gana el más específico.
+    """
+
+    BIN_WIDTH = 8
+
+    def __init__(self, ranges):
+        """`ranges`: iterable de (prefijo_desde, prefijo_hasta, red, emisor)."""
+        spans = []
+        for low, high, network, issuer in ranges:
+            start = int(str(low)[:self.BIN_WIDTH].ljust(self.BIN_WIDTH, '0'))
+            end = int(str(high)[:self.BIN_WIDTH].ljust(self.BIN_WIDTH, '9'))
+            if start > end:
+                raise ValueError(f"Rango BIN inválido: {low}-{high}")
+            spans.append((start, end, (network, issuer)))
+        self.starts, self.ends, self.labels = self._flatten(spans)
+
+    @staticmethod
+    def _flatten(spans: list) -> tuple:
+        """Intervalos disjuntos ordenados, cada uno con el rango más angosto que lo cubre."""
+        spans.sort(key=lambda span: span[0])
+        bounds = sorted({span[0] for span in spans} | {span[1] + 1 for span in spans})
+        starts, ends, labels = [], [], []
+        active = []  # heap (ancho, orden, fin, etiqueta)
+        i = 0
+        for lo, next_lo in zip(bounds, bounds[1:]):
+            while i < len(spans) and spans[i][0] <= lo:
+                start, end, label = spans[i]
+                heapq.heappush(active, (end - start, i, end, label))
+                i += 1
+            while active and active[0][2] < lo:
+                heapq.heappop(active)
+            if not active:
+                continue
+            label = active[0][3]
+            if labels and labels[-1] == label and ends[-1] == lo - 1:
+                ends[-1] = next_lo - 1
+            else:
+                starts.append(lo)
+                ends.append(next_lo - 1)
+                labels.append(label)
+        return starts, ends, labels
+
+    @classmethod
+    def from_csv(cls, path: str) -> "BinRangeIndex":
+        """CSV con columnas low,high,network,issuer (más NETWORK_BIN_RANGES como base)."""
+        with open(path, newline='', encoding='utf-8') as fh:
+            rows = [(row['low'], row['high'], row['network'], row.get('issuer') or None)
+                    for row in csv.DictReader(fh)]
+        return cls(NETWORK_BIN_RANGES + rows)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _key(self, card_number: str) -> int | None:
+        if not (card_number.isascii() and card_number.isdigit()):
+            return None
+        return int(card_number[:self.BIN_WIDTH].ljust(self.BIN_WIDTH, '0'))
+
+    def lookup(self, card_number: str) -> tuple | None:
+        """(red, emisor) del número, o None si ningún rango lo cubre."""
+        key = self._key(card_number)
+        if key is None:
+            return None
+        i = bisect_right(self.starts, key) - 1
+        if i >= 0 and key <= self.ends[i]:
+            return self.labels[i]
+        return None
+
+    def lookup_batch(self, card_numbers):
+        """
+        Versión vectorizada de lookup: array de índices en `self.labels`
+        (-1 si ningún rango cubre el número).
+        """
+        import numpy as np
+        card_numbers = list(card_numbers)
+        digits, lengths, all_digits = _digit_matrix(card_numbers)
+        width = min(self.BIN_WIDTH, digits.shape[1])
+        weights = 10 ** np.arange(self.BIN_WIDTH - 1, self.BIN_WIDTH - 1 - width, -1, dtype=np.int64)
+        keys = digits[:, :width].astype(np.int64) @ weights
+        starts = np.asarray(self.starts, dtype=np.int64)
+        ends = np.asarray(self.ends, dtype=np.int64)
+        idx = np.searchsorted(starts, keys, side='right') - 1
+        hit = all_digits & (idx >= 0) & (keys <= ends[np.maximum(idx, 0)])
+        return np.where(hit, idx, -1)
+
 #-- funciones para OTP --
 def generate_otp(length: int = 6) -> str:
     return ''.join(random.choices(string.digits, k=length))
@@ -0,0 +1,419 @@
+"""
+Benchmark de endpoints contra un Postgres local desechable.
+
+Levanta la app de app/main.py en un servidor HTTP en proceso, crea usuarios
+de prueba y ejecuta cada escenario con la concurrencia indicada. Por escenario
+reporta throughput, latencias p50/p95/p99 y round trips a Postgres por request,
+y guarda los resultados en JSON para comparar corridas:
+
+    # Postgres desechable (requiere initdb/pg_ctl en el PATH o --pg-bin)
+    python bench/load_test.py --throwaway-pg --concurrency 8 --requests 500 -o results.json
+
+    # Contra una base existente (variables POSTGRES_*) y comparando con una corrida anterior
+    python bench/load_test.py --baseline results.json --max-regression 0.15
+
+Los round trips se cuentan en el pool de la app e incluyen los lotes del
+escritor de logs; en credit-payment incluyen también el generate-otp previo
+(la latencia de ese paso no se mide).
+
+`credit-payment-legacy` (fuera de la lista por defecto) repite la secuencia de
+sentencias que tenía la compra a crédito antes de bank.credit_purchase, montada
+en una ruta del benchmark, para comparar con `credit-payment`:
+
+    python bench/load_test.py --scenarios credit-payment-legacy,credit-payment
+
+Con --baseline el proceso termina con código 1 si algún escenario tiene
+respuestas que no son 200 o requests que no se completaron (un worker que
+lanza una excepción), si empeora más que --max-regression en p99 o
+throughput, o si hace más round trips por request.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["login", "generate-otp", "deposit", "deposit-shared", "deposit-hot", "withdraw", "transfer",
+             "credit-payment", "pay-credit-balance"]
+BENCH_PASSWORD = "bench-pass"
+# Escenario -> usuario dueño de la cuenta que comparten todos los clientes
+SHARED_ACCOUNTS = {"deposit-shared": "bench-target0", "deposit-hot": "bench-target1"}
+# Número válido para is_luhn_valid (el ejemplo del Swagger)
+BENCH_CARD = "499273987160"
+LEGACY_CREDIT_PAYMENT_PATH = "/bench/credit-payment-legacy"
+PREPARED_SCENARIOS = {"credit-payment": "/bank/credit-payment", "credit-payment-legacy": LEGACY_CREDIT_PAYMENT_PATH}
+
+
+def start_throwaway_postgres(pg_bin: str | None) -> tuple[str, callable]:
+    """Crea un cluster temporal que escucha solo en un socket unix; devuelve (host, stop)."""
+    def tool(name):
+        return os.path.join(pg_bin, name) if pg_bin else shutil.which(name) or name
+
+    data_dir = tempfile.mkdtemp(prefix="bench-pg-")
+    subprocess.run([tool("initdb"), "-D", data_dir, "-U", "postgres", "-A", "trust"],
+                   check=True, stdout=subprocess.DEVNULL)
+    options = f"-k {data_dir} -c listen_addresses='' -c fsync=off"
+    subprocess.run([tool("pg_ctl"), "-D", data_dir, "-o", options, "-w", "-l",
+                    os.path.join(data_dir, "server.log"), "start"], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([tool("createdb"), "-h", data_dir, "-U", "postgres", "corebank"], check=True)
+
+    def stop():
+        subprocess.run([tool("pg_ctl"), "-D", data_dir, "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return data_dir, stop
+
+
+class Client:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def post(self, path: str, body: dict, token: str | None = None) -> tuple[int, dict]:
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        req = urllib.request.Request(self.base_url + path, data=json.dumps(body).encode(), headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                return resp.status, json.loads(resp.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b"{}")
+
+
+def create_bench_users(count: int, prefix: str = "bench") -> list[str]:
+    """Usuarios con saldo y cupo amplios para que ninguna operación falle por fondos."""
+    from app.db import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    cur = conn.cursor()
+    usernames = [f"{prefix}{i}" for i in range(count)]
+    for username in usernames:
+        cur.execute("""
+            INSERT INTO bank.users (username, password, role, full_name, email)
+            VALUES (%s, %s, 'cliente', %s, %s)
+            ON CONFLICT (username) DO NOTHING
+            RETURNING id
+        """, (username, BENCH_PASSWORD, username, f"{username}@example.com"))
+        row = cur.fetchone()
+        if row:
+            cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (1000000000, %s)", (row[0],))
+            cur.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (1000000000, 0, %s)", (row[0],))
+        else:
+            cur.execute("""
+                UPDATE bank.accounts SET balance = 1000000000
+                WHERE user_id = (SELECT id FROM bank.users WHERE username = %s)
+            """, (username,))
+    conn.commit()
+    cur.close()
+    pool.putconn(conn)
+    return usernames
+
+
+class Scenario:
+    """Prepara y ejecuta una request de un escenario para un usuario de prueba."""
+
+    def __init__(self, name: str, client: Client, users: list[str], tokens: dict, accounts: dict):
+        self.name = name
+        self.client = client
+        self.users = users
+        self.tokens = tokens
+        self.accounts = accounts
+
+    def run(self, worker: int) -> int:
+        username = self.users[worker % len(self.users)]
+        token = self.tokens[username]
+        if self.name == "login":
+            return self.client.post("/auth/login", {"username": username, "password": BENCH_PASSWORD})[0]
+        if self.name == "generate-otp":
+            return self.client.post("/auth/generate-otp", {}, token)[0]
+        if self.name == "deposit":
+            return self.client.post("/bank/deposit", {"account_number": self.accounts[username], "amount": 1}, token)[0]
+        if self.name in SHARED_ACCOUNTS:
+            # Todos depositan en la misma cuenta (normal o caliente): mide la contención
+            account = self.accounts[SHARED_ACCOUNTS[self.name]]
+            return self.client.post("/bank/deposit", {"account_number": account, "amount": 1}, token)[0]
+        if self.name == "withdraw":
+            return self.client.post("/bank/withdraw", {"amount": 1}, token)[0]
+        if self.name == "transfer":
+            target = self.users[(worker + 1) % len(self.users)]
+            return self.client.post("/bank/transfer", {"target_username": target, "amount": 1}, token)[0]
+        if self.name == "pay-credit-balance":
+            return self.client.post("/bank/pay-credit-balance", {"amount": 1}, token)[0]
+        if self.name in PREPARED_SCENARIOS:
+            raise RuntimeError(f"{self.name} se mide con prepare()/run_prepared()")
+        raise ValueError(self.name)
+
+    def prepare(self, worker: int):
+        """credit-payment necesita un OTP nuevo por compra; se genera fuera del tiempo medido."""
+        username = self.users[worker % len(self.users)]
+        status, body = self.client.post("/auth/generate-otp", {}, self.tokens[username])
+        return username, body.get("otp")
+
+    def run_prepared(self, prepared) -> int:
+        username, otp = prepared
+        return self.client.post(PREPARED_SCENARIOS[self.name], {
+            "amount": 1,
+            "card_number": BENCH_CARD,
+            "expiry_date": "12/28",
+            "cvv": "123",
+            "otp_code": otp,
+            "establishment_id": 1
+        }, self.tokens[username])[0]
+
+
+def register_legacy_credit_payment(app):
+    """
+    La compra a crédito como era antes de bank.credit_purchase: OTP en otra
+    conexión, establecimiento, tarjeta, saldo, dos UPDATE y dos relecturas.
+    """
+    from flask import g, request
+    from werkzeug.exceptions import HTTPException
+    from flask_restx import Resource
+    from app.main import api, token_required, credit_payment_model
+    from app.idempotency import idempotent
+    from app.db import get_connection, release_connection, get_pool, CONSUME_OTP_SQL
+    from app.utils import encrypt_data, is_luhn_valid
+    from app.logger import write_log
+    from datetime import datetime
+
+    def validate_otp(user_id, code):
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute(CONSUME_OTP_SQL, (user_id, code, datetime.utcnow()))
+            valid = cur.fetchone() is not None
+            conn.commit()
+            cur.close()
+        finally:
+            pool.putconn(conn)
+        return valid
+
+    def legacy_credit_payment():
+        ip = request.remote_addr or "unknown"
+        data = api.payload
+        amount = data.get("amount", 0)
+        card_number = data.get("card_number")
+        if amount <= 0 or not is_luhn_valid(card_number):
+            api.abort(400, "Invalid purchase")
+        user_id = g.user['id']
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            if not validate_otp(user_id, data.get("otp_code")):
+                api.abort(400, "OTP inválido o expirado")
+            cur.execute("SELECT id FROM bank.establecimientos WHERE id = %s", (data.get("establishment_id"),))
+            if not cur.fetchone():
+                api.abort(400, "Establecimiento no válido o no registrado")
+            cur.execute("SELECT id FROM bank_secure.encrypted_cards WHERE user_id = %s AND card_last_4_digits = %s",
+                        (user_id, card_number[-4:]))
+            if not cur.fetchone():
+                cur.execute("""
+                    INSERT INTO bank_secure.encrypted_cards (user_id, encrypted_card_number, encrypted_expiry_date, encrypted_cvv, card_last_4_digits)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (user_id, encrypt_data(card_number), encrypt_data(data['expiry_date']), encrypt_data(data['cvv']), card_number[-4:]))
+            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
+            if float(cur.fetchone()[0]) < amount:
+                api.abort(400, "Fondos insuficientes en la cuenta")
+            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (amount, user_id))
+            cur.execute("UPDATE bank.credit_cards SET balance = balance + %s WHERE user_id = %s", (amount, user_id))
+            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
+            new_account_balance = float(cur.fetchone()[0])
+            cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
+            new_credit_balance = float(cur.fetchone()[0])
+            conn.commit()
+            write_log("INFO", ip, g.user["username"], f"Compra a crédito por ${amount}", 200)
+        except HTTPException:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            release_connection(conn)
+        return {"account_balance": new_account_balance, "credit_card_debt": new_credit_balance}
+
+    # Mismo recorrido que /bank/credit-payment (validación del modelo, token,
+    # idempotencia): solo cambia el cuerpo del handler
+    class LegacyCreditPayment(Resource):
+        @api.expect(credit_payment_model, validate=True)
+        @token_required
+        @idempotent
+        def post(self):
+            return legacy_credit_payment()
+
+    api.add_resource(LegacyCreditPayment, LEGACY_CREDIT_PAYMENT_PATH)
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(scenario: Scenario, concurrency: int, requests: int) -> dict:
+    from app.db import db_round_trips
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker(worker_id: int):
+        nonlocal errors
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            prepared = scenario.prepare(worker_id) if scenario.name in PREPARED_SCENARIOS else None
+            start = time.perf_counter()
+            status = scenario.run_prepared(prepared) if prepared else scenario.run(worker_id)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != 200:
+                    errors += 1
+
+    trips_before = db_round_trips()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker, worker_id) for worker_id in range(concurrency)]
+    wall = time.perf_counter() - start
+    trips = db_round_trips() - trips_before
+
+    # Un worker que lanza una excepción deja de pedir: su request y las que no
+    # llegó a hacer cuentan como errores, así la corrida no pasa por tener menos requests
+    exceptions = 0
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            exceptions += 1
+            print(f"{scenario.name}: worker abortado: {e!r}")
+    errors += requests - len(latencies)
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "exceptions": exceptions,
+        "seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "db_round_trips_per_request": round(trips / len(latencies), 2) if latencies else 0.0,
+    }
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    failures = []
+    for name, current in results["scenarios"].items():
+        # Una corrida con errores es rápida y barata: se rechaza antes de mirar latencias
+        error_rate = current["errors"] / current["requests"] if current["requests"] else 1.0
+        if error_rate > 0:
+            base = baseline.get("scenarios", {}).get(name) or {}
+            base_rate = base["errors"] / base["requests"] if base.get("requests") else 0.0
+            failures.append(f"{name}: {current['errors']} errores ({error_rate:.1%}, base {base_rate:.1%})")
+            continue
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        if current["p99_ms"] > base["p99_ms"] * (1 + max_regression):
+            failures.append(f"{name}: p99 {current['p99_ms']}ms > {base['p99_ms']}ms (+{max_regression:.0%})")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - max_regression):
+            failures.append(f"{name}: throughput {current['throughput_rps']} < {base['throughput_rps']} (-{max_regression:.0%})")
+        if current["db_round_trips_per_request"] > base["db_round_trips_per_request"] + 0.5:
+            failures.append(f"{name}: round trips {current['db_round_trips_per_request']} > {base['db_round_trips_per_request']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="Requests por escenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--throwaway-pg", action="store_true", help="Crea un Postgres temporal con initdb")
+    parser.add_argument("--pg-bin", help="Directorio con initdb/pg_ctl/createdb")
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="Resultados anteriores contra los que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    stop_pg = None
+    if args.throwaway_pg:
+        host, stop_pg = start_throwaway_postgres(args.pg_bin)
+        os.environ.update({"POSTGRES_HOST": host, "POSTGRES_DB": "corebank", "POSTGRES_USER": "postgres"})
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+    os.environ.setdefault("DB_POOL_MAX", str(max(10, args.concurrency * 2)))
+    # El benchmark mide la app, no los límites de tasa ni el tope de concurrencia
+    os.environ.setdefault("RATE_LIMIT_USER_RATE", "0")
+    os.environ.setdefault("RATE_LIMIT_LOGIN_RATE", "0")
+    os.environ.setdefault("MAX_IN_FLIGHT", "0")
+
+    try:
+        sys.path.insert(0, ROOT)
+        from werkzeug.serving import make_server
+        from app.main import app
+
+        register_legacy_credit_payment(app)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = Client(f"http://127.0.0.1:{server.server_port}")
+
+        # La primera request migra el esquema si hace falta
+        client.post("/auth/login", {"username": "user1", "password": "pass1"})
+        users = create_bench_users(max(2, args.concurrency))
+        targets = create_bench_users(2, prefix="bench-target")
+        tokens = {u: client.post("/auth/login", {"username": u, "password": BENCH_PASSWORD})[1]["token"] for u in users}
+        from app.db import get_pool
+        conn = get_pool().getconn()
+        cur = conn.cursor()
+        cur.execute("SELECT u.username, a.id FROM bank.accounts a JOIN bank.users u ON u.id = a.user_id WHERE u.username = ANY(%s)",
+                    (users + targets,))
+        accounts = dict(cur.fetchall())
+        cur.execute("UPDATE bank.accounts SET hot = (id = %s) WHERE id = ANY(%s)",
+                    (accounts[SHARED_ACCOUNTS["deposit-hot"]], [accounts[t] for t in targets]))
+        conn.commit()
+        get_pool().putconn(conn)
+
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "concurrency": args.concurrency,
+                "requests_per_scenario": args.requests,
+                "python": sys.version.split()[0],
+            },
+            "scenarios": {},
+        }
+        for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+            scenario = Scenario(name, client, users, tokens, accounts)
+            results["scenarios"][name] = run_scenario(scenario, args.concurrency, args.requests)
+            print(name, json.dumps(results["scenarios"][name]))
+        server.shutdown()
+    finally:
+        if stop_pg:
+            stop_pg()
+
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(results, fh, indent=2)
+    print(f"Resultados guardados en {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            failures = compare(results, json.load(fh), args.max_regression)
+        for failure in failures:
+            print(f"REGRESION {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
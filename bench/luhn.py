@@ -0,0 +1,95 @@
+"""
+Benchmark de validación de tarjetas por lotes: is_luhn_valid (uno por uno)
+contra luhn_valid_batch (NumPy), y BinRangeIndex.lookup contra lookup_batch.
+Verifica además que ambas versiones den el mismo resultado.
+
+    python bench/luhn.py --cards 1000000 --bin-ranges 50000 -o luhn_results.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_cards(n: int, rng: random.Random) -> list[str]:
+    """Números de 13 a 19 dígitos con prefijos de redes reales y ~1% de basura."""
+    prefixes = ["4", "51", "55", "2221", "34", "37", "6011", "65", "3528", "62", "9"]
+    cards = []
+    for _ in range(n):
+        prefix = rng.choice(prefixes)
+        length = rng.randint(13, 19)
+        card = prefix + "".join(rng.choices("0123456789", k=length - len(prefix)))
+        if rng.random() < 0.01:
+            card = card[:6] + "-" + card[7:]
+        cards.append(card)
+    return cards
+
+
+def make_bin_ranges(n: int, rng: random.Random) -> list[tuple]:
+    """Rangos de emisor de 6 y 8 dígitos dentro de las redes."""
+    ranges = []
+    for i in range(n):
+        start = rng.randint(40000000, 55999999) // 100 * 100
+        width = rng.choice((1, 10, 100))
+        ranges.append((str(start).zfill(8), str(start + width - 1).zfill(8), "visa" if start < 50000000 else "mastercard", f"emisor-{i}"))
+    return ranges
+
+
+def timed(fn) -> tuple:
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=1_000_000)
+    parser.add_argument("--bin-ranges", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("-o", "--output", default="luhn_results.json")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from app.utils import is_luhn_valid, luhn_valid_batch, BinRangeIndex, NETWORK_BIN_RANGES
+
+    rng = random.Random(args.seed)
+    cards = make_cards(args.cards, rng)
+    results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "cards": args.cards,
+                        "bin_ranges": args.bin_ranges, "python": sys.version.split()[0]}}
+
+    scalar, scalar_s = timed(lambda: [is_luhn_valid(card) for card in cards])
+    batch, batch_s = timed(lambda: luhn_valid_batch(cards))
+    assert batch.tolist() == scalar, "luhn_valid_batch difiere de is_luhn_valid"
+    results["luhn"] = {
+        "scalar_cards_per_s": round(args.cards / scalar_s),
+        "batch_cards_per_s": round(args.cards / batch_s),
+        "speedup": round(scalar_s / batch_s, 2),
+        "valid": int(batch.sum()),
+    }
+    print("luhn", json.dumps(results["luhn"]))
+
+    index, build_s = timed(lambda: BinRangeIndex(NETWORK_BIN_RANGES + make_bin_ranges(args.bin_ranges, rng)))
+    scalar, scalar_s = timed(lambda: [index.lookup(card) for card in cards])
+    batch, batch_s = timed(lambda: index.lookup_batch(cards))
+    assert [index.labels[i] if i >= 0 else None for i in batch.tolist()] == scalar, "lookup_batch difiere de lookup"
+    results["bin_index"] = {
+        "intervals": len(index),
+        "build_ms": round(build_s * 1000, 3),
+        "scalar_lookups_per_s": round(args.cards / scalar_s),
+        "batch_lookups_per_s": round(args.cards / batch_s),
+        "speedup": round(scalar_s / batch_s, 2),
+        "matched": int((batch >= 0).sum()),
+    }
+    print("bin_index", json.dumps(results["bin_index"]))
+
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(results, fh, indent=2)
+    print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Chequeo de planes: siembra datos de volumen en una transacción (que se
+deshace al final), corre ANALYZE y revisa con EXPLAIN que las consultas
+calientes usen su índice. Falla (exit 1) si algún plan tiene un Seq Scan o
+no usa el índice esperado:
+
+    login        bank.users por username             users_username_key
+    otp          consumo del OTP                     otp_codes_unused_idx
+    balance      saldo y deuda por user_id           accounts_user_id_idx, credit_cards_user_id_idx
+    account      débito de la cuenta por user_id     accounts_user_id_idx
+    credit-card  cargo a la tarjeta por user_id      credit_cards_user_id_idx
+    stored-card  tarjeta guardada por últimos 4      encrypted_cards_user_last4_idx
+    statement    página del extracto por keyset      transactions_account_created_idx
+    logs         rango de timestamp de app_logs      app_logs_p*_timestamp_idx
+
+account, credit-card y stored-card son sentencias de bank.credit_purchase y
+bank.pay_credit_balance: EXPLAIN no entra en las funciones plpgsql, así que se
+revisan copias de esas sentencias.
+
+    python bench/plans.py --throwaway-pg
+    python bench/plans.py --users 50000 --transactions 500000
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+INDEX_NODES = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+# Copias de las sentencias por user_id de bank.credit_purchase (app/db.py)
+ACCOUNT_DEBIT_SQL = "UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s RETURNING balance, id"
+CREDIT_CARD_CHARGE_SQL = "UPDATE bank.credit_cards SET balance = balance + %s WHERE user_id = %s RETURNING balance"
+STORED_CARD_SQL = """
+    SELECT 1 FROM bank_secure.encrypted_cards ec
+    WHERE ec.user_id = %s AND ec.card_last_4_digits = %s
+"""
+
+
+def seed(cur, args, month: datetime):
+    """Carga usuarios, cuentas, tarjetas, movimientos, OTPs y logs con prefijo 'plan'."""
+    cur.execute("""
+        INSERT INTO bank.users (username, password, role, full_name, email)
+        SELECT 'plan' || g, 'x', 'cliente', 'Plan ' || g, 'plan' || g || '@example.com'
+        FROM generate_series(1, %s) AS g
+    """, (args.users,))
+    cur.execute("""
+        INSERT INTO bank.accounts (balance, user_id)
+        SELECT 1000, id FROM bank.users WHERE username LIKE 'plan%%'
+    """)
+    cur.execute("""
+        INSERT INTO bank.credit_cards (limit_credit, balance, user_id)
+        SELECT 5000, 0, id FROM bank.users WHERE username LIKE 'plan%%'
+    """)
+    # Varias tarjetas guardadas por usuario; el cifrado no cambia el plan
+    cur.execute("""
+        INSERT INTO bank_secure.encrypted_cards
+            (user_id, encrypted_card_number, encrypted_expiry_date, encrypted_cvv, card_last_4_digits)
+        SELECT u.id, 'x', 'x', 'x', lpad((u.id * 7 + g)::TEXT, 4, '0')
+        FROM bank.users u, generate_series(1, %s) AS g
+        WHERE u.username LIKE 'plan%%'
+    """, (args.cards_per_user,))
+    cur.execute("SELECT min(a.id), max(a.id) FROM bank.accounts a JOIN bank.users u ON u.id = a.user_id "
+                "WHERE u.username LIKE 'plan%%'")
+    first, last = cur.fetchone()
+    cur.execute("""
+        INSERT INTO bank.transactions (account_id, kind, amount, counterparty_account_id, description, created_at)
+        SELECT %s + g %% (%s - %s + 1), 'deposit', 10, NULL, 'plan', NOW() - g * INTERVAL '1 second'
+        FROM generate_series(1, %s) AS g
+    """, (first, last, first, args.transactions))
+    cur.execute("""
+        INSERT INTO bank.otp_codes (user_id, code, expires_at, used)
+        SELECT a.user_id, lpad((g %% 1000000)::TEXT, 6, '0'), NOW() + (g %% 600) * INTERVAL '1 second', g %% 4 <> 0
+        FROM generate_series(1, %s) AS g
+        JOIN bank.accounts a ON a.id = %s + g %% (%s - %s + 1)
+    """, (args.otps, first, last, first))
+    # Todos los logs caen en la partición del mes: el rango consultado no toca la por defecto
+    cur.execute("""
+        INSERT INTO logs_repo.app_logs (timestamp, log_type, ip_address, username, action, http_status)
+        SELECT %s + (g %% (27 * 86400)) * INTERVAL '1 second', 'INFO', '127.0.0.1', 'plan' || (g %% 100), 'plan', 200
+        FROM generate_series(1, %s) AS g
+    """, (month, args.logs))
+    for table in ("bank.users", "bank.accounts", "bank.credit_cards", "bank_secure.encrypted_cards",
+                  "bank.transactions", "bank.otp_codes", "logs_repo.app_logs"):
+        cur.execute(f"ANALYZE {table}")
+    return first
+
+
+def plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def check(cur, name: str, sql: str, params: tuple, *indexes: str) -> list:
+    """
+    Devuelve los problemas del plan de `sql` (lista vacía si está bien). Cada
+    índice esperado debe aparecer en el plan; uno que empieza con "_" vale como sufijo.
+    """
+    cur.execute("EXPLAIN (FORMAT JSON) " + cur.mogrify(sql, params).decode())
+    plan = cur.fetchone()[0]
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    nodes = list(plan_nodes(plan[0]["Plan"]))
+    problems = [f"{name}: Seq Scan sobre {n.get('Relation Name')}" for n in nodes if n["Node Type"] == "Seq Scan"]
+    used = sorted({n.get("Index Name") for n in nodes if n["Node Type"] in INDEX_NODES})
+    for index in indexes:
+        if not any(i == index or (index.startswith("_") and i.endswith(index)) for i in used):
+            problems.append(f"{name}: no usa {index} (índices: {', '.join(used) or 'ninguno'})")
+    print(f"{name:<12} {'ERROR' if problems else 'ok':<6} {', '.join(used)}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--transactions", type=int, default=200000)
+    parser.add_argument("--cards-per-user", type=int, default=3)
+    parser.add_argument("--otps", type=int, default=100000)
+    parser.add_argument("--logs", type=int, default=200000)
+    parser.add_argument("--throwaway-pg", action="store_true", help="Crea un Postgres temporal con initdb")
+    parser.add_argument("--pg-bin", help="Directorio con initdb/pg_ctl/createdb")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    from load_test import start_throwaway_postgres
+
+    stop_pg = None
+    if args.throwaway_pg:
+        host, stop_pg = start_throwaway_postgres(args.pg_bin)
+        os.environ.update({"POSTGRES_HOST": host, "POSTGRES_DB": "corebank", "POSTGRES_USER": "postgres"})
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+    try:
+        sys.path.insert(0, ROOT)
+        from app.db import CONSUME_OTP_SQL, new_connection
+        from app.export_logs import EXPORT_LOGS_SQL
+        from app.main import BALANCE_SQL, LOGIN_USER_SQL, STATEMENT_PAGE_SQL
+        from app.migrations import migrate
+
+        conn = new_connection()
+        migrate(conn)
+        cur = conn.cursor()
+        try:
+            now = datetime.now()
+            month = datetime(now.year, now.month, 1)
+            first_account = seed(cur, args, month)
+            cur.execute("SELECT user_id FROM bank.accounts WHERE id = %s", (first_account + 1,))
+            user_id = cur.fetchone()[0]
+            problems = []
+            problems += check(cur, "login", LOGIN_USER_SQL, ("plan42",), "users_username_key")
+            problems += check(cur, "otp", CONSUME_OTP_SQL, (user_id, "000042", now), "otp_codes_unused_idx")
+            problems += check(cur, "balance", BALANCE_SQL, (user_id, user_id),
+                              "accounts_user_id_idx", "credit_cards_user_id_idx")
+            problems += check(cur, "account", ACCOUNT_DEBIT_SQL, (1, user_id), "accounts_user_id_idx")
+            problems += check(cur, "credit-card", CREDIT_CARD_CHARGE_SQL, (1, user_id), "credit_cards_user_id_idx")
+            problems += check(cur, "stored-card", STORED_CARD_SQL, (user_id, "0042"), "encrypted_cards_user_last4_idx")
+            problems += check(cur, "statement", STATEMENT_PAGE_SQL, (user_id, datetime.max, 0, 51),
+                              "transactions_account_created_idx")
+            problems += check(cur, "logs", EXPORT_LOGS_SQL, (month + timedelta(days=7), month + timedelta(days=8)),
+                              "_timestamp_idx")
+        finally:
+            conn.rollback()
+            conn.close()
+    finally:
+        if stop_pg:
+            stop_pg()
+
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Prueba de humo de SERVING_MODE: levanta Gunicorn con gunicorn.conf.py en modo
+sync y en modo async (gevent), corre la misma secuencia de requests contra
+cada uno y compara las respuestas. Termina con código 1 si algún status,
+cuerpo o cabecera relevante difiere entre modos, o si una ráfaga de depósitos
+concurrentes no deja el mismo saldo.
+
+Cada modo usa usuarios nuevos; antes de comparar se reemplazan sus nombres y
+se ocultan los valores que cambian entre corridas (tokens, OTP, ids, fechas,
+cursores).
+
+    python bench/serving_modes.py --throwaway-pg
+    python bench/serving_modes.py --workers 2 --burst 200 -o serving_modes.json
+
+Con más de un worker el saldo cacheado de otro worker puede atrasarse unos
+milisegundos (LISTEN/NOTIFY) y dar diferencias que no son del modo; por eso
+el valor por defecto es un worker.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+MODES = ["sync", "async"]
+
+# Cambian en cada corrida: se compara que estén, no su valor
+VOLATILE_KEYS = {"token", "otp", "expires_at", "id", "created_at", "next_cursor", "pid", "warm_up_seconds"}
+
+
+def call(base_url: str, method: str, path: str, body: dict | None = None, token: str | None = None,
+         headers: dict | None = None) -> tuple[int, dict, object]:
+    """Devuelve (status, cabeceras, cuerpo JSON o None)."""
+    headers = dict(headers or {})
+    data = None
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        data = json.dumps(body).encode()
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    req = urllib.request.Request(base_url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            status, resp_headers, raw = resp.status, dict(resp.headers), resp.read()
+    except urllib.error.HTTPError as e:
+        status, resp_headers, raw = e.code, dict(e.headers), e.read()
+    return status, resp_headers, json.loads(raw) if raw else None
+
+
+def normalize(value, names: dict):
+    if isinstance(value, dict):
+        return {k: ("*" if k in VOLATILE_KEYS and v is not None else normalize(v, names)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [normalize(v, names) for v in value]
+    if isinstance(value, str):
+        return names.get(value, value)
+    return value
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(mode: str, workers: int) -> tuple[str, subprocess.Popen]:
+    port = free_port()
+    env = dict(os.environ, SERVING_MODE=mode, BIND=f"127.0.0.1:{port}", WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen([sys.executable, "-W", "ignore", "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app"],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn en modo {mode} terminó con código {proc.returncode}")
+        try:
+            if call(base_url, "GET", "/ready")[0] == 200:
+                return base_url, proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"gunicorn en modo {mode} no quedó listo")
+
+
+def run_sequence(base_url: str, prefix: str, burst: int) -> list[dict]:
+    """Recorre los endpoints de /auth y /bank; devuelve un paso normalizado por request."""
+    from load_test import BENCH_CARD, BENCH_PASSWORD, create_bench_users
+    from app.db import get_pool
+
+    user_a, user_b = create_bench_users(2, prefix=prefix)
+    pool = get_pool()
+    conn = pool.getconn()
+    cur = conn.cursor()
+    cur.execute("SELECT a.id FROM bank.accounts a JOIN bank.users u ON u.id = a.user_id WHERE u.username = %s", (user_a,))
+    account_a = cur.fetchone()[0]
+    conn.commit()
+    pool.putconn(conn)
+    missing = prefix + "-missing"
+    names = {user_a: "<user_a>", user_b: "<user_b>", missing: "<missing>"}
+    steps = []
+
+    def step(name, method, path, body=None, token=None, headers=None):
+        status, resp_headers, payload = call(base_url, method, path, body, token, headers)
+        steps.append({
+            "step": name,
+            "status": status,
+            "etag": "ETag" in resp_headers,
+            "body": normalize(payload, names)
+        })
+        return status, resp_headers, payload
+
+    tokens = {}
+    for user in (user_a, user_b):
+        tokens[user] = step("login", "POST", "/auth/login", {"username": user, "password": BENCH_PASSWORD})[2]["token"]
+    token = tokens[user_a]
+    step("login-wrong-password", "POST", "/auth/login", {"username": user_a, "password": "wrong"})
+    step("balance-no-token", "GET", "/bank/balance")
+    step("balance", "GET", "/bank/balance", token=token)
+    step("deposit", "POST", "/bank/deposit", {"account_number": account_a, "amount": 100}, token)
+    step("deposit-zero", "POST", "/bank/deposit", {"account_number": account_a, "amount": 0}, token)
+    step("withdraw", "POST", "/bank/withdraw", {"amount": 30}, token)
+    step("transfer", "POST", "/bank/transfer", {"target_username": user_b, "amount": 20}, token)
+    step("transfer-unknown", "POST", "/bank/transfer", {"target_username": missing, "amount": 1}, token)
+    step("batch-atomic", "POST", "/bank/batch-transfers",
+         {"mode": "atomic", "transfers": [{"target_username": user_b, "amount": 5}] * 2}, token)
+    step("batch-best-effort", "POST", "/bank/batch-transfers",
+         {"mode": "best_effort", "transfers": [{"target_username": user_b, "amount": 1},
+                                               {"target_username": missing, "amount": 1}]}, token)
+    otp = step("generate-otp", "POST", "/auth/generate-otp", {}, token)[2]["otp"]
+    step("validate-otp", "POST", "/auth/validate-otp", {"code": otp}, token)
+    step("validate-otp-reused", "POST", "/auth/validate-otp", {"code": otp}, token)
+    otp = step("generate-otp", "POST", "/auth/generate-otp", {}, token)[2]["otp"]
+    step("credit-payment", "POST", "/bank/credit-payment", {
+        "amount": 50, "card_number": BENCH_CARD, "expiry_date": "12/28", "cvv": "123",
+        "otp_code": otp, "establishment_id": 1
+    }, token)
+    step("pay-credit-balance", "POST", "/bank/pay-credit-balance", {"amount": 10}, token)
+    key = {"Idempotency-Key": f"{prefix}-deposit"}
+    step("deposit-idempotent", "POST", "/bank/deposit", {"account_number": account_a, "amount": 7}, token, key)
+    step("deposit-idempotent-retry", "POST", "/bank/deposit", {"account_number": account_a, "amount": 7}, token, key)
+    etag = step("balance", "GET", "/bank/balance", token=token)[1].get("ETag")
+    step("balance-not-modified", "GET", "/bank/balance", token=token, headers={"If-None-Match": etag} if etag else None)
+    step("balance-target", "GET", "/bank/balance", token=tokens[user_b])
+    cursor = step("statement", "GET", "/bank/statement?limit=3", token=token)[2]["next_cursor"]
+    step("statement-next", "GET", f"/bank/statement?limit=3&cursor={cursor}", token=token)
+    step("statement-bad-cursor", "GET", "/bank/statement?cursor=%%%", token=token)
+
+    # Ráfaga concurrente sobre la misma cuenta: el saldo final debe ser el mismo en ambos modos
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        statuses = list(executor.map(
+            lambda _: call(base_url, "POST", "/bank/deposit", {"account_number": account_a, "amount": 1}, token)[0],
+            range(burst)))
+    steps.append({"step": "deposit-burst", "status": sorted(set(statuses)), "etag": False,
+                  "body": {"ok": statuses.count(200), "requests": burst}})
+    step("balance-after-burst", "GET", "/bank/balance", token=token)
+
+    step("logout", "POST", "/auth/logout", token=token)
+    step("balance-after-logout", "GET", "/bank/balance", token=token)
+    return steps
+
+
+def compare(results: dict) -> list[str]:
+    sync, other = results["sync"], results["async"]
+    if len(sync) != len(other):
+        return [f"sync hizo {len(sync)} pasos y async {len(other)}"]
+    return [
+        f"{a['step']}: sync {json.dumps(a, sort_keys=True)} != async {json.dumps(b, sort_keys=True)}"
+        for a, b in zip(sync, other) if a != b
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--burst", type=int, default=100, help="Depósitos concurrentes de la ráfaga")
+    parser.add_argument("--throwaway-pg", action="store_true", help="Crea un Postgres temporal con initdb")
+    parser.add_argument("--pg-bin", help="Directorio con initdb/pg_ctl/createdb")
+    parser.add_argument("-o", "--output", default="serving_modes.json")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, ROOT)
+    from load_test import start_throwaway_postgres
+
+    stop_pg = None
+    if args.throwaway_pg:
+        host, stop_pg = start_throwaway_postgres(args.pg_bin)
+        os.environ.update({"POSTGRES_HOST": host, "POSTGRES_DB": "corebank", "POSTGRES_USER": "postgres"})
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+    # Se comparan respuestas, no los límites de tasa
+    os.environ.setdefault("RATE_LIMIT_USER_RATE", "0")
+    os.environ.setdefault("RATE_LIMIT_LOGIN_RATE", "0")
+
+    run_id = time.strftime("%H%M%S")
+    results = {}
+    try:
+        for mode in MODES:
+            base_url, proc = start_gunicorn(mode, args.workers)
+            try:
+                results[mode] = run_sequence(base_url, f"serve{run_id}{mode}", args.burst)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=30)
+            print(f"{mode:<6} {len(results[mode])} pasos")
+    finally:
+        if stop_pg:
+            stop_pg()
+
+    failures = compare(results)
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "workers": args.workers,
+                            "burst": args.burst}, "modes": results, "differences": failures}, fh, indent=2)
+    print(f"Resultados guardados en {args.output}")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("Mismas respuestas en sync y async")
+
+
+if __name__ == "__main__":
+    main()
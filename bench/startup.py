@@ -0,0 +1,102 @@
+"""
+Benchmark de arranque: tiempo de import de app.main (incluye create_app) y
+latencia del primer request de un proceso nuevo, con y sin warm-up.
+
+Cada corrida es un proceso aparte:
+
+    cold  WARM_UP=0 y sin warm_up(): todo se inicializa en el primer request
+    warm  create_app prepara Swagger/cifrador/JWT y warm_up() corre antes del
+          primer request (lo que hace gunicorn en post_worker_init)
+
+    python bench/startup.py --throwaway-pg --runs 5 -o startup_results.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+MODES = ["cold", "warm"]
+
+
+def child(mode: str):
+    """Mide un arranque en este proceso e imprime el resultado en JSON."""
+    sys.path.insert(0, ROOT)
+    result = {}
+    start = time.perf_counter()
+    from app.main import app, warm_up
+    result["import_ms"] = (time.perf_counter() - start) * 1000
+    if mode == "warm":
+        start = time.perf_counter()
+        warm_up()
+        result["warm_up_ms"] = (time.perf_counter() - start) * 1000
+    client = app.test_client()
+    for name, path in (("first_request_ms", "/swagger.json"), ("second_request_ms", "/swagger.json")):
+        start = time.perf_counter()
+        response = client.get(path)
+        result[name] = (time.perf_counter() - start) * 1000
+        assert response.status_code == 200, response.status_code
+    start = time.perf_counter()
+    response = client.post("/auth/login", json={"username": "user1", "password": "pass1"})
+    result["first_login_ms"] = (time.perf_counter() - start) * 1000
+    assert response.status_code == 200, response.status_code
+    print(json.dumps(result))
+
+
+def run(mode: str) -> dict:
+    env = dict(os.environ)
+    if mode == "cold":
+        env["WARM_UP"] = "0"
+    out = subprocess.run([sys.executable, "-W", "ignore", os.path.abspath(__file__), "--child", mode],
+                         env=env, check=True, capture_output=True, text=True, cwd=ROOT)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--throwaway-pg", action="store_true", help="Crea un Postgres temporal con initdb")
+    parser.add_argument("--pg-bin", help="Directorio con initdb/pg_ctl/createdb")
+    parser.add_argument("-o", "--output", default="startup_results.json")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    sys.path.insert(0, BENCH_DIR)
+    from load_test import start_throwaway_postgres
+
+    stop_pg = None
+    if args.throwaway_pg:
+        host, stop_pg = start_throwaway_postgres(args.pg_bin)
+        os.environ.update({"POSTGRES_HOST": host, "POSTGRES_DB": "corebank", "POSTGRES_USER": "postgres"})
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+    os.environ.setdefault("RATE_LIMIT_LOGIN_RATE", "0")
+    try:
+        # Deja el esquema migrado: se mide el arranque de un worker, no la creación de la base
+        run("warm")
+        results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": args.runs,
+                            "python": sys.version.split()[0]}, "modes": {}}
+        for mode in MODES:
+            samples = [run(mode) for _ in range(args.runs)]
+            results["modes"][mode] = {
+                key: round(statistics.median(sample[key] for sample in samples), 3)
+                for key in samples[0]
+            }
+            print(mode, json.dumps(results["modes"][mode]))
+    finally:
+        if stop_pg:
+            stop_pg()
+
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(results, fh, indent=2)
+    print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# gunicorn.conf.py
+# SERVING_MODE=sync  -> workers síncronos (un request en vuelo por worker).
+# SERVING_MODE=async -> workers gevent: cada worker atiende hasta
+#                       WORKER_CONNECTIONS requests concurrentes en un event loop
+#                       y psycopg2 cede el control mientras espera a Postgres.
+# Con async conviene subir DB_POOL_MAX: el pool es el límite real de
+# requests que pueden estar hablando con la base a la vez. El tope de
+# requests en curso (MAX_IN_FLIGHT, app/ratelimit.py) toma por defecto
+# WORKER_CONNECTIONS en async y 64 en sync; si se fija a mano en async, debe
+# acompañar a WORKER_CONNECTIONS o el worker responderá 503 antes de tiempo.
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+SERVING_MODE = os.environ.get("SERVING_MODE", "sync")
+
+if SERVING_MODE == "async":
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+
+# --preload: el master importa la app (create_app prepara Swagger, cifrador y
+# clave del JWT) una sola vez y los workers la heredan al hacer fork. En modo
+# async queda desactivado por defecto: gevent debe parchear antes de importar.
+preload_app = os.environ.get("PRELOAD_APP", "1" if SERVING_MODE == "sync" else "0") == "1"
+
+def on_starting(server):
+    # Migra una sola vez en el master, antes de crear los workers: en cada
+    # worker el primer request solo comprueba la versión del esquema.
+    # Si la base aún no responde, lo reintenta el primer request de cada worker.
+    from app.db import new_connection
+    from app.migrations import migrate
+    try:
+        conn = new_connection()
+        try:
+            server.log.info("Esquema en la versión %s", migrate(conn))
+        finally:
+            conn.close()
+    except Exception as e:
+        server.log.warning("No se pudo migrar el esquema al arrancar: %s", e)
+
+def post_fork(server, worker):
+    if SERVING_MODE == "async":
+        # Hace cooperativas las esperas de red de psycopg2 (pool, LISTEN, cursores)
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+def post_worker_init(worker):
+    # Warm-up del worker antes de aceptar conexiones; si falla (p. ej. la base
+    # no responde) lo reintenta el primer request y /ready responde 503
+    from app.main import warm_up
+    try:
+        warm_up()
+        worker.log.info("Worker %s listo", worker.pid)
+    except Exception as e:
+        worker.log.warning("Warm-up del worker %s fallido: %s", worker.pid, e)